@@ -0,0 +1,262 @@
+"""
+Population Amplification
+Scales a processed corpus up for load tests without running Synthea again:
+every patient bundle is emitted as K variants, each a new synthetic person.
+
+Per variant, on the raw bytes:
+    - every resource id of the bundle (and so every urn:uuid / Type/id
+      reference to it) is replaced by a deterministic uuid5 of (id, variant)
+    - all dates are moved back by a random whole number of days (see
+      rebaseline.py), keeping the record internally consistent
+Then, on the parsed bundle:
+    - race/ethnicity is re-sampled from ADAP_DEMOGRAPHICS, and the digits of
+      the name, SSN/driver's license/passport and phone numbers re-drawn
+    - the post-processor's medications and labs are dropped and drawn afresh
+      (lab values, regimen and dates), keeping the patient's ADAP status
+
+Sex and birth date are kept: Synthea's clinical history depends on them, and
+their distribution already follows ADAP_DEMOGRAPHICS when the corpus was
+generated with STRATIFIED=true. The input must be a processed corpus in the
+default 'bundle' output mode. Files are processed in a process pool.
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import uuid
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Dict, List, Tuple
+from dotenv import load_dotenv
+
+from fhir_archive import reject_archives
+from fhir_files import OUTPUT_LAYOUTS, PATIENT, output_path_for, scan_bundle_files
+from population_generator import ADAP_DEMOGRAPHICS
+from post_processor import GENERATED_NAMESPACE, GENERATED_TAG, FHIRPostProcessor
+from rebaseline import shift_dates
+
+load_dotenv()
+
+AMPLIFY_NAMESPACE = uuid.uuid5(GENERATED_NAMESPACE, 'amplify')
+
+US_CORE_RACE = 'http://hl7.org/fhir/us/core/StructureDefinition/us-core-race'
+US_CORE_ETHNICITY = 'http://hl7.org/fhir/us/core/StructureDefinition/us-core-ethnicity'
+OMB_SYSTEM = 'urn:oid:2.16.840.1.113883.6.238'
+
+# ADAP race/ethnicity key -> US Core OMB race category (Hispanic patients are coded White)
+RACE_CODINGS = {
+    'white': ('2106-3', 'White'),
+    'black': ('2054-5', 'Black or African American'),
+    'asian': ('2028-9', 'Asian'),
+    'native': ('1002-5', 'American Indian or Alaska Native'),
+    'other': ('2076-8', 'Native Hawaiian or Other Pacific Islander'),
+    'hispanic': ('2106-3', 'White')
+}
+ETHNICITY_CODINGS = {
+    True: ('2135-2', 'Hispanic or Latino'),
+    False: ('2186-5', 'Not Hispanic or Latino')
+}
+
+# Patient identifier types whose values are re-drawn (MR is the resource id)
+REDRAWN_IDENTIFIERS = {'SS', 'DL', 'PPN'}
+
+_UUID = re.compile(rb'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+_FULL_URL = re.compile(rb'"fullUrl": ?"urn:uuid:([0-9a-f-]{36})"')
+_DIGITS = re.compile(r'\d')
+
+
+def variant_id(resource_id: str, variant: int) -> str:
+    return str(uuid.uuid5(AMPLIFY_NAMESPACE, f"{resource_id}:{variant}"))
+
+
+def rewrite_ids(data: bytes, variant: int) -> bytes:
+    """Replace the bundle's own resource ids wherever they occur"""
+    ids = {match.group(1): variant_id(match.group(1).decode('ascii'), variant).encode('ascii')
+           for match in _FULL_URL.finditer(data)}
+    return _UUID.sub(lambda match: ids.get(match.group(0), match.group(0)), data)
+
+
+def redraw_digits(value: str, rng: random.Random) -> str:
+    return _DIGITS.sub(lambda _: str(rng.randrange(10)), value)
+
+
+def race_extensions(race: str) -> List[Dict]:
+    """US Core race and ethnicity extensions for an ADAP race/ethnicity key"""
+    extensions = []
+    for url, (code, display) in ((US_CORE_RACE, RACE_CODINGS[race]),
+                                 (US_CORE_ETHNICITY, ETHNICITY_CODINGS[race == 'hispanic'])):
+        extensions.append({
+            "url": url,
+            "extension": [
+                {"url": "ombCategory", "valueCoding": {"system": OMB_SYSTEM, "code": code, "display": display}},
+                {"url": "text", "valueString": display}
+            ]
+        })
+    return extensions
+
+
+def is_generated(resource: Dict) -> bool:
+    return any(tag.get('system') == GENERATED_TAG['system'] for tag in resource.get('meta', {}).get('tag', []))
+
+
+class PopulationAmplifier:
+    """Emit K new-identity variants of every patient in a processed corpus"""
+
+    def __init__(self,
+                 corpus_dir: str,
+                 output_dir: str,
+                 copies: int,
+                 seed: int = None,
+                 max_jitter_days: int = 90,
+                 output_layout: str = 'flat',
+                 workers: int = None):
+        self.corpus_dir = Path(corpus_dir)
+        self.output_dir = Path(output_dir)
+        self.copies = copies
+        self.seed = seed
+        self.max_jitter_days = max_jitter_days
+        self.output_layout = output_layout
+        self.workers = workers or os.cpu_count() or 1
+        # Only used for its medication/lab generators, never run over a directory
+        self.processor = FHIRPostProcessor(corpus_dir, output_dir, seed=seed)
+        self.races = list(ADAP_DEMOGRAPHICS['race_ethnicity'])
+        self.race_weights = [ADAP_DEMOGRAPHICS['race_ethnicity'][race] for race in self.races]
+
+    def variant_rng(self, name: str, variant: int) -> random.Random:
+        """Per-variant stream: reproducible with a seed, fresh otherwise"""
+        return random.Random(f"{self.seed}:{name}:{variant}" if self.seed is not None else None)
+
+    def resample_patient(self, patient: Dict, rng: random.Random):
+        """New race/ethnicity and re-drawn identifying digits, in place"""
+        race = rng.choices(self.races, self.race_weights)[0]
+        patient['extension'] = [
+            extension for extension in patient.get('extension', [])
+            if extension.get('url') not in (US_CORE_RACE, US_CORE_ETHNICITY)
+        ] + race_extensions(race)
+        for name in patient.get('name', []):
+            name['given'] = [redraw_digits(given, rng) for given in name.get('given', [])]
+            if 'family' in name:
+                name['family'] = redraw_digits(name['family'], rng)
+        for identifier in patient.get('identifier', []):
+            codings = identifier.get('type', {}).get('coding', [{}])
+            if codings[0].get('code') in REDRAWN_IDENTIFIERS and 'value' in identifier:
+                identifier['value'] = redraw_digits(identifier['value'], rng)
+        for telecom in patient.get('telecom', []):
+            if telecom.get('system') == 'phone' and 'value' in telecom:
+                telecom['value'] = redraw_digits(telecom['value'], rng)
+
+    def variant(self, name: str, data: bytes, variant: int) -> Tuple[str, bytes]:
+        """(file name, bundle bytes) of one variant of a patient bundle"""
+        rng = self.variant_rng(name, variant)
+        data, _ = shift_dates(rewrite_ids(data, variant), -rng.randint(0, self.max_jitter_days))
+        bundle = json.loads(data)
+
+        entries = bundle.get('entry', [])
+        kept = [entry for entry in entries if not is_generated(entry.get('resource', {}))]
+        is_adap = len(kept) < len(entries)
+        bundle['entry'] = kept
+
+        patient = next((e['resource'] for e in kept if e['resource'].get('resourceType') == 'Patient'), None)
+        if patient is None:
+            return f"{Path(name).stem}_{variant}.json", json.dumps(bundle, indent=2).encode('utf-8')
+        self.resample_patient(patient, rng)
+        self.processor.add_hiv_resources(bundle, is_adap=is_adap, rng=rng)
+
+        # Synthea's naming: Given_Family_<patient id>.json
+        human_name = (patient.get('name') or [{}])[0]
+        given = (human_name.get('given') or ['Patient'])[0]
+        family = human_name.get('family', 'Unknown')
+        return f"{given}_{family}_{patient['id']}.json", json.dumps(bundle, indent=2).encode('utf-8')
+
+    def amplify_file(self, path: str) -> int:
+        """Write all variants of one patient bundle; returns the number written"""
+        name = Path(path).name
+        with open(path, 'rb') as f:
+            data = f.read()
+        for k in range(self.copies):
+            variant_name, variant_data = self.variant(name, data, k)
+            target = output_path_for(self.output_dir, variant_name, self.output_layout)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            with open(target, 'wb') as f:
+                f.write(variant_data)
+        return self.copies
+
+    def amplify(self) -> Tuple[int, int]:
+        """Amplify the corpus; returns (source patients, patients written)"""
+        # Variants are read and written one bundle file at a time
+        reject_archives(self.corpus_dir, 'amplification')
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        # Hospital/practitioner bundles are shared by every variant: copy them once
+        for bundle_file in scan_bundle_files(self.corpus_dir):
+            if bundle_file.kind != PATIENT:
+                shutil.copyfile(bundle_file.path, self.output_dir / bundle_file.name)
+
+        paths = (bundle_file.path for bundle_file in
+                 scan_bundle_files(self.corpus_dir, recursive=True, kinds={PATIENT}))
+        sources = 0
+        written = 0
+        if self.workers <= 1:
+            results = map(self.amplify_file, paths)
+        else:
+            pool = Pool(self.workers, _init_worker, (self._settings(),))
+            results = pool.imap_unordered(_amplify_file, paths, chunksize=16)
+        try:
+            for count in results:
+                sources += 1
+                written += count
+        finally:
+            if self.workers > 1:
+                pool.close()
+                pool.join()
+        return sources, written
+
+    def _settings(self) -> Dict:
+        return {
+            'corpus_dir': str(self.corpus_dir),
+            'output_dir': str(self.output_dir),
+            'copies': self.copies,
+            'seed': self.seed,
+            'max_jitter_days': self.max_jitter_days,
+            'output_layout': self.output_layout,
+            'workers': 1
+        }
+
+
+_worker_amplifier = None
+
+
+def _init_worker(settings: Dict):
+    global _worker_amplifier
+    _worker_amplifier = PopulationAmplifier(**settings)
+
+
+def _amplify_file(path: str) -> int:
+    return _worker_amplifier.amplify_file(path)
+
+
+def main():
+    """Main execution"""
+    parser = argparse.ArgumentParser(description="Clone every patient of a processed corpus into new-identity variants")
+    parser.add_argument('corpus_dir', nargs='?', default=os.getenv('PROCESSED_FHIR_DIR', './processed_fhir'))
+    parser.add_argument('--output-dir', required=True)
+    parser.add_argument('--copies', type=int, required=True, help="Variants written per source patient")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--max-jitter-days', type=int, default=90,
+                        help="Each variant's dates move back by up to this many days")
+    parser.add_argument('--output-layout', choices=OUTPUT_LAYOUTS, default='flat')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    amplifier = PopulationAmplifier(args.corpus_dir, args.output_dir, args.copies, args.seed,
+                                    args.max_jitter_days, args.output_layout, args.workers)
+    print(f"🧬 Amplifying {args.corpus_dir} x{args.copies}")
+    sources, written = amplifier.amplify()
+    print(f"✅ {written} patients from {sources} source patients")
+    print(f"\n📁 Output saved to: {amplifier.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
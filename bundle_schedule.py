@@ -0,0 +1,75 @@
+"""
+Size-Aware Bundle Scheduling
+Orders and batches the bundle work list for parallel workers, so a few huge
+bundles do not start last and leave one worker running after the rest are idle.
+
+Bundles are taken largest first (LPT). Consecutive bundles are grouped into
+tasks up to a target size that shrinks with the work left (guided
+self-scheduling): early tasks are large, a bundle bigger than the target goes
+alone, and the last tasks are small enough for the workers to finish at about
+the same time. Batching the many small bundles also saves per-task overhead.
+
+imap_bounded runs a stream of calls on a process pool without submitting
+them all up front (Executor.map does), so memory stays bounded by the
+window and results arrive as the calls finish.
+"""
+
+from concurrent.futures import Executor, FIRST_COMPLETED, wait
+from itertools import islice
+from typing import Any, Callable, Iterable, Iterator, List, Tuple
+
+from fhir_files import BundleFile
+
+
+def schedule_bundles(bundle_files: Iterable[BundleFile],
+                     workers: int,
+                     chunks_per_worker: int = 4,
+                     min_chunk_bytes: int = 256 * 1024,
+                     max_chunk_files: int = 64) -> List[List[BundleFile]]:
+    """Tasks (lists of bundle files, sizes required) in the order to run them
+
+    Each task targets remaining bytes / (workers * chunks_per_worker), but not
+    less than min_chunk_bytes.
+    """
+    ordered = sorted(bundle_files, key=lambda bundle_file: bundle_file.size, reverse=True)
+    remaining = sum(bundle_file.size for bundle_file in ordered)
+    slots = max(workers, 1) * chunks_per_worker
+    tasks = []
+    i = 0
+    while i < len(ordered):
+        target = max(remaining / slots, min_chunk_bytes)
+        task = [ordered[i]]
+        task_bytes = ordered[i].size
+        i += 1
+        while i < len(ordered) and len(task) < max_chunk_files and task_bytes + ordered[i].size <= target:
+            task.append(ordered[i])
+            task_bytes += ordered[i].size
+            i += 1
+        tasks.append(task)
+        remaining -= task_bytes
+    return tasks
+
+
+def iter_batches(items: Iterable, size: int) -> Iterator[List]:
+    """Consecutive lists of up to size items"""
+    items = iter(items)
+    while True:
+        batch = list(islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+def imap_bounded(pool: Executor, calls: Iterable[Tuple[Callable, Any]], window: int) -> Iterator:
+    """fn(arg) of each (fn, arg) call in completion order, at most window submitted at a time"""
+    pending = set()
+    for fn, arg in calls:
+        pending.add(pool.submit(fn, arg))
+        if len(pending) >= window:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
@@ -0,0 +1,117 @@
+"""
+Per-Resource Content Hash Index
+Written by FHIRPostProcessor next to its output (content_index.bin) so two
+runs can be diffed resource by resource without re-reading either corpus.
+
+The file is a header followed by one block per written bundle:
+    name        logical bundle name (the Synthea file name)
+    path        output file holding the resources, relative to the corpus
+    offset/len  byte range of this bundle's data within path
+    digest      hash over all records, to skip unchanged bundles quickly
+    records     (Type/id, 16-byte BLAKE2b of the canonical resource JSON)
+"""
+
+import hashlib
+import json
+import struct
+from typing import BinaryIO, Dict, Iterator, List, NamedTuple, Tuple
+
+CONTENT_INDEX_FILE = 'content_index.bin'
+MAGIC = b'FHIRIDX2'  # 2: 16-bit key lengths
+DIGEST_SIZE = 16
+
+_BLOCK_HEADER = struct.Struct('<QQ16sIQ')
+_KEY_SIZE = struct.Struct('<H')
+
+
+class IndexBlock(NamedTuple):
+    name: str
+    path: str
+    offset: int
+    length: int
+    digest: bytes
+    count: int
+    records_size: int
+    records_offset: int  # where the records start in the index file
+
+
+def resource_key(resource: Dict) -> str:
+    return f"{resource['resourceType']}/{resource.get('id', '')}"
+
+
+def content_hash(resource: Dict) -> bytes:
+    """Hash of a resource independent of key order and whitespace"""
+    canonical = json.dumps(resource, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.blake2b(canonical.encode('utf-8'), digest_size=DIGEST_SIZE).digest()
+
+
+def index_records(resources: Iterator[Dict]) -> List[Tuple[str, bytes]]:
+    return [(resource_key(resource), content_hash(resource)) for resource in resources]
+
+
+def _string(value: str) -> bytes:
+    data = value.encode('utf-8')
+    return struct.pack('<H', len(data)) + data
+
+
+def encode_block(name: str, path: str, offset: int, length: int, records: List[Tuple[str, bytes]]) -> bytes:
+    """Serialize one bundle's records as an index block"""
+    body = b''.join(
+        _KEY_SIZE.pack(len(key_bytes)) + key_bytes + digest
+        for key_bytes, digest in ((key.encode('utf-8'), digest) for key, digest in records)
+    )
+    digest = hashlib.blake2b(body, digest_size=DIGEST_SIZE).digest()
+    return _string(name) + _string(path) + _BLOCK_HEADER.pack(offset, length, digest, len(records), len(body)) + body
+
+
+def open_index(path) -> BinaryIO:
+    """Create an index file for writing"""
+    f = open(path, 'wb')
+    f.write(MAGIC)
+    return f
+
+
+def _read_string(f: BinaryIO) -> str:
+    header = f.read(2)
+    if len(header) < 2:
+        raise EOFError
+    (size,) = struct.unpack('<H', header)
+    return f.read(size).decode('utf-8')
+
+
+def iter_blocks(f: BinaryIO) -> Iterator[IndexBlock]:
+    """Scan block headers, skipping over the records"""
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a content index file")
+    while True:
+        try:
+            name = _read_string(f)
+        except EOFError:
+            return
+        path = _read_string(f)
+        offset, length, digest, count, records_size = _BLOCK_HEADER.unpack(f.read(_BLOCK_HEADER.size))
+        records_offset = f.tell()
+        f.seek(records_size, 1)
+        yield IndexBlock(name, path, offset, length, digest, count, records_size, records_offset)
+
+
+def load_blocks(path) -> Dict[str, IndexBlock]:
+    """Bundle name -> block header for every block in an index file"""
+    with open(path, 'rb') as f:
+        return {block.name: block for block in iter_blocks(f)}
+
+
+def read_records(f: BinaryIO, block: IndexBlock) -> Dict[str, bytes]:
+    """Type/id -> content hash for one block"""
+    f.seek(block.records_offset)
+    body = f.read(block.records_size)
+    records = {}
+    position = 0
+    for _ in range(block.count):
+        (key_size,) = _KEY_SIZE.unpack_from(body, position)
+        position += _KEY_SIZE.size
+        key = body[position:position + key_size].decode('utf-8')
+        position += key_size
+        records[key] = body[position:position + DIGEST_SIZE]
+        position += DIGEST_SIZE
+    return records
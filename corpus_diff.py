@@ -0,0 +1,180 @@
+"""
+Resource-Level Diff Between Two Processed Corpora
+Compares the content_index.bin files written by FHIRPostProcessor
+(content_index=True) for a previous and a current run and emits only the
+resources that were added, changed or deleted, so a test server can be
+re-synced incrementally instead of re-uploading the whole population.
+
+Bundles whose block digest is unchanged are skipped without reading
+anything else; only changed bundles are opened in the current corpus to
+extract the resources to upload. Output is either NDJSON (one file per
+resource type plus deleted.ndjson) or FHIR batch Bundles (PUT/DELETE).
+"""
+
+import argparse
+import json
+import os
+from pathlib import Path
+from typing import Dict, Iterator, List, Set, Tuple
+from dotenv import load_dotenv
+
+from content_index import CONTENT_INDEX_FILE, load_blocks, read_records, resource_key, IndexBlock
+
+load_dotenv()
+
+OUTPUT_FORMATS = ('ndjson', 'batch')
+DELETED_FILE = 'deleted.ndjson'
+
+
+def rewrite_references(node, references: Dict[str, str]):
+    """Replace bundle-local urn:uuid references with Type/id, in place"""
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key == 'reference' and isinstance(value, str) and value in references:
+                node[key] = references[value]
+            else:
+                rewrite_references(value, references)
+    elif isinstance(node, list):
+        for item in node:
+            rewrite_references(item, references)
+
+
+def load_resources(corpus_dir: Path, block: IndexBlock) -> Iterator[Dict]:
+    """Resources of one indexed bundle, with urn:uuid references made absolute"""
+    with open(corpus_dir / block.path, 'rb') as f:
+        f.seek(block.offset)
+        data = f.read(block.length)
+    if block.path.endswith('.ndjson'):
+        yield from (json.loads(line) for line in data.splitlines() if line.strip())
+        return
+    entries = json.loads(data).get('entry', [])
+    references = {
+        entry['fullUrl']: resource_key(entry['resource'])
+        for entry in entries if entry.get('fullUrl', '').startswith('urn:uuid:')
+    }
+    for entry in entries:
+        resource = entry['resource']
+        rewrite_references(resource, references)
+        yield resource
+
+
+class CorpusDiff:
+    """Added/changed/deleted resources between two indexed corpora"""
+
+    def __init__(self, previous_dir: str, current_dir: str):
+        self.previous_dir = Path(previous_dir)
+        self.current_dir = Path(current_dir)
+        self.counts = {'added': 0, 'changed': 0, 'deleted': 0, 'unchanged_bundles': 0, 'changed_bundles': 0}
+
+    def iter_changes(self) -> Iterator[Tuple[str, object]]:
+        """Yield ('upsert', resource) for each added/changed resource, then ('delete', 'Type/id')"""
+        previous = load_blocks(self.previous_dir / CONTENT_INDEX_FILE)
+        current = load_blocks(self.current_dir / CONTENT_INDEX_FILE)
+        deleted: Set[str] = set()
+        upserted: Set[str] = set()
+
+        with open(self.previous_dir / CONTENT_INDEX_FILE, 'rb') as prev_index, \
+                open(self.current_dir / CONTENT_INDEX_FILE, 'rb') as cur_index:
+            for name, block in current.items():
+                old_block = previous.get(name)
+                if old_block is not None and old_block.digest == block.digest:
+                    self.counts['unchanged_bundles'] += 1
+                    continue
+                self.counts['changed_bundles'] += 1
+                records = read_records(cur_index, block)
+                old_records = read_records(prev_index, old_block) if old_block is not None else {}
+
+                changed = {key for key, digest in records.items() if old_records.get(key) != digest}
+                deleted.update(key for key in old_records if key not in records)
+                if changed:
+                    for resource in load_resources(self.current_dir, block):
+                        key = resource_key(resource)
+                        if key in changed:
+                            self.counts['changed' if key in old_records else 'added'] += 1
+                            upserted.add(key)
+                            yield 'upsert', resource
+
+            for name, old_block in previous.items():
+                if name not in current:
+                    deleted.update(read_records(prev_index, old_block))
+
+        # A resource that moved to another bundle is an update, not a delete
+        for key in sorted(deleted - upserted):
+            self.counts['deleted'] += 1
+            yield 'delete', key
+
+    def write_ndjson(self, output_dir: Path):
+        """One <Type>.ndjson per upserted resource type plus deleted.ndjson"""
+        output_dir.mkdir(parents=True, exist_ok=True)
+        streams = {}
+        try:
+            for action, item in self.iter_changes():
+                if action == 'upsert':
+                    name = f"{item['resourceType']}.ndjson"
+                    record = item
+                else:
+                    name = DELETED_FILE
+                    resource_type, resource_id = item.split('/', 1)
+                    record = {'resourceType': resource_type, 'id': resource_id}
+                if name not in streams:
+                    streams[name] = open(output_dir / name, 'w', encoding='utf-8')
+                streams[name].write(json.dumps(record, separators=(',', ':')) + '\n')
+        finally:
+            for stream in streams.values():
+                stream.close()
+
+    def write_batches(self, output_dir: Path, batch_size: int = 500):
+        """FHIR batch Bundles of PUT (added/changed) and DELETE requests"""
+        output_dir.mkdir(parents=True, exist_ok=True)
+        entries: List[Dict] = []
+        batch_count = 0
+
+        def flush():
+            nonlocal batch_count, entries
+            if not entries:
+                return
+            batch_count += 1
+            bundle = {"resourceType": "Bundle", "type": "batch", "entry": entries}
+            with open(output_dir / f"batch_{batch_count:06d}.json", 'w', encoding='utf-8') as f:
+                json.dump(bundle, f, separators=(',', ':'))
+            entries = []
+
+        for action, item in self.iter_changes():
+            if action == 'upsert':
+                url = resource_key(item)
+                entries.append({"resource": item, "request": {"method": "PUT", "url": url}})
+            else:
+                entries.append({"request": {"method": "DELETE", "url": item}})
+            if len(entries) >= batch_size:
+                flush()
+        flush()
+
+    def print_report(self, output_dir: Path):
+        print(f"\n🔀 Diff {self.previous_dir} -> {self.current_dir}")
+        print(f"   Bundles: {self.counts['changed_bundles']} changed, {self.counts['unchanged_bundles']} unchanged")
+        print(f"   Resources: {self.counts['added']} added, {self.counts['changed']} changed, "
+              f"{self.counts['deleted']} deleted")
+        print(f"\n📁 Changes saved to: {output_dir}")
+
+
+def main():
+    """Main execution"""
+    parser = argparse.ArgumentParser(description="Emit the resources that changed between two processed corpora")
+    parser.add_argument('previous_dir')
+    parser.add_argument('current_dir', nargs='?', default=os.getenv('PROCESSED_FHIR_DIR', './processed_fhir'))
+    parser.add_argument('--output-dir', default='./fhir_diff')
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='ndjson')
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+
+    diff = CorpusDiff(args.previous_dir, args.current_dir)
+    output_dir = Path(args.output_dir)
+    if args.format == 'ndjson':
+        diff.write_ndjson(output_dir)
+    else:
+        diff.write_batches(output_dir, args.batch_size)
+    diff.print_report(output_dir)
+
+
+if __name__ == "__main__":
+    main()
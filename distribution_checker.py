@@ -0,0 +1,387 @@
+"""
+Distribution Conformance Checker for Generated Cohorts
+Verifies that a processed corpus matches the distributions it was generated
+from: ADAP_DEMOGRAPHICS sex/age/race proportions, the ADAP percentage, the
+85/10/5 viral load split, qualitative coinfection rates and the quantitative
+lab ranges in COMPLETE_HIV_LABS.
+
+The corpus is read in a single streaming pass into fixed-size counters and
+histograms, so memory use does not grow with the number of bundles.
+Categorical targets are tested with a chi-square goodness-of-fit test and
+quantitative labs with a (binned) Kolmogorov-Smirnov test.
+"""
+
+import argparse
+import json
+import math
+import os
+from collections import Counter
+from datetime import date
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+import numpy as np
+from dotenv import load_dotenv
+
+from fhir_archive import archive_shards, iter_archives
+from fhir_files import PATIENT, scan_bundle_files
+from population_generator import ADAP_DEMOGRAPHICS, AGE_RANGES
+from post_processor import COMPLETE_HIV_LABS, BASELINE_ONLY_TESTS, GENERATED_TAG
+from hab_measures import ART_RXNORM_CODES
+from lab_model import DERIVED_LABS, range_mixture_cdf
+from synthea_module import HIV_CONDITION_CODE, QUALITATIVE_RESULT_CODES
+
+load_dotenv()
+
+
+# Viral load split used by generate_complete_lab_panel
+VIRAL_LOAD_TARGETS = {'undetectable': 0.85, 'suppressed': 0.10, 'detectable': 0.05}
+
+# Quantitative labs drawn from an equal-weight mixture of their ranges
+# (viral load, CD4 and HCV RNA are conditional and checked elsewhere;
+# LDL and eGFR are derived from other labs by the lab model)
+CONDITIONAL_LABS = {'hiv_viral_load', 'cd4_count', 'cd4_percent', 'hep_c_rna'} | DERIVED_LABS
+
+# US Core OMB race category codes -> ADAP race/ethnicity key
+OMB_RACE_CODES = {
+    '2106-3': 'white',
+    '2054-5': 'black',
+    '2028-9': 'asian',
+    '1002-5': 'native',
+    '2076-8': 'other'
+}
+HISPANIC_ETHNICITY_CODE = '2135-2'
+
+HISTOGRAM_BINS = 200
+
+# SNOMED qualifier code -> result label, for the all-in-one module's coded results
+QUALITATIVE_RESULT_LABELS = {code: label for label, (code, _) in QUALITATIVE_RESULT_CODES.items()}
+
+
+def age_bucket(age: int) -> Optional[str]:
+    """Map an age in years to its ADAP_DEMOGRAPHICS age bucket"""
+    for name, (low, high) in AGE_RANGES.items():
+        if low <= age <= high or (name == '>=65' and age >= low):
+            return name
+    return None
+
+
+def chi2_sf(x: float, dof: int) -> float:
+    """Chi-square survival function via the regularized upper incomplete gamma"""
+    if dof <= 0:
+        return float('nan')
+    if x <= 0:
+        return 1.0
+    a, z = dof / 2.0, x / 2.0
+    log_prefix = -z + a * math.log(z) - math.lgamma(a)
+
+    if z < a + 1:
+        # Series expansion of the lower incomplete gamma
+        term = total = 1.0 / a
+        n = a
+        for _ in range(1000):
+            n += 1
+            term *= z / n
+            total += term
+            if abs(term) < abs(total) * 1e-15:
+                break
+        return max(0.0, 1.0 - total * math.exp(log_prefix))
+
+    # Continued fraction (modified Lentz) for the upper incomplete gamma
+    tiny = 1e-300
+    b = z + 1 - a
+    c = 1 / tiny
+    d = 1 / b
+    h = d
+    for i in range(1, 1000):
+        an = -i * (i - a)
+        b += 2
+        d = an * d + b
+        d = tiny if abs(d) < tiny else d
+        c = b + an / c
+        c = tiny if abs(c) < tiny else c
+        d = 1 / d
+        delta = d * c
+        h *= delta
+        if abs(delta - 1) < 1e-15:
+            break
+    return min(1.0, math.exp(log_prefix) * h)
+
+
+def ks_sf(statistic: float, n: int) -> float:
+    """Asymptotic Kolmogorov distribution p-value for a one-sample KS statistic"""
+    if n <= 0:
+        return float('nan')
+    sqrt_n = math.sqrt(n)
+    lam = (sqrt_n + 0.12 + 0.11 / sqrt_n) * statistic
+    if lam < 1e-3:
+        return 1.0
+    total = sum(2 * (-1) ** (k - 1) * math.exp(-2 * k * k * lam * lam) for k in range(1, 101))
+    return min(1.0, max(0.0, total))
+
+
+def chi_square_test(observed: Dict[str, int], expected_props: Dict[str, float]) -> Dict:
+    """Chi-square goodness of fit, pooling categories with expected count < 5"""
+    total_props = sum(expected_props.values())
+    n = sum(observed.get(k, 0) for k in expected_props)
+    if n == 0:
+        return {'n': 0, 'statistic': None, 'dof': 0, 'p_value': None}
+
+    cells = []
+    pooled_obs, pooled_exp = 0, 0.0
+    for category, prop in expected_props.items():
+        exp = n * prop / total_props
+        obs = observed.get(category, 0)
+        if exp < 5:
+            pooled_obs += obs
+            pooled_exp += exp
+        else:
+            cells.append([obs, exp])
+    if pooled_exp >= 5 or not cells:
+        cells.append([pooled_obs, pooled_exp])
+    elif pooled_exp > 0:
+        cells[-1][0] += pooled_obs
+        cells[-1][1] += pooled_exp
+
+    statistic = sum((obs - exp) ** 2 / exp for obs, exp in cells if exp > 0)
+    dof = len(cells) - 1
+    return {
+        'n': n,
+        'statistic': statistic,
+        'dof': dof,
+        'p_value': chi2_sf(statistic, dof) if dof > 0 else None
+    }
+
+
+class StreamingHistogram:
+    """Fixed-bin histogram with under/overflow counts"""
+
+    def __init__(self, low: float, high: float, bins: int = HISTOGRAM_BINS):
+        self.edges = np.linspace(low, high, bins + 1)
+        self.counts = np.zeros(bins + 2, dtype=np.int64)  # [underflow, bins..., overflow]
+
+    def add(self, value: float):
+        self.counts[np.searchsorted(self.edges, value, side='right')] += 1
+
+    @property
+    def n(self) -> int:
+        return int(self.counts.sum())
+
+    def ks_statistic(self, cdf) -> float:
+        """KS distance between the binned empirical CDF and a target CDF"""
+        n = self.n
+        if n == 0:
+            return 0.0
+        empirical = np.cumsum(self.counts)[:-1] / n  # F_n at each edge
+        return float(np.max(np.abs(empirical - cdf(self.edges))))
+
+
+def _is_generated(resource: Dict) -> bool:
+    return any(tag.get('code') == GENERATED_TAG['code'] and tag.get('system') == GENERATED_TAG['system']
+               for tag in resource.get('meta', {}).get('tag', []))
+
+
+def _hiv_encounters(entries: List[Dict]) -> Set[str]:
+    """References to the encounters of the all-in-one HIV module (reason: HIV infection)"""
+    references = set()
+    for entry in entries:
+        resource = entry.get('resource', {})
+        if resource.get('resourceType') != 'Encounter':
+            continue
+        if any(coding.get('code') == HIV_CONDITION_CODE['code']
+               for reason in resource.get('reasonCode', []) for coding in reason.get('coding', [])):
+            references.add(f"Encounter/{resource.get('id')}")
+            references.add(f"urn:uuid:{resource.get('id')}")
+            if entry.get('fullUrl'):
+                references.add(entry['fullUrl'])
+    return references
+
+
+def _qualitative_value(resource: Dict) -> Optional[str]:
+    """Result label of a qualitative lab (post-processor valueString or module SNOMED code)"""
+    if 'valueString' in resource:
+        return resource['valueString']
+    for coding in resource.get('valueCodeableConcept', {}).get('coding', []):
+        if coding.get('code') in QUALITATIVE_RESULT_LABELS:
+            return QUALITATIVE_RESULT_LABELS[coding['code']]
+    return None
+
+
+class DistributionChecker:
+    """Single-pass, constant-memory conformance check of a processed corpus"""
+
+    def __init__(self,
+                 corpus_dir: str,
+                 adap_percentage: float = 0.5,
+                 alpha: float = 0.01,
+                 reference_date: date = None):
+        self.corpus_dir = Path(corpus_dir)
+        self.adap_percentage = adap_percentage
+        self.alpha = alpha
+        self.reference_date = reference_date or date.today()
+
+        self.qualitative_tests = {
+            info['loinc']: (name, info)
+            for name, info in list(COMPLETE_HIV_LABS.items()) + list(BASELINE_ONLY_TESTS.items())
+            if info.get('result_type') == 'qualitative'
+        }
+        self.quantitative_tests = {
+            info['loinc']: (name, info)
+            for name, info in COMPLETE_HIV_LABS.items()
+            if 'ranges' in info and name not in CONDITIONAL_LABS
+        }
+        self.viral_load_loinc = COMPLETE_HIV_LABS['hiv_viral_load']['loinc']
+
+        self.sex = Counter()
+        self.age = Counter()
+        self.race = Counter()
+        self.adap = Counter()
+        self.viral_load = Counter()
+        self.qualitative = {loinc: Counter() for loinc in self.qualitative_tests}
+        self.histograms = {}
+        for loinc, (name, info) in self.quantitative_tests.items():
+            ranges = list(info['ranges'].values())
+            self.histograms[loinc] = StreamingHistogram(min(r[0] for r in ranges), max(r[1] for r in ranges))
+
+    def _patient_demographics(self, patient: Dict):
+        gender = patient.get('gender')
+        if gender in ('male', 'female'):
+            self.sex['M' if gender == 'male' else 'F'] += 1
+
+        birth_date = patient.get('birthDate')
+        if birth_date:
+            year, month, day = (int(p) for p in (birth_date.split('-') + ['1', '1'])[:3])
+            ref = self.reference_date
+            age = ref.year - year - ((ref.month, ref.day) < (month, day))
+            bucket = age_bucket(age)
+            if bucket:
+                self.age[bucket] += 1
+
+        race = None
+        for extension in patient.get('extension', []):
+            url = extension.get('url', '')
+            for sub in extension.get('extension', []):
+                if sub.get('url') != 'ombCategory':
+                    continue
+                code = sub.get('valueCoding', {}).get('code')
+                if url.endswith('us-core-ethnicity') and code == HISPANIC_ETHNICITY_CODE:
+                    race = 'hispanic'
+                elif url.endswith('us-core-race') and race is None:
+                    race = OMB_RACE_CODES.get(code, 'other')
+        if race:
+            self.race[race] += 1
+
+    def add_bundle(self, bundle: Dict):
+        """Update the streaming counters from one bundle"""
+        patient = None
+        on_art = False
+        entries = bundle.get('entry', [])
+        # Labs of the all-in-one module are untagged; they belong to its HIV encounters
+        hiv_encounters = _hiv_encounters(entries)
+        for entry in entries:
+            resource = entry.get('resource', {})
+            resource_type = resource.get('resourceType')
+            if resource_type == 'Patient':
+                patient = resource
+            elif resource_type in ('MedicationStatement', 'MedicationRequest'):
+                codings = resource.get('medicationCodeableConcept', {}).get('coding', [])
+                on_art = on_art or any(c.get('code') in ART_RXNORM_CODES for c in codings)
+            elif resource_type == 'Observation' and (
+                    _is_generated(resource) or resource.get('encounter', {}).get('reference') in hiv_encounters):
+                codings = resource.get('code', {}).get('coding', [])
+                code = codings[0].get('code') if codings else None
+                if code == self.viral_load_loinc:
+                    value = resource.get('valueQuantity', {}).get('value', 0)
+                    self.viral_load['undetectable' if value < 20 else
+                                    'suppressed' if value < 200 else 'detectable'] += 1
+                elif code in self.qualitative:
+                    self.qualitative[code][_qualitative_value(resource)] += 1
+                elif code in self.histograms:
+                    value = resource.get('valueQuantity', {}).get('value')
+                    if value is not None:
+                        self.histograms[code].add(value)
+
+        if patient is None:
+            return
+        self._patient_demographics(patient)
+        self.adap['adap' if on_art else 'non_adap'] += 1
+
+    def scan(self):
+        """Single streaming pass over the corpus"""
+        for bundle_file in scan_bundle_files(self.corpus_dir, recursive=True, kinds={PATIENT}):
+            with open(bundle_file.path, 'rb') as f:
+                self.add_bundle(json.loads(f.read()))
+        # Patient bundles written into archive shards (OUTPUT_ARCHIVE)
+        for _, data in iter_archives(archive_shards(self.corpus_dir), kinds={PATIENT}):
+            self.add_bundle(json.loads(data))
+
+    def _result(self, name: str, test: str, outcome: Dict) -> Dict:
+        p_value = outcome.get('p_value')
+        outcome.update({
+            'name': name,
+            'test': test,
+            'passed': p_value is None or p_value >= self.alpha
+        })
+        return outcome
+
+    def results(self) -> List[Dict]:
+        """Goodness-of-fit results for every configured target"""
+        results = [
+            self._result('sex', 'chi2', chi_square_test(self.sex, ADAP_DEMOGRAPHICS['sex'])),
+            self._result('age', 'chi2', chi_square_test(self.age, ADAP_DEMOGRAPHICS['age_distribution'])),
+            self._result('race_ethnicity', 'chi2', chi_square_test(self.race, ADAP_DEMOGRAPHICS['race_ethnicity'])),
+            self._result('adap_percentage', 'chi2', chi_square_test(
+                self.adap, {'adap': self.adap_percentage, 'non_adap': 1 - self.adap_percentage})),
+            self._result('viral_load_split', 'chi2', chi_square_test(self.viral_load, VIRAL_LOAD_TARGETS)),
+        ]
+
+        for loinc, (name, info) in self.qualitative_tests.items():
+            values = info['values']
+            weights = info.get('distribution', [1.0 / len(values)] * len(values))
+            results.append(self._result(name, 'chi2', chi_square_test(
+                self.qualitative[loinc], dict(zip(values, weights)))))
+
+        for loinc, (name, info) in self.quantitative_tests.items():
+            histogram = self.histograms[loinc]
+            statistic = histogram.ks_statistic(range_mixture_cdf(list(info['ranges'].values())))
+            results.append(self._result(name, 'ks', {
+                'n': histogram.n,
+                'statistic': statistic,
+                'p_value': ks_sf(statistic, histogram.n) if histogram.n else None
+            }))
+        return results
+
+    def print_report(self, results: List[Dict] = None):
+        """Print the conformance report"""
+        if results is None:
+            results = self.results()
+        print(f"\n📈 Distribution conformance: {self.corpus_dir} (alpha={self.alpha})")
+        for result in results:
+            status = "✅" if result['passed'] else "❌"
+            if result['statistic'] is None:
+                print(f"   ⚪ {result['name']}: no data")
+                continue
+            p_value = f"{result['p_value']:.4f}" if result['p_value'] is not None else "n/a"
+            print(f"   {status} {result['name']}: {result['test']}={result['statistic']:.4f} "
+                  f"p={p_value} (n={result['n']})")
+
+
+def main():
+    """Main execution"""
+    parser = argparse.ArgumentParser(description="Check generated cohort distributions against targets")
+    parser.add_argument('corpus_dir', nargs='?', default=os.getenv('PROCESSED_FHIR_DIR', './processed_fhir'))
+    parser.add_argument('--adap-percentage', type=float, default=0.5)
+    parser.add_argument('--alpha', type=float, default=0.01)
+    parser.add_argument('--json', action='store_true', help="Print results as JSON")
+    args = parser.parse_args()
+
+    checker = DistributionChecker(args.corpus_dir, adap_percentage=args.adap_percentage, alpha=args.alpha)
+    checker.scan()
+    results = checker.results()
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        checker.print_report(results)
+
+
+if __name__ == "__main__":
+    main()
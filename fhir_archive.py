@@ -0,0 +1,178 @@
+"""
+Archive I/O for Bundle Corpora
+Reads bundles straight out of tar/zip archives and writes output into rolling
+archive shards of a configurable size, so a million-patient run does not
+create millions of small files. Archives are read and written sequentially
+(tar as a stream, so .tar.gz works without seeking) and nothing is extracted
+to temporary files.
+
+Shards are named <prefix>-00000.<ext>, <prefix>-00001.<ext>, ... A new shard
+is started when the next member would push the current one past max_bytes.
+In uncompressed tar shards every member's data is stored contiguously, so the
+byte offset of a bundle inside the shard is recorded and the content/SQLite
+indexes can point into the shard directly.
+"""
+
+import io
+import os
+import tarfile
+import threading
+import zipfile
+from pathlib import Path
+from typing import Iterator, List, Optional, Set, Tuple, Union
+
+from fhir_files import BundleFile, classify_bundle_name, scan_bundle_files
+
+ARCHIVE_FORMATS = ('tar', 'tar.gz', 'zip')
+_SUFFIXES = (('.tar.gz', 'tar.gz'), ('.tgz', 'tar.gz'), ('.tar', 'tar'), ('.zip', 'zip'))
+
+
+def archive_format(path: Union[str, Path]) -> Optional[str]:
+    """'tar', 'tar.gz' or 'zip' from an archive file name (None for anything else)"""
+    name = str(path).lower()
+    return next((fmt for suffix, fmt in _SUFFIXES if name.endswith(suffix)), None)
+
+
+def find_archives(path: Union[str, Path]) -> List[Path]:
+    """Archives to read for an input path
+
+    An archive file is read on its own. A directory is read as archives when
+    it holds archives and no loose bundle files.
+    """
+    path = Path(path)
+    if path.is_file():
+        return [path] if archive_format(path) else []
+    if not path.is_dir() or next(scan_bundle_files(path), None) is not None:
+        return []
+    return sorted(entry for entry in path.iterdir() if entry.is_file() and archive_format(entry))
+
+
+def archive_shards(corpus_dir: Union[str, Path]) -> List[Path]:
+    """Archive shards directly inside a corpus directory
+
+    Unlike find_archives, loose bundles may sit beside them: archive output
+    keeps the hospital/practitioner bundles as plain files.
+    """
+    corpus_dir = Path(corpus_dir)
+    if not corpus_dir.is_dir():
+        return []
+    return sorted(entry for entry in corpus_dir.iterdir() if entry.is_file() and archive_format(entry))
+
+
+def reject_archives(corpus_dir: Union[str, Path], tool: str):
+    """Fail loudly for tools that rewrite or copy bundle files one by one"""
+    shards = archive_shards(corpus_dir)
+    if shards:
+        raise ValueError(f"{corpus_dir} holds {len(shards)} archive shard(s) ({shards[0].name}, ...); "
+                         f"{tool} needs loose bundle files, so unpack the shards first")
+
+
+def iter_archive(path: Path,
+                 kinds: Set[str] = None,
+                 suffix: str = '.json',
+                 read: bool = True) -> Iterator[Tuple[BundleFile, Optional[bytes]]]:
+    """(bundle file, bytes) of each bundle member, in archive order (bytes None if not read)"""
+    fmt = archive_format(path)
+    if fmt == 'zip':
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                name = os.path.basename(info.filename)
+                if info.is_dir() or not name.endswith(suffix) or name.startswith('.'):
+                    continue
+                kind = classify_bundle_name(name)
+                if kinds is None or kind in kinds:
+                    yield BundleFile(os.path.join(str(path), info.filename), name, kind, info.file_size), \
+                        archive.read(info) if read else None
+        return
+    with tarfile.open(path, mode='r|*') as archive:
+        for member in archive:
+            name = os.path.basename(member.name)
+            if not member.isfile() or not name.endswith(suffix) or name.startswith('.'):
+                continue
+            kind = classify_bundle_name(name)
+            if kinds is None or kind in kinds:
+                yield BundleFile(os.path.join(str(path), member.name), name, kind, member.size), \
+                    archive.extractfile(member).read() if read else None
+
+
+def iter_archives(paths: List[Path], kinds: Set[str] = None, read: bool = True) -> Iterator[Tuple[BundleFile, Optional[bytes]]]:
+    for path in paths:
+        yield from iter_archive(path, kinds, read=read)
+
+
+class ArchiveShardWriter:
+    """Append members to rolling archive shards (thread-safe, sequential)"""
+
+    def __init__(self,
+                 output_dir: Union[str, Path],
+                 prefix: str = 'bundles',
+                 archive_format: str = 'tar',
+                 max_bytes: int = 1 << 30):
+        if archive_format not in ARCHIVE_FORMATS:
+            raise ValueError(f"Unknown archive format: {archive_format}")
+        self.output_dir = Path(output_dir)
+        self.prefix = prefix
+        self.archive_format = archive_format
+        self.max_bytes = max_bytes
+        self.shards: List[Path] = []
+        self._archive = None
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _open_next(self):
+        self._close_current()
+        path = self.output_dir / f"{self.prefix}-{len(self.shards):05d}.{self.archive_format}"
+        if self.archive_format == 'zip':
+            self._archive = zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED)
+        else:
+            self._archive = tarfile.open(path, 'w:gz' if self.archive_format == 'tar.gz' else 'w')
+        self.shards.append(path)
+        self._size = 0
+
+    def _close_current(self):
+        if self._archive is not None:
+            self._archive.close()
+            self._archive = None
+
+    def write(self, name: str, data: bytes) -> Tuple[str, Optional[int]]:
+        """Add a member; returns (shard file name, offset of its data in the shard)
+
+        The offset is None for compressed formats, where it is not a file position.
+        """
+        with self._lock:
+            if self._archive is None or (self._size and self._size + len(data) > self.max_bytes):
+                self._open_next()
+            self._size += len(data)
+            shard = self.shards[-1].name
+            if self.archive_format == 'zip':
+                self._archive.writestr(name, data)
+                return shard, None
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            start = self._archive.offset
+            header = info.tobuf(self._archive.format, self._archive.encoding, self._archive.errors)
+            self._archive.addfile(info, io.BytesIO(data))
+            return shard, (start + len(header) if self.archive_format == 'tar' else None)
+
+    def close(self):
+        with self._lock:
+            self._close_current()
+
+
+def pack_directory(source_dir: Union[str, Path],
+                   output_dir: Union[str, Path],
+                   prefix: str = 'bundles',
+                   archive_format: str = 'tar',
+                   max_bytes: int = 1 << 30,
+                   remove: bool = True) -> List[Path]:
+    """Move a directory's bundle files into archive shards, one file at a time"""
+    writer = ArchiveShardWriter(output_dir, prefix, archive_format, max_bytes)
+    try:
+        for bundle_file in scan_bundle_files(source_dir, recursive=True):
+            with open(bundle_file.path, 'rb') as f:
+                writer.write(os.path.relpath(bundle_file.path, source_dir), f.read())
+            if remove:
+                os.unlink(bundle_file.path)
+    finally:
+        writer.close()
+    return writer.shards
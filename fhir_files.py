@@ -0,0 +1,120 @@
+"""
+Bundle File Enumeration and Output Layout Helpers
+Streams Synthea output directories with os.scandir instead of materializing
+glob listings, classifies patient / hospital / practitioner bundles by file
+name alone, and maps patient bundles onto an optional hashed subdirectory
+layout so no single output directory holds millions of files.
+"""
+
+import hashlib
+import os
+from pathlib import Path
+from typing import Iterator, NamedTuple, Optional, Set, Union
+
+# Bundle kinds, classified from Synthea's file naming convention
+PATIENT = 'patient'
+HOSPITAL = 'hospital'
+PRACTITIONER = 'practitioner'
+
+OUTPUT_LAYOUTS = ('flat', 'sharded')
+
+# Sidecar patches (post-processor OUTPUT_MODE=sidecar) refer to their base bundle
+PATCH_SUFFIX = '.patch.json'
+SHARD_LEVELS = 2
+SHARD_WIDTH = 2
+HEX_DIGITS = frozenset('0123456789abcdef')
+
+
+class BundleFile(NamedTuple):
+    """A bundle file found by a directory scan"""
+    path: str
+    name: str
+    kind: str
+    size: Optional[int] = None
+
+
+def classify_bundle_name(name: str) -> str:
+    """Classify a Synthea bundle from its file name without opening it"""
+    if name.startswith('hospitalInformation'):
+        return HOSPITAL
+    if name.startswith('practitionerInformation'):
+        return PRACTITIONER
+    return PATIENT
+
+
+def scan_bundle_files(directory: Union[str, Path],
+                      recursive: bool = False,
+                      kinds: Set[str] = None,
+                      with_size: bool = False,
+                      suffix: str = '.json') -> Iterator[BundleFile]:
+    """Lazily yield bundle files in a directory
+
+    With recursive=True only hashed shard subdirectories (see shard_prefix)
+    are descended, so e.g. Synthea's raw 'fhir' folder inside an output
+    directory is not picked up as processed output.
+    """
+    stack = [str(directory)]
+    while stack:
+        current = stack.pop()
+        try:
+            scanner = os.scandir(current)
+        except FileNotFoundError:
+            continue
+        with scanner:
+            for entry in scanner:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive and is_shard_dir(entry.name):
+                        stack.append(entry.path)
+                    continue
+                if not entry.name.endswith(suffix):
+                    continue
+                kind = classify_bundle_name(entry.name)
+                if kinds is not None and kind not in kinds:
+                    continue
+                size = entry.stat().st_size if with_size else None
+                yield BundleFile(entry.path, entry.name, kind, size)
+
+
+def is_shard_dir(name: str) -> bool:
+    """True for a hashed shard subdirectory name such as 'ab'"""
+    return len(name) == SHARD_WIDTH and all(c in HEX_DIGITS for c in name)
+
+
+def patient_id_from_name(name: str) -> str:
+    """Extract the patient id from a Synthea file name (Given_Family_<uuid>.json)"""
+    stem = name.rsplit('.', 1)[0]
+    return stem.rsplit('_', 1)[-1]
+
+
+def shard_prefix(name: str, levels: int = SHARD_LEVELS, width: int = SHARD_WIDTH) -> Path:
+    """Hashed subdirectory for a bundle, e.g. 'ab/cd' for a two-level fan-out"""
+    key = patient_id_from_name(name).replace('-', '').lower()
+    if len(key) < levels * width or any(c not in HEX_DIGITS for c in key[:levels * width]):
+        # Not a uuid-style name; fall back to a hash so fan-out stays uniform
+        key = hashlib.md5(name.encode('utf-8')).hexdigest()
+    return Path(*(key[i * width:(i + 1) * width] for i in range(levels)))
+
+
+def output_path_for(output_dir: Path, name: str, layout: str = 'flat', kind: str = None) -> Path:
+    """Output path for a bundle under the given layout
+
+    Hospital and practitioner bundles always stay at the top level so they
+    can be uploaded before the patient bundles that reference them.
+    """
+    if layout not in OUTPUT_LAYOUTS:
+        raise ValueError(f"Unknown output layout: {layout}")
+    kind = kind or classify_bundle_name(name)
+    if layout == 'flat' or kind != PATIENT:
+        return output_dir / name
+    return output_dir / shard_prefix(name) / name
+
+
+def base_bundle_path(base_dir: Union[str, Path], patch_name: str) -> Optional[Path]:
+    """Synthea bundle a sidecar patch applies to, flat or sharded (None if not found)"""
+    name = patch_name[:-len(PATCH_SUFFIX)] + '.json'
+    for path in (Path(base_dir) / name, output_path_for(Path(base_dir), name, 'sharded')):
+        if path.is_file():
+            return path
+    return None
@@ -0,0 +1,392 @@
+"""
+Structural FHIR Validator for Generated Bundles
+Checks processed bundles for the problems a FHIR server would reject on upload:
+missing required elements, malformed valueQuantity / dates / codings and
+dangling urn:uuid references.
+
+Validators are compiled once per resourceType from RESOURCE_RULES, files are
+validated across worker processes, and violations are streamed into a running
+summary so a large corpus can gate every run.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import re
+import sys
+import tarfile
+import zipfile
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from functools import partial
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+from dotenv import load_dotenv
+
+from bundle_schedule import imap_bounded, iter_batches
+from fhir_archive import archive_shards, iter_archive
+from fhir_files import PATCH_SUFFIX, base_bundle_path, scan_bundle_files
+
+load_dotenv()
+
+
+DATE_PATTERN = re.compile(r'^\d{4}(-\d{2}(-\d{2})?)?$')
+DATETIME_PATTERN = re.compile(
+    r'^\d{4}(-\d{2}(-\d{2}(T\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}:\d{2})?)?)?)?$'
+)
+
+# Declarative per-resourceType rules, compiled into check functions below
+RESOURCE_RULES = {
+    'Patient': {
+        'required': ['id'],
+        'codes': {'gender': {'male', 'female', 'other', 'unknown'}},
+        'dates': ['birthDate']
+    },
+    'Encounter': {
+        'required': ['id', 'status', 'subject'],
+        'references': ['subject'],
+        'periods': ['period']
+    },
+    'Observation': {
+        'required': ['id', 'status', 'code', 'subject'],
+        'codes': {'status': {'registered', 'preliminary', 'final', 'amended', 'corrected',
+                             'cancelled', 'entered-in-error', 'unknown'}},
+        'codeable': ['code'],
+        'references': ['subject'],
+        'datetimes': ['effectiveDateTime', 'issued'],
+        'quantities': ['valueQuantity']
+    },
+    'MedicationStatement': {
+        'required': ['id', 'status', 'subject'],
+        'one_of': [('medicationCodeableConcept', 'medicationReference')],
+        'codes': {'status': {'active', 'completed', 'entered-in-error', 'intended', 'stopped',
+                             'on-hold', 'unknown', 'not-taken'}},
+        'codeable': ['medicationCodeableConcept'],
+        'references': ['subject'],
+        'datetimes': ['dateAsserted'],
+        'periods': ['effectivePeriod']
+    },
+    'MedicationRequest': {
+        'required': ['id', 'status', 'intent', 'subject'],
+        'references': ['subject']
+    },
+    'Condition': {
+        'required': ['id', 'subject', 'code'],
+        'codeable': ['code'],
+        'references': ['subject']
+    }
+}
+
+Violation = Tuple[str, str, str]  # (rule, resourceType, message)
+Check = Callable[[Dict], Iterator[Violation]]
+
+
+def _required_check(resource_type: str, field: str) -> Check:
+    def check(resource):
+        if resource.get(field) in (None, '', [], {}):
+            yield ('missing_required', resource_type, f"missing '{field}'")
+    return check
+
+
+def _one_of_check(resource_type: str, fields: Tuple[str, ...]) -> Check:
+    def check(resource):
+        if not any(field in resource for field in fields):
+            yield ('missing_required', resource_type, f"missing one of {'/'.join(fields)}")
+    return check
+
+
+def _code_check(resource_type: str, field: str, allowed: set) -> Check:
+    def check(resource):
+        value = resource.get(field)
+        if value is not None and value not in allowed:
+            yield ('invalid_code', resource_type, f"'{field}' has invalid value {value!r}")
+    return check
+
+
+def _codeable_check(resource_type: str, field: str) -> Check:
+    def check(resource):
+        concept = resource.get(field)
+        if concept is None:
+            return
+        codings = concept.get('coding') if isinstance(concept, dict) else None
+        if not codings:
+            yield ('invalid_coding', resource_type, f"'{field}' has no coding")
+            return
+        for coding in codings:
+            if not coding.get('system') or not coding.get('code'):
+                yield ('invalid_coding', resource_type, f"'{field}' coding lacks system/code")
+    return check
+
+
+def _reference_check(resource_type: str, field: str) -> Check:
+    def check(resource):
+        ref = resource.get(field)
+        if ref is not None and not (isinstance(ref, dict) and isinstance(ref.get('reference'), str)):
+            yield ('invalid_reference', resource_type, f"'{field}' is not a Reference")
+    return check
+
+
+def _date_check(resource_type: str, field: str, pattern: re.Pattern) -> Check:
+    def check(resource):
+        value = resource.get(field)
+        if value is not None and not (isinstance(value, str) and pattern.match(value)):
+            yield ('invalid_date', resource_type, f"'{field}' is not a valid date: {value!r}")
+    return check
+
+
+def _period_check(resource_type: str, field: str) -> Check:
+    def check(resource):
+        period = resource.get(field)
+        if period is None:
+            return
+        if not isinstance(period, dict) or 'start' not in period:
+            yield ('invalid_period', resource_type, f"'{field}' has no start")
+            return
+        for key in ('start', 'end'):
+            value = period.get(key)
+            if value is not None and not (isinstance(value, str) and DATETIME_PATTERN.match(value)):
+                yield ('invalid_date', resource_type, f"'{field}.{key}' is not a valid dateTime: {value!r}")
+    return check
+
+
+def _quantity_check(resource_type: str, field: str) -> Check:
+    def check(resource):
+        quantity = resource.get(field)
+        if quantity is None:
+            return
+        value = quantity.get('value') if isinstance(quantity, dict) else None
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value != value:
+            yield ('invalid_quantity', resource_type, f"'{field}.value' is not numeric: {value!r}")
+        elif quantity.get('system') and not quantity.get('code'):
+            yield ('invalid_quantity', resource_type, f"'{field}' has system but no code")
+    return check
+
+
+def compile_validators(rules: Dict = RESOURCE_RULES) -> Dict[str, List[Check]]:
+    """Compile the declarative rules into a list of checks per resourceType"""
+    validators = {}
+    for resource_type, spec in rules.items():
+        checks = [_required_check(resource_type, f) for f in spec.get('required', [])]
+        checks += [_one_of_check(resource_type, f) for f in spec.get('one_of', [])]
+        checks += [_code_check(resource_type, f, allowed) for f, allowed in spec.get('codes', {}).items()]
+        checks += [_codeable_check(resource_type, f) for f in spec.get('codeable', [])]
+        checks += [_reference_check(resource_type, f) for f in spec.get('references', [])]
+        checks += [_date_check(resource_type, f, DATE_PATTERN) for f in spec.get('dates', [])]
+        checks += [_date_check(resource_type, f, DATETIME_PATTERN) for f in spec.get('datetimes', [])]
+        checks += [_period_check(resource_type, f) for f in spec.get('periods', [])]
+        checks += [_quantity_check(resource_type, f) for f in spec.get('quantities', [])]
+        validators[resource_type] = checks
+    return validators
+
+
+VALIDATORS = compile_validators()
+
+
+def iter_references(node) -> Iterator[str]:
+    """Yield every Reference.reference string in a resource"""
+    stack = [node]
+    while stack:
+        current = stack.pop()
+        if isinstance(current, dict):
+            for key, value in current.items():
+                if key == 'reference' and isinstance(value, str):
+                    yield value
+                elif isinstance(value, (dict, list)):
+                    stack.append(value)
+        elif isinstance(current, list):
+            stack.extend(current)
+
+
+def validate_bundle(bundle: Dict, external_ids: Optional[Set[str]] = frozenset()) -> List[Violation]:
+    """Validate bundle structure, each resource and internal references
+    
+    Relative references may also point at external_ids (Type/id); None
+    leaves relative references to resources outside the bundle unchecked.
+    """
+    violations = []
+    if bundle.get('resourceType') != 'Bundle':
+        return [('invalid_bundle', 'Bundle', "not a Bundle")]
+
+    entries = bundle.get('entry', [])
+    full_urls = set()
+    local_ids = set()
+    for entry in entries:
+        resource = entry.get('resource')
+        full_url = entry.get('fullUrl')
+        if full_url:
+            if full_url in full_urls:
+                violations.append(('duplicate_fullurl', 'Bundle', f"duplicate fullUrl {full_url}"))
+            full_urls.add(full_url)
+        if isinstance(resource, dict):
+            local_ids.add(f"{resource.get('resourceType')}/{resource.get('id')}")
+
+    for entry in entries:
+        resource = entry.get('resource')
+        if not isinstance(resource, dict) or 'resourceType' not in resource:
+            violations.append(('invalid_entry', 'Bundle', "entry without resource/resourceType"))
+            continue
+        resource_type = resource['resourceType']
+        for check in VALIDATORS.get(resource_type, ()):
+            violations.extend(check(resource))
+
+        for ref in iter_references(resource):
+            if ref.startswith('urn:uuid:'):
+                if ref not in full_urls:
+                    violations.append(('dangling_reference', resource_type, f"unresolved {ref}"))
+            elif external_ids is not None and '?' not in ref and ref.count('/') == 1 \
+                    and ref not in local_ids and ref not in external_ids:
+                # Relative literal reference (Type/id) to a resource not in this bundle
+                violations.append(('dangling_reference', resource_type, f"unresolved {ref}"))
+
+    return violations
+
+
+def base_bundle_ids(base_dir: str, patch_name: str) -> Optional[Set[str]]:
+    """Type/id of every resource in a sidecar's base bundle (None if not found)"""
+    path = base_bundle_path(base_dir, patch_name)
+    if path is None:
+        return None
+    with open(path, 'rb') as f:
+        bundle = json.loads(f.read())
+    return {
+        f"{entry['resource'].get('resourceType')}/{entry['resource'].get('id')}"
+        for entry in bundle.get('entry', []) if isinstance(entry.get('resource'), dict)
+    }
+
+
+def validate_file(bundle_path: str, base_dir: str = None) -> Tuple[str, List[Violation]]:
+    """Worker entry point: validate a single bundle file
+    
+    A sidecar's relative references are resolved against its base bundle in
+    base_dir; without base_dir they are not checked.
+    """
+    try:
+        with open(bundle_path, 'rb') as f:
+            data = f.read()
+    except OSError as e:
+        return bundle_path, [('unreadable', 'Bundle', str(e))]
+    return validate_data(bundle_path, data, base_dir)
+
+
+def validate_files(bundle_paths: List[str], base_dir: str = None) -> List[Tuple[str, List[Violation]]]:
+    """Worker entry point: validate a batch of bundle files"""
+    return [validate_file(bundle_path, base_dir) for bundle_path in bundle_paths]
+
+
+def validate_archive(archive_path: Path, base_dir: str = None) -> List[Tuple[str, List[Violation]]]:
+    """Worker entry point: validate every bundle member of an archive shard"""
+    try:
+        return [validate_data(bundle_file.path, data, base_dir) for bundle_file, data in iter_archive(archive_path)]
+    except (OSError, tarfile.TarError, zipfile.BadZipFile) as e:
+        return [(str(archive_path), [('unreadable', 'Bundle', str(e))])]
+
+
+def validate_data(bundle_path: str, data: bytes, base_dir: str = None) -> Tuple[str, List[Violation]]:
+    """Validate one bundle's bytes (bundle_path names it in the results)"""
+    try:
+        bundle = json.loads(data)
+    except ValueError as e:
+        return bundle_path, [('unreadable', 'Bundle', str(e))]
+    if not bundle_path.endswith(PATCH_SUFFIX):
+        return bundle_path, validate_bundle(bundle)
+    if base_dir is None:
+        return bundle_path, validate_bundle(bundle, external_ids=None)
+    external_ids = base_bundle_ids(base_dir, os.path.basename(bundle_path))
+    if external_ids is None:
+        return bundle_path, [('missing_base_bundle', 'Bundle', f"no base bundle in {base_dir}")]
+    return bundle_path, validate_bundle(bundle, external_ids)
+
+
+class FHIRValidator:
+    """Validate every bundle in a directory across worker processes"""
+
+    def __init__(self, corpus_dir: str, workers: int = None, max_examples: int = 5, base_dir: str = None):
+        self.corpus_dir = Path(corpus_dir)
+        # Synthea bundles that sidecar patches in corpus_dir apply to
+        self.base_dir = base_dir
+        self.workers = workers or os.cpu_count() or 1
+        self.max_examples = max_examples
+
+    def iter_results(self) -> Iterator[Tuple[str, List[Violation]]]:
+        """Stream (path, violations) results as workers finish
+        
+        Bundle files are validated in batches of 32 and archive shards
+        (OUTPUT_ARCHIVE, members named archive/member) one per worker. Only a
+        few batches per worker are submitted at a time.
+        """
+        paths = (f.path for f in scan_bundle_files(self.corpus_dir, recursive=True))
+        validate = partial(validate_files, base_dir=self.base_dir)
+        validate_shard = partial(validate_archive, base_dir=self.base_dir)
+        calls = itertools.chain(((validate, batch) for batch in iter_batches(paths, 32)),
+                                ((validate_shard, archive) for archive in archive_shards(self.corpus_dir)))
+        if self.workers <= 1:
+            for fn, arg in calls:
+                yield from fn(arg)
+            return
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            for results in imap_bounded(pool, calls, self.workers * 4):
+                yield from results
+
+    def validate(self, verbose: bool = True) -> Dict:
+        """Validate the corpus, printing violations as they stream in"""
+        rule_counts = Counter()
+        type_counts = Counter()
+        examples = {}
+        files_checked = 0
+        files_invalid = 0
+
+        for bundle_path, violations in self.iter_results():
+            files_checked += 1
+            if not violations:
+                continue
+            files_invalid += 1
+            for rule, resource_type, message in violations:
+                rule_counts[rule] += 1
+                type_counts[resource_type] += 1
+                if len(examples.setdefault(rule, [])) < self.max_examples:
+                    examples[rule].append(f"{Path(bundle_path).name}: {resource_type} {message}")
+                    if verbose:
+                        print(f"   ❌ [{rule}] {Path(bundle_path).name}: {resource_type} {message}")
+
+        return {
+            'files_checked': files_checked,
+            'files_invalid': files_invalid,
+            'violations': dict(rule_counts),
+            'violations_by_type': dict(type_counts),
+            'examples': examples
+        }
+
+    def print_summary(self, summary: Dict):
+        """Print validation summary"""
+        print(f"\n🔎 Validated {summary['files_checked']} bundles in {self.corpus_dir}")
+        if not summary['violations']:
+            print("   ✅ No structural violations found")
+            return
+        print(f"   Invalid bundles: {summary['files_invalid']}")
+        for rule, count in sorted(summary['violations'].items(), key=lambda kv: -kv[1]):
+            print(f"   {rule}: {count}")
+        for resource_type, count in sorted(summary['violations_by_type'].items(), key=lambda kv: -kv[1]):
+            print(f"      {resource_type}: {count}")
+
+
+def main():
+    """Main execution"""
+    parser = argparse.ArgumentParser(description="Validate structure and references of FHIR bundles")
+    parser.add_argument('corpus_dir', nargs='?', default=os.getenv('PROCESSED_FHIR_DIR', './processed_fhir'))
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--max-examples', type=int, default=5)
+    parser.add_argument('--quiet', action='store_true', help="Only print the final summary")
+    parser.add_argument('--base-dir', default=None,
+                        help="Synthea bundles the sidecar patches apply to (resolves their Patient/Encounter references)")
+    args = parser.parse_args()
+
+    validator = FHIRValidator(args.corpus_dir, workers=args.workers, max_examples=args.max_examples,
+                              base_dir=args.base_dir)
+    summary = validator.validate(verbose=not args.quiet)
+    validator.print_summary(summary)
+    sys.exit(1 if summary['violations'] else 0)
+
+
+if __name__ == "__main__":
+    main()
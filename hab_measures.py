@@ -0,0 +1,287 @@
+"""
+HRSA HAB Performance Measure Engine
+Evaluates core HIV/AIDS Bureau (HAB) performance measures over a processed
+FHIR corpus so every generated dataset can be checked against ADAP targets.
+
+Each bundle is reduced to a fixed-width per-patient feature row (indexed by
+LOINC / RxNorm code), shards of rows are evaluated as NumPy masks, and the
+per-shard numerator/denominator counts are summed in a map-reduce over a
+process pool.
+"""
+
+import argparse
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional
+import numpy as np
+from dotenv import load_dotenv
+
+from bundle_schedule import imap_bounded
+from fhir_archive import archive_shards, iter_archive
+from fhir_files import PATIENT, scan_bundle_files
+from post_processor import COMPLETE_HIV_LABS, HIV_MEDICATIONS
+from medications_and_labs import HIV_MEDICATIONS as HIV_MEDICATION_REFERENCE
+
+load_dotenv()
+
+
+# Per-patient feature columns
+FEATURES = [
+    'hiv_care',          # any HIV viral load result or ART prescription
+    'has_vl',            # at least one HIV viral load result
+    'vl_last',           # most recent viral load (NaN if none)
+    'on_art',            # active antiretroviral MedicationStatement/MedicationRequest
+    'hcv_screen',        # HCV antibody or RNA result
+    'hbv_screen',        # HBsAg, anti-HBs or anti-HBc result
+    'syphilis_screen',   # RPR result
+    'lipid_screen',      # any lipid panel component
+    'male',
+    'female'
+]
+COL = {name: i for i, name in enumerate(FEATURES)}
+
+# LOINC code -> screening feature
+LOINC_FEATURES = {
+    COMPLETE_HIV_LABS['hep_c_antibody']['loinc']: 'hcv_screen',
+    COMPLETE_HIV_LABS['hep_c_rna']['loinc']: 'hcv_screen',
+    COMPLETE_HIV_LABS['hep_b_surface_ag']['loinc']: 'hbv_screen',
+    COMPLETE_HIV_LABS['hep_b_surface_ab']['loinc']: 'hbv_screen',
+    COMPLETE_HIV_LABS['hep_b_core_ab']['loinc']: 'hbv_screen',
+    COMPLETE_HIV_LABS['syphilis_rpr']['loinc']: 'syphilis_screen',
+    COMPLETE_HIV_LABS['cholesterol_total']['loinc']: 'lipid_screen',
+    COMPLETE_HIV_LABS['hdl']['loinc']: 'lipid_screen',
+    COMPLETE_HIV_LABS['ldl']['loinc']: 'lipid_screen',
+    COMPLETE_HIV_LABS['triglycerides']['loinc']: 'lipid_screen',
+}
+VIRAL_LOAD_LOINC = COMPLETE_HIV_LABS['hiv_viral_load']['loinc']
+
+# All antiretroviral RxNorm codes known to the generator and the reference catalog
+ART_RXNORM_CODES = frozenset(HIV_MEDICATIONS.values()) | frozenset(
+    med['rxnorm'] for med in HIV_MEDICATION_REFERENCE.values()
+)
+
+# DHHS / HAB viral suppression threshold
+VIRAL_SUPPRESSION_THRESHOLD = 200
+
+# Measure name -> (denominator column, numerator function over the feature matrix)
+MEASURES = {
+    'viral_suppression': ('has_vl', lambda m: m[:, COL['vl_last']] < VIRAL_SUPPRESSION_THRESHOLD),
+    'art_prescription': ('hiv_care', lambda m: m[:, COL['on_art']] > 0),
+    'hcv_screening': ('hiv_care', lambda m: m[:, COL['hcv_screen']] > 0),
+    'hbv_screening': ('hiv_care', lambda m: m[:, COL['hbv_screen']] > 0),
+    'syphilis_screening': ('hiv_care', lambda m: m[:, COL['syphilis_screen']] > 0),
+    'lipid_screening': ('on_art', lambda m: m[:, COL['lipid_screen']] > 0),
+}
+
+# Expected rates implied by the post-processor configuration (85% undetectable
+# + 10% suppressed; every ADAP patient gets ART and the complete lab panel)
+ADAP_TARGETS = {
+    'viral_suppression': 0.95,
+    'art_prescription': 1.0,
+    'hcv_screening': 1.0,
+    'hbv_screening': 1.0,
+    'syphilis_screening': 1.0,
+    'lipid_screening': 1.0,
+}
+
+STRATA = ['all', 'male', 'female']
+
+
+def extract_patient_features(bundle: Dict) -> Optional[np.ndarray]:
+    """Reduce a patient bundle to a single feature row (None if no Patient)"""
+    row = np.zeros(len(FEATURES))
+    row[COL['vl_last']] = np.nan
+    vl_date = ''
+    has_patient = False
+
+    for entry in bundle.get('entry', []):
+        resource = entry.get('resource', {})
+        resource_type = resource.get('resourceType')
+
+        if resource_type == 'Observation':
+            for coding in resource.get('code', {}).get('coding', []):
+                code = coding.get('code')
+                if code == VIRAL_LOAD_LOINC:
+                    row[COL['has_vl']] = 1
+                    date = resource.get('effectiveDateTime', '')
+                    value = resource.get('valueQuantity', {}).get('value')
+                    if value is not None and date >= vl_date:
+                        vl_date = date
+                        row[COL['vl_last']] = value
+                elif code in LOINC_FEATURES:
+                    row[COL[LOINC_FEATURES[code]]] = 1
+
+        elif resource_type in ('MedicationStatement', 'MedicationRequest'):
+            # MedicationRequest: ART ordered by the all-in-one Synthea module
+            if resource.get('status') not in ('active', 'completed', None):
+                continue
+            for coding in resource.get('medicationCodeableConcept', {}).get('coding', []):
+                if coding.get('code') in ART_RXNORM_CODES:
+                    row[COL['on_art']] = 1
+
+        elif resource_type == 'Patient':
+            has_patient = True
+            gender = resource.get('gender')
+            if gender == 'male':
+                row[COL['male']] = 1
+            elif gender == 'female':
+                row[COL['female']] = 1
+
+    if not has_patient:
+        return None
+
+    row[COL['hiv_care']] = 1 if (row[COL['has_vl']] or row[COL['on_art']]) else 0
+    return row
+
+
+def evaluate_measures(matrix: np.ndarray) -> np.ndarray:
+    """Vectorized numerator/denominator counts, shape (strata, measures, 2)"""
+    counts = np.zeros((len(STRATA), len(MEASURES), 2), dtype=np.int64)
+    if matrix.size == 0:
+        return counts
+
+    stratum_masks = [
+        np.ones(len(matrix), dtype=bool),
+        matrix[:, COL['male']] > 0,
+        matrix[:, COL['female']] > 0
+    ]
+    for j, (denominator_col, numerator_fn) in enumerate(MEASURES.values()):
+        denominator = matrix[:, COL[denominator_col]] > 0
+        numerator = denominator & numerator_fn(matrix)
+        for i, stratum in enumerate(stratum_masks):
+            counts[i, j, 0] = np.count_nonzero(numerator & stratum)
+            counts[i, j, 1] = np.count_nonzero(denominator & stratum)
+    return counts
+
+
+def evaluate_shard(bundle_paths: List[str]) -> np.ndarray:
+    """Map step: extract features for a shard of bundle files and count"""
+    rows = []
+    for bundle_path in bundle_paths:
+        with open(bundle_path, 'rb') as f:
+            row = extract_patient_features(json.loads(f.read()))
+        if row is not None:
+            rows.append(row)
+    matrix = np.vstack(rows) if rows else np.empty((0, len(FEATURES)))
+    return evaluate_measures(matrix)
+
+
+def evaluate_archive(archive_path: Path) -> np.ndarray:
+    """Map step: extract features for the patient bundles of one archive shard and count"""
+    rows = []
+    for _, data in iter_archive(archive_path, kinds={PATIENT}):
+        row = extract_patient_features(json.loads(data))
+        if row is not None:
+            rows.append(row)
+    matrix = np.vstack(rows) if rows else np.empty((0, len(FEATURES)))
+    return evaluate_measures(matrix)
+
+
+def iter_shards(paths: Iterable[str], shard_size: int) -> Iterator[List[str]]:
+    """Group bundle paths into fixed-size shards"""
+    shard = []
+    for path in paths:
+        shard.append(path)
+        if len(shard) >= shard_size:
+            yield shard
+            shard = []
+    if shard:
+        yield shard
+
+
+class HABMeasureEngine:
+    """Compute HRSA HAB performance measures over a processed FHIR corpus"""
+
+    def __init__(self,
+                 corpus_dir: str,
+                 workers: int = None,
+                 shard_size: int = 256,
+                 tolerance: float = 0.02):
+        self.corpus_dir = Path(corpus_dir)
+        self.workers = workers or os.cpu_count() or 1
+        self.shard_size = shard_size
+        self.tolerance = tolerance
+
+    def compute(self) -> np.ndarray:
+        """Map-reduce the measure counts over all bundle shards
+
+        Archive shards (OUTPUT_ARCHIVE) are read whole by one worker each.
+        Both kinds of shard go through one window of a few shards per
+        worker, so the shard stream is never submitted all at once.
+        """
+        bundle_paths = (f.path for f in scan_bundle_files(self.corpus_dir, recursive=True, kinds={PATIENT}))
+        calls = itertools.chain(((evaluate_shard, shard) for shard in iter_shards(bundle_paths, self.shard_size)),
+                                ((evaluate_archive, archive) for archive in archive_shards(self.corpus_dir)))
+        totals = np.zeros((len(STRATA), len(MEASURES), 2), dtype=np.int64)
+
+        if self.workers <= 1:
+            for fn, arg in calls:
+                totals += fn(arg)
+            return totals
+
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            for counts in imap_bounded(pool, calls, self.workers * 4):
+                totals += counts
+        return totals
+
+    def report(self) -> Dict:
+        """Build the measure report, comparing overall rates to ADAP targets"""
+        totals = self.compute()
+        report = {}
+        for j, measure in enumerate(MEASURES):
+            measure_report = {}
+            for i, stratum in enumerate(STRATA):
+                numerator, denominator = (int(v) for v in totals[i, j])
+                measure_report[stratum] = {
+                    'numerator': numerator,
+                    'denominator': denominator,
+                    'rate': numerator / denominator if denominator else None
+                }
+            rate = measure_report['all']['rate']
+            target = ADAP_TARGETS[measure]
+            measure_report['target'] = target
+            measure_report['meets_target'] = rate is not None and rate >= target - self.tolerance
+            report[measure] = measure_report
+        return report
+
+    def print_report(self, report: Dict = None):
+        """Print a human-readable measure report"""
+        if report is None:
+            report = self.report()
+
+        print(f"\n📊 HRSA HAB Performance Measures: {self.corpus_dir}")
+        for measure, result in report.items():
+            overall = result['all']
+            rate = f"{overall['rate']*100:.1f}%" if overall['rate'] is not None else "n/a"
+            status = "✅" if result['meets_target'] else "❌"
+            print(f"   {status} {measure}: {overall['numerator']}/{overall['denominator']} "
+                  f"({rate}, target {result['target']*100:.0f}%)")
+            for stratum in STRATA[1:]:
+                stratum_result = result[stratum]
+                if stratum_result['denominator']:
+                    print(f"      {stratum}: {stratum_result['numerator']}/{stratum_result['denominator']} "
+                          f"({stratum_result['rate']*100:.1f}%)")
+
+
+def main():
+    """Main execution"""
+    parser = argparse.ArgumentParser(description="Compute HRSA HAB measures over processed FHIR bundles")
+    parser.add_argument('corpus_dir', nargs='?', default=os.getenv('PROCESSED_FHIR_DIR', './processed_fhir'))
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--shard-size', type=int, default=256)
+    parser.add_argument('--json', action='store_true', help="Print the report as JSON")
+    args = parser.parse_args()
+
+    engine = HABMeasureEngine(args.corpus_dir, workers=args.workers, shard_size=args.shard_size)
+    report = engine.report()
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        engine.print_report(report)
+
+
+if __name__ == "__main__":
+    main()
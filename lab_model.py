@@ -0,0 +1,175 @@
+"""
+Clinically Correlated Lab Model
+Samples the quantitative tests in COMPLETE_HIV_LABS jointly instead of
+independently, using a Gaussian copula: correlated standard normals are drawn
+for a whole batch of patients, mapped to uniforms and pushed through
+precomputed inverse-CDF lookup tables of each test's marginal (the same
+equal-weight mixture of ranges the independent draws used).
+
+LDL is derived with the Friedewald equation from total cholesterol, HDL and
+triglycerides, and eGFR with the 2021 CKD-EPI creatinine equation, so the
+panel is internally consistent.
+"""
+
+from typing import Dict, List, Tuple
+import numpy as np
+
+
+# Pairwise correlations between latent normals of the copula
+LAB_CORRELATIONS = {
+    ('cd4_count', 'cd4_percent'): 0.80,
+    ('alt', 'ast'): 0.75,
+    ('cholesterol_total', 'triglycerides'): 0.40,
+    ('cholesterol_total', 'hdl'): 0.20,
+    ('hdl', 'triglycerides'): -0.40,
+    ('triglycerides', 'glucose_fasting'): 0.30,
+}
+
+# Tests computed from other tests rather than sampled from their own ranges
+DERIVED_LABS = {'ldl', 'egfr'}
+
+# Tests sampled outside the copula (viral load status drives them separately)
+INDEPENDENT_LABS = {'hiv_viral_load', 'hep_c_rna'}
+
+TABLE_SIZE = 2048
+
+
+def normal_cdf(z: np.ndarray) -> np.ndarray:
+    """Standard normal CDF (Abramowitz-Stegun 7.1.26 erf, |error| < 1.5e-7)"""
+    x = np.abs(z) / np.sqrt(2.0)
+    t = 1.0 / (1.0 + 0.3275911 * x)
+    poly = t * (0.254829592 + t * (-0.284496736 + t * (1.421413741 + t * (-1.453152027 + t * 1.061405429))))
+    erf = 1.0 - poly * np.exp(-x * x)
+    return 0.5 * (1.0 + np.sign(z) * erf)
+
+
+def range_mixture_cdf(ranges: List[Tuple[float, float]]):
+    """CDF of an equal-weight mixture of uniform distributions over ranges"""
+    lows = np.array([r[0] for r in ranges], dtype=float)
+    highs = np.array([r[1] for r in ranges], dtype=float)
+
+    def cdf(x):
+        x = np.asarray(x, dtype=float)[..., None]
+        return np.clip((x - lows) / (highs - lows), 0, 1).mean(axis=-1)
+    return cdf
+
+
+def inverse_cdf_table(ranges: List[Tuple[float, float]], table_size: int = TABLE_SIZE) -> np.ndarray:
+    """Tabulate the quantile function of a range mixture on a uniform grid"""
+    low = min(r[0] for r in ranges)
+    high = max(r[1] for r in ranges)
+    x = np.linspace(low, high, table_size * 8)
+    return np.interp(np.linspace(0, 1, table_size), range_mixture_cdf(ranges)(x), x)
+
+
+def friedewald_ldl(total: np.ndarray, hdl: np.ndarray, triglycerides: np.ndarray) -> np.ndarray:
+    """Calculated LDL (mg/dL) = TC - HDL - TG/5"""
+    return np.maximum(total - hdl - triglycerides / 5.0, 10.0)
+
+
+def ckd_epi_egfr(creatinine: np.ndarray, age: np.ndarray, female: np.ndarray) -> np.ndarray:
+    """2021 race-free CKD-EPI creatinine equation (mL/min/1.73m2)"""
+    kappa = np.where(female, 0.7, 0.9)
+    alpha = np.where(female, -0.241, -0.302)
+    ratio = creatinine / kappa
+    egfr = (142.0 * np.minimum(ratio, 1.0) ** alpha * np.maximum(ratio, 1.0) ** -1.200
+            * 0.9938 ** age)
+    return egfr * np.where(female, 1.012, 1.0)
+
+
+class CorrelatedLabModel:
+    """Gaussian-copula sampler for the quantitative lab panel"""
+
+    def __init__(self,
+                 labs: Dict,
+                 correlations: Dict = LAB_CORRELATIONS,
+                 batch_size: int = 4096,
+                 seed: int = None,
+                 table_size: int = TABLE_SIZE):
+        self.rng = np.random.default_rng(seed)
+        self.batch_size = batch_size
+
+        # Sampled tests, in copula dimension order
+        self.tests = [
+            name for name, info in labs.items()
+            if 'ranges' in info and name not in DERIVED_LABS | INDEPENDENT_LABS
+        ]
+        index = {name: i for i, name in enumerate(self.tests)}
+
+        corr = np.eye(len(self.tests))
+        for (a, b), rho in correlations.items():
+            if a in index and b in index:
+                corr[index[a], index[b]] = corr[index[b], index[a]] = rho
+        self.cholesky = np.linalg.cholesky(corr)
+
+        self.tables = {name: inverse_cdf_table(list(labs[name]['ranges'].values()), table_size)
+                       for name in self.tests}
+        # CD4 is 'normal' when the viral load is undetectable, otherwise either range
+        self.suppressed_tables = {
+            name: inverse_cdf_table([labs[name]['ranges']['normal']], table_size)
+            for name in ('cd4_count', 'cd4_percent') if name in index
+        }
+        self.grid = np.linspace(0, 1, table_size)
+
+        self._batch = None
+        self._suppressed_batch = None
+        self._position = 0
+
+    def _uniforms(self, n: int, rng: np.random.Generator = None) -> np.ndarray:
+        z = (rng or self.rng).standard_normal((n, len(self.tests))) @ self.cholesky.T
+        return normal_cdf(z)
+
+    def sample(self,
+               n: int,
+               undetectable: np.ndarray,
+               age: np.ndarray,
+               female: np.ndarray,
+               rng: np.random.Generator = None) -> Dict[str, np.ndarray]:
+        """Vectorized cohort sample of n panels (including derived LDL/eGFR)"""
+        u = self._uniforms(n, rng)
+        values = {}
+        for i, name in enumerate(self.tests):
+            values[name] = np.interp(u[:, i], self.grid, self.tables[name])
+            if name in self.suppressed_tables:
+                suppressed = np.interp(u[:, i], self.grid, self.suppressed_tables[name])
+                values[name] = np.where(undetectable, suppressed, values[name])
+        self._add_derived(values, age, female)
+        return values
+
+    def _add_derived(self, values: Dict, age, female):
+        if {'cholesterol_total', 'hdl', 'triglycerides'} <= values.keys():
+            values['ldl'] = friedewald_ldl(values['cholesterol_total'], values['hdl'], values['triglycerides'])
+        if 'creatinine' in values:
+            values['egfr'] = ckd_epi_egfr(values['creatinine'], age, female)
+
+    def _refill(self):
+        u = self._uniforms(self.batch_size)
+        self._batch = {}
+        self._suppressed_batch = {}
+        for i, name in enumerate(self.tests):
+            self._batch[name] = np.interp(u[:, i], self.grid, self.tables[name])
+            if name in self.suppressed_tables:
+                self._suppressed_batch[name] = np.interp(u[:, i], self.grid, self.suppressed_tables[name])
+        self._position = 0
+
+    def draw(self, undetectable: bool, age: float, female: bool, seed: int = None) -> Dict[str, float]:
+        """One patient's panel, served from a pre-sampled vectorized batch
+        
+        With a seed the panel is drawn from its own stream instead, so it does
+        not depend on which patients were drawn before it.
+        """
+        if seed is not None:
+            values = self.sample(1, np.array([undetectable]), np.array([age]), np.array([female]),
+                                 rng=np.random.default_rng(seed))
+            return {name: float(column[0]) for name, column in values.items()}
+        if self._batch is None or self._position >= self.batch_size:
+            self._refill()
+        i = self._position
+        self._position += 1
+
+        values = {name: float(column[i]) for name, column in self._batch.items()}
+        if undetectable:
+            for name, column in self._suppressed_batch.items():
+                values[name] = float(column[i])
+        self._add_derived(values, age, female)
+        return {name: float(value) for name, value in values.items()}
@@ -0,0 +1,157 @@
+"""
+Memory-Budgeted Concurrency
+Admission control for work whose memory use varies by orders of magnitude
+(bundles from a few KB to tens of MB, Synthea JVMs of very different
+population sizes). Each task is admitted with an estimated cost; tasks run
+concurrently while the larger of the reserved estimates and the measured RSS
+of the workers stays under a ceiling, up to a maximum worker count. Small
+tasks therefore run wide, and big ones are throttled instead of OOM-killed.
+
+Costs come from a per-unit model (bytes of memory per input byte, per
+patient) that is learned online from the RSS the workers actually reach.
+"""
+
+import os
+import resource
+import subprocess
+import sys
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def process_rss(pid: int = None) -> int:
+    """Current resident set size of a process in bytes (0 if unknown)
+
+    Reads /proc on Linux. Elsewhere only the calling process can be measured,
+    and only by its peak RSS.
+    """
+    try:
+        with open(f"/proc/{pid or 'self'}/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        pass
+    if pid is None or pid == os.getpid():
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024  # bytes on macOS, KB elsewhere
+    return 0
+
+
+class CostModel:
+    """Memory estimate base + per_unit * units, learned from observed RSS
+
+    Observations above the estimate raise per_unit at once; lower ones pull it
+    down slowly, so the model errs on the side of admitting less. Tasks
+    smaller than min_units are not learned from: their RSS growth is mostly
+    allocator noise.
+    """
+
+    def __init__(self, per_unit: float, base: int = 0, smoothing: float = 0.1, min_units: float = 0):
+        self.per_unit = per_unit
+        self.base = base
+        self.smoothing = smoothing
+        self.min_units = min_units
+        self._lock = threading.Lock()
+
+    def estimate(self, units: float) -> int:
+        return int(self.base + self.per_unit * units)
+
+    def observe(self, units: float, used: int):
+        """Record the memory one task used (above its worker's idle RSS)"""
+        if units <= 0 or units < self.min_units:
+            return
+        ratio = max(used - self.base, 0) / units
+        with self._lock:
+            if ratio > self.per_unit:
+                self.per_unit = ratio
+            else:
+                self.per_unit += self.smoothing * (ratio - self.per_unit)
+
+
+class MemoryBudget:
+    """Admit tasks while reserved and measured memory stay under limit_bytes
+
+    limit_bytes=None only caps the worker count.
+    """
+
+    def __init__(self, limit_bytes: Optional[int], max_workers: int):
+        self.limit_bytes = limit_bytes
+        self.max_workers = max_workers
+        self.running = 0
+        self.peak_running = 0
+        self.throttled = 0  # admissions that had to wait for memory
+        self._reserved = 0
+        self._measured: Dict[object, int] = {}  # worker -> last RSS sample
+        self._cond = threading.Condition()
+
+    @property
+    def in_use(self) -> int:
+        return max(self._reserved, sum(self._measured.values()))
+
+    def _admits(self, cost: int) -> bool:
+        # One task always runs, however big, so the work cannot stall
+        if self.running == 0:
+            return True
+        if self.running >= self.max_workers:
+            return False
+        return self.limit_bytes is None or self.in_use + cost <= self.limit_bytes
+
+    def acquire(self, cost: int, stop: threading.Event = None) -> bool:
+        """Block until a task of this cost fits; False if stop was set meanwhile"""
+        with self._cond:
+            waited = False
+            while not self._admits(cost):
+                if stop is not None and stop.is_set():
+                    return False
+                if self.running < self.max_workers:
+                    waited = True
+                self._cond.wait(timeout=0.5)
+            self.throttled += waited
+            self.running += 1
+            self.peak_running = max(self.peak_running, self.running)
+            self._reserved += cost
+            return True
+
+    def release(self, cost: int):
+        with self._cond:
+            self.running -= 1
+            self._reserved -= cost
+            self._cond.notify_all()
+
+    def report(self, worker, rss: int):
+        """Latest RSS sample of a worker (process id, or any key)"""
+        with self._cond:
+            self._measured[worker] = rss
+            self._cond.notify_all()
+
+    def forget(self, worker):
+        with self._cond:
+            self._measured.pop(worker, None)
+            self._cond.notify_all()
+
+    def summary(self) -> str:
+        budget = f"budget {self.limit_bytes / 1024**3:.1f} GB" if self.limit_bytes is not None else "no memory budget"
+        return f"peak {self.peak_running}/{self.max_workers} concurrent, {self.throttled} throttled, {budget}"
+
+
+def run_monitored(cmd: List[str],
+                  on_sample: Callable[[int, int], None] = None,
+                  poll_seconds: float = 1.0) -> Tuple[subprocess.CompletedProcess, int]:
+    """subprocess.run(cmd, capture_output=True, text=True), sampling the child's RSS
+
+    on_sample(pid, rss) is called at every sample; returns the completed
+    process and its peak RSS.
+    """
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    peak = 0
+    while True:
+        try:
+            stdout, stderr = process.communicate(timeout=poll_seconds)
+            break
+        except subprocess.TimeoutExpired:
+            rss = process_rss(process.pid)
+            peak = max(peak, rss)
+            if on_sample is not None:
+                on_sample(process.pid, rss)
+    return subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr), peak
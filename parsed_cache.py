@@ -0,0 +1,112 @@
+"""
+Parsed-Bundle Cache
+Binary copies of parsed Synthea bundles, kept in a hidden .parsed_cache
+directory inside the input directory (scan_bundle_files skips it), so repeated
+post-processing runs over the same Synthea output skip JSON parsing.
+
+Each record is marshal data (the fastest stdlib codec for plain dicts and
+lists) behind a small header:
+    magic, marshal version
+    mtime_ns, size    of the source bundle; any change invalidates the record
+    summary           just the Patient (id, gender, birthDate) and each
+                      Encounter's id and period.start, as a skeleton bundle
+    bundle            the full parsed bundle
+The summary comes first, so the patch output modes, which never rewrite the
+bundle, decode only that.
+"""
+
+import marshal
+import os
+import struct
+from pathlib import Path
+from typing import Dict, NamedTuple, Optional
+
+from fhir_files import BundleFile
+
+PARSED_CACHE_DIR = '.parsed_cache'
+MAGIC = b'FHIRPC1\n'
+
+_HEADER = struct.Struct('<BqqI')  # marshal version, source mtime_ns, source size, summary length
+_PREFIX = len(MAGIC) + _HEADER.size
+
+
+class CachedBundle(NamedTuple):
+    """Cache record handed from the reader stage in place of the source bytes"""
+    record: bytes
+
+
+def summarize(bundle: Dict) -> Dict:
+    """Skeleton bundle with only what add_hiv_resources reads"""
+    entries = []
+    for entry in bundle.get('entry', []):
+        resource = entry.get('resource', {})
+        resource_type = resource.get('resourceType')
+        if resource_type == 'Patient':
+            entries.append({'resource': {
+                key: resource[key] for key in ('resourceType', 'id', 'gender', 'birthDate') if key in resource
+            }})
+        elif resource_type == 'Encounter':
+            entries.append({'resource': {
+                'resourceType': 'Encounter',
+                'id': resource.get('id'),
+                'period': {'start': resource.get('period', {}).get('start')}
+            }})
+    return {'entry': entries}
+
+
+def encode(bundle: Dict, stat: os.stat_result) -> bytes:
+    summary = marshal.dumps(summarize(bundle))
+    header = _HEADER.pack(marshal.version, stat.st_mtime_ns, stat.st_size, len(summary))
+    return MAGIC + header + summary + marshal.dumps(bundle)
+
+
+def decode_summary(cached: CachedBundle) -> Dict:
+    (_, _, _, summary_size) = _HEADER.unpack_from(cached.record, len(MAGIC))
+    return marshal.loads(cached.record[_PREFIX:_PREFIX + summary_size])
+
+
+def decode_bundle(cached: CachedBundle) -> Dict:
+    (_, _, _, summary_size) = _HEADER.unpack_from(cached.record, len(MAGIC))
+    return marshal.loads(memoryview(cached.record)[_PREFIX + summary_size:])
+
+
+class ParsedBundleCache:
+    """Read and write cache records for the bundles of one input directory"""
+
+    def __init__(self, input_dir):
+        self.input_dir = Path(input_dir)
+        self.cache_dir = self.input_dir / PARSED_CACHE_DIR
+        self._created_dirs = set()
+
+    def path_for(self, bundle_file: BundleFile) -> Path:
+        relative = os.path.relpath(bundle_file.path, self.input_dir)
+        return self.cache_dir / f"{relative}.bin"
+
+    def read(self, bundle_file: BundleFile) -> Optional[CachedBundle]:
+        """The bundle's record if it matches the source's current mtime and size"""
+        try:
+            stat = os.stat(bundle_file.path)
+            with open(self.path_for(bundle_file), 'rb') as f:
+                record = f.read()
+        except FileNotFoundError:
+            return None
+        if len(record) < _PREFIX or record[:len(MAGIC)] != MAGIC:
+            return None
+        version, mtime_ns, size, _ = _HEADER.unpack_from(record, len(MAGIC))
+        if (version, mtime_ns, size) != (marshal.version, stat.st_mtime_ns, stat.st_size):
+            return None
+        return CachedBundle(record)
+
+    def write(self, bundle_file: BundleFile, data: bytes, bundle: Dict):
+        """Cache a bundle parsed from data, unless the source changed since it was read"""
+        stat = os.stat(bundle_file.path)
+        if stat.st_size != len(data):
+            return
+        path = self.path_for(bundle_file)
+        if path.parent not in self._created_dirs:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self._created_dirs.add(path.parent)
+        tmp = path.with_name(f".{path.name}.{os.getpid()}")
+        with open(tmp, 'wb') as f:
+            f.write(encode(bundle, stat))
+        os.replace(tmp, path)
@@ -7,12 +7,20 @@ using the 2023 ADAP and RSR Public Data Reports
 import json
 import subprocess
 import random
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
 import numpy as np
 import os
 from dotenv import load_dotenv
 
+from fhir_archive import ArchiveShardWriter, archive_format, find_archives, iter_archives, pack_directory
+from fhir_files import PATIENT, scan_bundle_files
+from memory_budget import CostModel, MemoryBudget, run_monitored
+from synthea_cache import SyntheaCache, clone_tree
+from synthea_module import write_hiv_module
+
 load_dotenv()
 
 # Demographics based on 2023 ADAP Data Report
@@ -53,6 +61,101 @@ ADAP_DEMOGRAPHICS = {
     }
 }
 
+# (state, city) -> share of the population generated there. Approximate
+# relative ADAP enrollment of the largest programs, one metro area each;
+# override with GEOGRAPHY_WEIGHTS from the current ADAP Data Report. City
+# None lets Synthea spread patients across the whole state.
+GEOGRAPHY_WEIGHTS = {
+    ('California', 'Los Angeles'): 0.16,
+    ('New York', 'New York'): 0.14,
+    ('Florida', 'Miami'): 0.13,
+    ('Texas', 'Houston'): 0.12,
+    ('Georgia', 'Atlanta'): 0.08,
+    ('Illinois', 'Chicago'): 0.06,
+    ('Pennsylvania', 'Philadelphia'): 0.05,
+    ('New Jersey', 'Newark'): 0.05,
+    ('North Carolina', 'Charlotte'): 0.05,
+    ('Maryland', 'Baltimore'): 0.04,
+    ('Louisiana', 'New Orleans'): 0.04,
+    ('Massachusetts', 'Boston'): 0.04,
+    ('Washington', 'Seattle'): 0.04
+}
+
+# Bulk-data types every Synthea run exports for its own providers; merged
+# job output keeps one copy of each resource id
+SHARED_NDJSON_TYPES = ('Organization', 'Location', 'Practitioner', 'PractitionerRole')
+
+# Initial JVM memory estimate for a Synthea run (refined from observed peak RSS)
+JVM_BASE_COST = 1024**3
+JVM_COST_PER_PATIENT = 256 * 1024
+
+# Age bucket -> inclusive age range in years (upper bound for '>=65' is Synthea's -a limit)
+AGE_RANGES = {
+    '<13': (0, 12),
+    '13-14': (13, 14),
+    '15-19': (15, 19),
+    '20-24': (20, 24),
+    '25-29': (25, 29),
+    '30-34': (30, 34),
+    '35-39': (35, 39),
+    '40-44': (40, 44),
+    '45-49': (45, 49),
+    '50-54': (50, 54),
+    '55-59': (55, 59),
+    '60-64': (60, 64),
+    '>=65': (65, 90)
+}
+
+
+class Stratum(NamedTuple):
+    """One age x sex cell of the target population and its patient quota"""
+    age_group: str
+    sex: str
+    min_age: int
+    max_age: int
+    quota: int
+    
+    @property
+    def name(self) -> str:
+        return f"{self.sex}_{self.min_age}-{self.max_age}"
+
+
+class Location(NamedTuple):
+    """One state (and optionally city) of the target population and its patient quota"""
+    state: str
+    city: Optional[str]
+    quota: int
+    
+    @property
+    def name(self) -> str:
+        return '_'.join(part.replace(' ', '-') for part in (self.state, self.city) if part)
+
+
+def parse_geography(value: str) -> Dict[Tuple[str, Optional[str]], float]:
+    """'California:Los Angeles=3, Texas=2' -> {('California', 'Los Angeles'): 3.0, ('Texas', None): 2.0}"""
+    weights = {}
+    for part in value.split(','):
+        if not part.strip():
+            continue
+        place, sep, weight = part.rpartition('=')
+        if not sep:
+            raise ValueError(f"Location weight must be State[:City]=weight: {part.strip()!r}")
+        state, _, city = place.partition(':')
+        weights[(state.strip(), city.strip() or None)] = float(weight)
+    return weights
+
+
+def apportion(total: int, weights: Dict[str, float]) -> Dict[str, int]:
+    """Split total into integer quotas proportional to weights (largest remainder)"""
+    weight_sum = sum(weights.values())
+    exact = {key: total * w / weight_sum for key, w in weights.items()}
+    quotas = {key: int(v) for key, v in exact.items()}
+    shortfall = total - sum(quotas.values())
+    for key in sorted(exact, key=lambda k: exact[k] - quotas[k], reverse=True)[:shortfall]:
+        quotas[key] += 1
+    return quotas
+
+
 # HIV-related RxNorm codes (common ARV medications)
 HIV_MEDICATIONS = {
     'biktarvy': '2120107',  # Biktarvy (bictegravir/emtricitabine/tenofovir alafenamide)
@@ -97,12 +200,39 @@ class SyntheaPopulationGenerator:
     def __init__(self,
                  synthea_jar_path: str,
                  output_dir: str = None,
-                 population_size: int = 1000):
+                 population_size: int = 1000,
+                 seed: int = None,
+                 max_parallel: int = None,
+                 cache_dir: str = None,
+                 cache_max_bytes: int = 50 * 1024**3,
+                 memory_budget_bytes: int = None,
+                 bulk_data: bool = False,
+                 archive_format: str = None,
+                 archive_shard_bytes: int = 1 << 30):
         self.synthea_jar_path = Path(synthea_jar_path)
         if output_dir is None:
             output_dir = os.getenv('PROCESSED_FHIR_DIR', './output')
         self.output_dir = Path(output_dir)
         self.population_size = population_size
+        # Parallel Synthea runs need distinct seeds or they generate the same patients
+        self.seed = seed if seed is not None else random.randrange(2**31)
+        self.max_parallel = max_parallel or max(1, (os.cpu_count() or 2) // 2)
+        # Content-addressed cache of finished Synthea runs (None disables it)
+        self.cache = SyntheaCache(cache_dir, cache_max_bytes) if cache_dir else None
+        # Parallel JVMs start only while their estimated/measured RSS fits the budget
+        self.memory_budget = MemoryBudget(memory_budget_bytes, self.max_parallel) if memory_budget_bytes else None
+        self.jvm_cost = CostModel(JVM_COST_PER_PATIENT, base=JVM_BASE_COST)
+        # Export one <ResourceType>.ndjson per type instead of a bundle per patient
+        self.bulk_data = bulk_data
+        # Pack the bundles into rolling tar/zip shards (synthea-00000.tar, ...) in
+        # output_dir/fhir instead of leaving one file per patient there
+        if archive_format is not None and bulk_data:
+            raise ValueError("Archive output packs bundles; it cannot be combined with bulk data")
+        self.archive_format = archive_format
+        self.archive_shard_bytes = archive_shard_bytes
+        self._archive_writer = None
+        # Type -> ids of the shared resources already merged from earlier jobs
+        self._merged_ids: Dict[str, set] = {}
         self.output_dir.mkdir(exist_ok=True, parents=True)
         
     def create_demographics_file(self) -> Path:
@@ -194,48 +324,328 @@ class SyntheaPopulationGenerator:
             
         return config_path
     
-    def run_synthea(self, state: str = "Massachusetts", city: str = "Boston") -> Path:
-        """Execute Synthea to generate population"""
+    def create_hiv_module(self, adap_percentage: float = 0.5) -> Path:
+        """Write the HIV care GMF module used for all-in-one generation"""
+        return write_hiv_module(self.output_dir / "modules", adap_percentage=adap_percentage)
+    
+    def run_synthea(self,
+                    state: str = "Massachusetts",
+                    city: str = "Boston",
+                    module_dir: Path = None) -> Path:
+        """Execute Synthea to generate population
+        
+        With module_dir, Synthea also loads the local modules in that directory
+        (see create_hiv_module), so HIV medications and labs are generated in
+        the same run and post-processing can be skipped.
+        """
         
         demographics_csv = self.create_custom_demographics_csv()
         
+        cmd = self.synthea_command(self.population_size, self.output_dir, state, city, module_dir,
+                                   extra_args=["-s", str(self.seed)])
+        
+        self._execute("synthea", cmd, self.output_dir / "fhir", module_dir)
+        if self.archive_format is not None:
+            self.remove_archives()
+            shards = pack_directory(self.output_dir / "fhir", self.output_dir / "fhir", 'synthea',
+                                    self.archive_format, self.archive_shard_bytes)
+            print(f"Packed bundles into {len(shards)} archive shard(s)")
+        
+        print(f"Synthea completed successfully")
+        return self.output_dir / "fhir"
+    
+    def _execute(self, name: str, cmd: List[str], fhir_dir: Path, module_dir: Path = None):
+        """Run one Synthea command, or link its output from the cache on a hit"""
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(self.synthea_jar_path, cmd, [module_dir] if module_dir else [])
+            if self.cache.materialize(key, fhir_dir):
+                print(f"Synthea cache hit [{name}]: {key[:12]}")
+                return
+        
+        run_dir = None
+        run_cmd = cmd
+        if key is not None:
+            # Run into a clean directory of its own, so the cache entry holds
+            # this run's bundles only (not stale files already in fhir_dir)
+            run_dir = fhir_dir.parent / f".synthea-{key[:12]}"
+            shutil.rmtree(run_dir, ignore_errors=True)
+            run_cmd = [f"--exporter.baseDirectory={run_dir}" if arg.startswith("--exporter.baseDirectory=") else arg
+                       for arg in cmd]
+        
+        try:
+            print(f"Running Synthea [{name}]: {' '.join(run_cmd)}")
+            if self.memory_budget is None:
+                result = subprocess.run(run_cmd, capture_output=True, text=True)
+            else:
+                result = self._run_budgeted(name, run_cmd)
+            
+            if result.returncode != 0:
+                print(f"Synthea Error: {result.stderr}")
+                raise RuntimeError(f"Synthea execution failed for {name}: {result.stderr}")
+            
+            if run_dir is not None:
+                self.cache.store(key, run_dir / "fhir", meta={'name': name, 'cmd': cmd})
+                clone_tree(run_dir / "fhir", fhir_dir)
+        finally:
+            if run_dir is not None:
+                shutil.rmtree(run_dir, ignore_errors=True)
+    
+    def _run_budgeted(self, name: str, cmd: List[str]) -> subprocess.CompletedProcess:
+        """Run a JVM once it fits in the memory budget, learning its cost from its peak RSS"""
+        population = int(cmd[cmd.index("-p") + 1])
+        cost = self.jvm_cost.estimate(population)
+        self.memory_budget.acquire(cost)
+        try:
+            result, peak = run_monitored(cmd, lambda pid, rss: self.memory_budget.report(name, rss))
+        finally:
+            self.memory_budget.release(cost)
+            self.memory_budget.forget(name)
+        if peak:
+            self.jvm_cost.observe(population, peak)
+        return result
+    
+    def synthea_command(self,
+                        population: int,
+                        base_dir: Path,
+                        state: str,
+                        city: str,
+                        module_dir: Path = None,
+                        extra_args: List[str] = None) -> List[str]:
+        """Build the java command line for one Synthea run"""
         cmd = [
             "java",
             "-jar", str(self.synthea_jar_path),
-            "-p", str(self.population_size),
+            "-p", str(population),
             "--exporter.fhir.export", "true",
             "--exporter.csv.export", "false",
             "--exporter.ccda.export", "false",
-            f"--exporter.baseDirectory={self.output_dir}",
-            state,
-            city
+            f"--exporter.baseDirectory={base_dir}"
+        ]
+        if self.bulk_data:
+            cmd += ["--exporter.fhir.bulk_data", "true"]
+        if module_dir is not None:
+            cmd += ["-d", str(module_dir)]
+        cmd += extra_args or []
+        cmd += [state] + ([city] if city else [])
+        return cmd
+    
+    def plan_strata(self) -> List[Stratum]:
+        """Turn the ADAP age x sex targets into per-stratum patient quotas"""
+        weights = {
+            (age_group, sex): age_weight * sex_weight
+            for age_group, age_weight in ADAP_DEMOGRAPHICS['age_distribution'].items()
+            for sex, sex_weight in ADAP_DEMOGRAPHICS['sex'].items()
+        }
+        quotas = apportion(self.population_size, weights)
+        return [
+            Stratum(age_group, sex, *AGE_RANGES[age_group], quotas[(age_group, sex)])
+            for age_group, sex in weights
+            if quotas[(age_group, sex)] > 0
         ]
+    
+    def plan_geography(self, weights: Dict[Tuple[str, Optional[str]], float] = None) -> List[Location]:
+        """Split the population into per-location quotas by weight"""
+        quotas = apportion(self.population_size, weights or GEOGRAPHY_WEIGHTS)
+        return [Location(state, city, quota) for (state, city), quota in quotas.items() if quota > 0]
+    
+    def run_synthea_jobs(self, jobs: List[Dict]) -> List[Path]:
+        """Run independent Synthea jobs in parallel and merge their FHIR output
         
-        print(f"Running Synthea: {' '.join(cmd)}")
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        Each job is a dict with 'name' and 'cmd' (and optionally 'module_dir')
+        and writes to its own 'base_dir'; patient bundles are moved into
+        output_dir/fhir afterwards.
+        """
+        def run(job):
+            self._execute(job['name'], job['cmd'], Path(job['base_dir']) / "fhir", job.get('module_dir'))
+            return job
         
-        if result.returncode != 0:
-            print(f"Synthea Error: {result.stderr}")
-            raise RuntimeError(f"Synthea execution failed: {result.stderr}")
+        # Merged bulk-data files are appended to, so start them empty
+        if self.bulk_data:
+            for ndjson_file in scan_bundle_files(self.output_dir / "fhir", suffix='.ndjson'):
+                os.unlink(ndjson_file.path)
+        self._merged_ids = {}
+        if self.archive_format is not None:
+            self.remove_archives()
+            (self.output_dir / "fhir").mkdir(parents=True, exist_ok=True)
+            self._archive_writer = ArchiveShardWriter(self.output_dir / "fhir", 'synthea',
+                                                      self.archive_format, self.archive_shard_bytes)
+        
+        merged = []
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_parallel) as pool:
+                for job in pool.map(run, jobs):
+                    merged.append(self.merge_job_output(job['name'], Path(job['base_dir'])))
+        finally:
+            if self._archive_writer is not None:
+                self._archive_writer.close()
+                print(f"Packed bundles into {len(self._archive_writer.shards)} archive shard(s)")
+                self._archive_writer = None
+        if self.memory_budget is not None:
+            print(f"Synthea jobs: {self.memory_budget.summary()}")
+        return merged
+    
+    def remove_archives(self):
+        """Delete archive shards left in output_dir/fhir by an earlier run"""
+        fhir_dir = self.output_dir / "fhir"
+        if fhir_dir.is_dir():
+            for entry in fhir_dir.iterdir():
+                if entry.name.startswith('synthea-') and archive_format(entry):
+                    entry.unlink()
+    
+    def merge_job_output(self, job_name: str, base_dir: Path) -> Path:
+        """Move one job's bundles into output_dir/fhir, keeping file names unique
+        
+        With archive output the bundles are appended to the archive shards.
+        """
+        fhir_dir = self.output_dir / "fhir"
+        fhir_dir.mkdir(parents=True, exist_ok=True)
+        for bundle_file in scan_bundle_files(base_dir / "fhir"):
+            target = fhir_dir / bundle_file.name
+            if bundle_file.kind != PATIENT:
+                # Every run writes its own hospital/practitioner bundles
+                target = fhir_dir / f"{bundle_file.name[:-len('.json')]}_{job_name}.json"
+            if self._archive_writer is not None:
+                with open(bundle_file.path, 'rb') as f:
+                    self._archive_writer.write(target.name, f.read())
+                continue
+            shutil.move(bundle_file.path, target)
+        for ndjson_file in scan_bundle_files(base_dir / "fhir", suffix='.ndjson'):
+            # Bulk-data output: append the job's lines to the shared per-type file
+            resource_type = ndjson_file.name[:-len('.ndjson')]
+            with open(ndjson_file.path, 'rb') as src, open(fhir_dir / ndjson_file.name, 'ab') as dst:
+                if resource_type not in SHARED_NDJSON_TYPES:
+                    shutil.copyfileobj(src, dst, 1 << 20)
+                    continue
+                # Providers shared by several jobs are written once
+                seen = self._merged_ids.setdefault(resource_type, set())
+                for line in src:
+                    if not line.strip():
+                        continue
+                    resource_id = json.loads(line).get('id')
+                    if resource_id in seen:
+                        continue
+                    seen.add(resource_id)
+                    dst.write(line if line.endswith(b'\n') else line + b'\n')
+        shutil.rmtree(base_dir, ignore_errors=True)
+        return fhir_dir
+    
+    def run_stratified(self,
+                       state: str = "Massachusetts",
+                       city: str = "Boston",
+                       module_dir: Path = None) -> Path:
+        """Run one Synthea job per age x sex stratum (-a min-max, -g M/F)
+        
+        The population hits the ADAP age/sex targets directly instead of
+        following Synthea's default age pyramid.
+        """
+        self.create_custom_demographics_csv()
+        strata = self.plan_strata()
+        jobs = []
+        for i, stratum in enumerate(strata):
+            base_dir = self.output_dir / "strata" / stratum.name
+            jobs.append({
+                'name': stratum.name,
+                'base_dir': base_dir,
+                'module_dir': module_dir,
+                'cmd': self.synthea_command(
+                    stratum.quota, base_dir, state, city, module_dir,
+                    extra_args=[
+                        "-s", str(self.seed + i),
+                        "-a", f"{stratum.min_age}-{stratum.max_age}",
+                        "-g", stratum.sex
+                    ]
+                )
+            })
+        
+        print(f"Planned {len(strata)} strata for {self.population_size} patients "
+              f"({self.max_parallel} parallel Synthea runs)")
+        self.run_synthea_jobs(jobs)
+        shutil.rmtree(self.output_dir / "strata", ignore_errors=True)
+        
+        print(f"Synthea completed successfully")
+        return self.output_dir / "fhir"
+    
+    def run_geographic(self,
+                       weights: Dict[Tuple[str, Optional[str]], float] = None,
+                       stratified: bool = False,
+                       module_dir: Path = None) -> Path:
+        """Run one Synthea job per location (and per age x sex stratum if stratified)
+        
+        Patients are spread over states/cities by weight (GEOGRAPHY_WEIGHTS by
+        default), each with that location's Synthea geography and providers.
+        The jobs run in parallel and are merged into output_dir/fhir.
+        """
+        self.create_custom_demographics_csv()
+        locations = self.plan_geography(weights)
+        quotas = {(location, None): location.quota for location in locations}
+        if stratified:
+            # Each location gets the ADAP age/sex mix of its own quota
+            strata = self.plan_strata()
+            quotas = apportion(self.population_size, {
+                (location, stratum): location.quota * stratum.quota
+                for location in locations
+                for stratum in strata
+            })
+        jobs = []
+        cells = [cell for cell, quota in quotas.items() if quota > 0]
+        for i, (location, stratum) in enumerate(cells):
+            name = location.name if stratum is None else f"{location.name}_{stratum.name}"
+            population = quotas[(location, stratum)]
+            extra_args = ["-s", str(self.seed + i)]
+            if stratum is not None:
+                extra_args += ["-a", f"{stratum.min_age}-{stratum.max_age}", "-g", stratum.sex]
+            base_dir = self.output_dir / "locations" / name
+            jobs.append({
+                'name': name,
+                'base_dir': base_dir,
+                'module_dir': module_dir,
+                'cmd': self.synthea_command(population, base_dir, location.state, location.city, module_dir,
+                                            extra_args=extra_args)
+            })
+        
+        print(f"Planned {len(jobs)} Synthea jobs over {len(locations)} locations for {self.population_size} patients "
+              f"({self.max_parallel} parallel Synthea runs)")
+        self.run_synthea_jobs(jobs)
+        shutil.rmtree(self.output_dir / "locations", ignore_errors=True)
         
         print(f"Synthea completed successfully")
         return self.output_dir / "fhir"
     
+    def iter_generated_patients(self) -> Iterator[Path]:
+        """Stream generated patient FHIR files (hospital/practitioner bundles excluded)
+        
+        Bundles packed into archives are named archive/member, without being read.
+        """
+        fhir_dir = self.output_dir / "fhir"
+        archives = find_archives(fhir_dir)
+        if archives:
+            for bundle_file, _ in iter_archives(archives, kinds={PATIENT}, read=False):
+                yield Path(bundle_file.path)
+            return
+        for bundle_file in scan_bundle_files(fhir_dir, kinds={PATIENT}):
+            yield Path(bundle_file.path)
+    
     def get_generated_patients(self) -> List[Path]:
         """Get list of generated patient FHIR files"""
-        fhir_dir = self.output_dir / "fhir"
-        if not fhir_dir.exists():
-            return []
-        return list(fhir_dir.glob("*.json"))
+        return list(self.iter_generated_patients())
 
 
 def main():
     """Main execution"""
     
+    seed = os.getenv('SYNTHEA_SEED')
     generator = SyntheaPopulationGenerator(
         synthea_jar_path="./synthea-with-dependencies.jar",
         output_dir=os.getenv('PROCESSED_FHIR_DIR', './output_fhir'),
-        population_size=1000
+        population_size=1000,
+        seed=int(seed) if seed else None,  # fixed seed makes runs reproducible and cacheable
+        cache_dir=os.getenv('SYNTHEA_CACHE_DIR'),
+        cache_max_bytes=int(float(os.getenv('SYNTHEA_CACHE_MAX_GB', '50')) * 1024**3),
+        memory_budget_bytes=int(float(os.getenv('MEMORY_BUDGET_GB')) * 1024**3) if os.getenv('MEMORY_BUDGET_GB') else None,
+        bulk_data=os.getenv('SYNTHEA_BULK_DATA', 'false').lower() == 'true',  # <ResourceType>.ndjson output
+        archive_format=os.getenv('SYNTHEA_ARCHIVE') or None,  # 'tar', 'tar.gz' or 'zip' shards instead of files
+        archive_shard_bytes=int(float(os.getenv('ARCHIVE_SHARD_MB', '1024')) * 1024**2)
     )
     
     print("Creating demographic configuration...")
@@ -243,15 +653,39 @@ def main():
     generator.create_custom_demographics_csv()
     generator.generate_age_range_file()
     
+    # All-in-one mode: HIV care module runs inside Synthea, no post-processing pass
+    all_in_one = os.getenv('ALL_IN_ONE', 'false').lower() == 'true'
+    module_dir = None
+    if all_in_one:
+        module_path = generator.create_hiv_module(adap_percentage=0.5)
+        module_dir = module_path.parent
+        print(f"Using HIV care module {module_path}")
+    
     print(f"Generating {generator.population_size} synthetic patients...")
-    fhir_output = generator.run_synthea()
+    stratified = os.getenv('STRATIFIED', 'false').lower() == 'true'
+    if os.getenv('GEOGRAPHY', 'false').lower() == 'true' or os.getenv('GEOGRAPHY_WEIGHTS'):
+        # One Synthea run per state/city, e.g. GEOGRAPHY_WEIGHTS='California:Los Angeles=3,Texas=2'
+        weights = parse_geography(os.getenv('GEOGRAPHY_WEIGHTS')) if os.getenv('GEOGRAPHY_WEIGHTS') else None
+        fhir_output = generator.run_geographic(weights, stratified=stratified, module_dir=module_dir)
+    elif stratified:
+        # One Synthea run per ADAP age x sex stratum
+        fhir_output = generator.run_stratified(module_dir=module_dir)
+    else:
+        fhir_output = generator.run_synthea(module_dir=module_dir)
     
-    patients = generator.get_generated_patients()
-    print(f"Generated {len(patients)} patient records in {fhir_output}")
+    if generator.bulk_data:
+        with open(fhir_output / "Patient.ndjson", 'rb') as f:
+            patient_count = sum(1 for line in f if line.strip())
+    else:
+        patient_count = sum(1 for _ in generator.iter_generated_patients())
+    print(f"Generated {patient_count} patient records in {fhir_output}")
     
     print("\nNext steps:")
-    print("1. Run post_process_fhir.py to add HIV medications and labs")
-    print("2. Run fhir_uploader.py to upload to FHIR server")
+    if all_in_one:
+        print("1. Run fhir_uploader.py to upload to FHIR server")
+    else:
+        print("1. Run post_process_fhir.py to add HIV medications and labs")
+        print("2. Run fhir_uploader.py to upload to FHIR server")
 
 
 if __name__ == "__main__":
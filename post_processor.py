@@ -2,18 +2,38 @@
 FHIR Post-Processor for Ryan White/ADAP Patients
 Adds HIV medications and comprehensive lab results aligned with DHHS Guidelines
 Includes all baseline and monitoring tests per DHHS recommendations
-TODO: Need to link back into main list.
+Generated labs and medications are anchored to the patient's own Synthea
+encounters (nearest encounter to the target date, via EncounterIndex).
 """
 
+import bisect
 import json
+import multiprocessing
 import random
+import re
+import shutil
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
 from datetime import datetime, timedelta
 import uuid
 import os
+import queue
+import threading
+from functools import partial
 from dotenv import load_dotenv
 
+from bundle_schedule import schedule_bundles
+from content_index import CONTENT_INDEX_FILE, encode_block, index_records, open_index
+from fhir_archive import ARCHIVE_FORMATS, ArchiveShardWriter, find_archives, iter_archives
+from fhir_files import PATIENT, BundleFile, output_path_for, scan_bundle_files
+from lab_model import CorrelatedLabModel
+from memory_budget import CostModel, MemoryBudget, process_rss
+from parsed_cache import CachedBundle, ParsedBundleCache, decode_bundle, decode_summary
+from regimens import RegimenSampler, conditions_from_observations
+from resource_filter import ResourceFilter, parse_elements, parse_types
+from sqlite_index import SQLITE_INDEX_FILE, SQLiteIndexWriter
+
 load_dotenv()
 
 
@@ -219,26 +239,323 @@ BASELINE_ONLY_TESTS = {
 }
 
 
+# Tag carried by every resource added by the post-processor, so generated
+# data can be told apart from Synthea's own resources downstream
+GENERATED_TAG = {
+    "system": "https://github.com/BigInformatics/fhir_pop_hrsa_hab",
+    "code": "post-processor",
+    "display": "Added by FHIR post-processor"
+}
+
+# Generated resource ids are derived from the patient id and the resource's
+# code, so re-running the post-processor keeps the same ids
+GENERATED_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, GENERATED_TAG['system'])
+
+
+def generated_resource_id(patient_id: str, resource: Dict, occurrence: int = 0) -> str:
+    """Stable id of a generated MedicationStatement/Observation for a patient
+    
+    occurrence numbers repeated codes (e.g. a reflex HCV RNA) within one patient.
+    """
+    concept = resource.get('medicationCodeableConcept') or resource.get('code', {})
+    code = concept.get('coding', [{}])[0].get('code', '')
+    name = f"{patient_id}/{resource['resourceType']}/{code}"
+    if occurrence:
+        name += f"#{occurrence}"
+    return str(uuid.uuid5(GENERATED_NAMESPACE, name))
+
+
+# End-of-stream marker passed between pipeline stages
+_SENTINEL = object()
+
+
+class BundleQueue(queue.Queue):
+    """Pipeline queue of tasks (lists of bundles) bounded in bundles, not tasks
+    
+    A task is admitted while fewer than maxsize bundles are queued, so the
+    queue holds at most maxsize - 1 bundles plus one task.
+    """
+    
+    def _init(self, maxsize):
+        super()._init(maxsize)
+        self._bundles = 0
+    
+    @staticmethod
+    def _weight(item) -> int:
+        return len(item) if isinstance(item, list) else 1  # sentinels count as one
+    
+    def _qsize(self):
+        return self._bundles
+    
+    def _put(self, item):
+        super()._put(item)
+        self._bundles += self._weight(item)
+    
+    def _get(self):
+        item = super()._get()
+        self._bundles -= self._weight(item)
+        return item
+
+
+# Memory for enriching a bundle, per byte of JSON (parsed objects plus output)
+BUNDLE_COST_PER_BYTE = 12.0
+    
+# Output modes: full rewritten bundles, per-patient sidecar bundles holding
+# only the added entries, or one shared NDJSON stream of added resources
+OUTPUT_MODES = ('bundle', 'sidecar', 'ndjson')
+NDJSON_PATCH_FILE = 'hiv_resources.ndjson'
+    
+# Input formats: Synthea's per-patient bundles, or its bulk-data export
+# (exporter.fhir.bulk_data: one <ResourceType>.ndjson per type)
+INPUT_FORMATS = ('bundle', 'ndjson')
+    
+# Patient of a bulk-data line, read without parsing the line
+_BULK_SUBJECT = re.compile(rb'"subject"\s*:\s*\{\s*"reference"\s*:\s*"(?:Patient/|urn:uuid:)([^"]+)"')
+
+
+# Age assumed for eGFR when a patient has no birthDate
+DEFAULT_AGE = 40
+
+
+def patient_age(patient_resource: Dict, on_date: datetime) -> float:
+    """Age in years of a Patient resource on a given date"""
+    birth_date = patient_resource.get('birthDate')
+    if not birth_date:
+        return DEFAULT_AGE
+    try:
+        born = datetime.strptime(birth_date[:10], '%Y-%m-%d')
+    except ValueError:
+        return DEFAULT_AGE
+    return max((on_date.replace(tzinfo=None) - born).days / 365.25, 0.0)
+
+
+def parse_fhir_datetime(value: str) -> Optional[datetime]:
+    """Parse a FHIR dateTime/instant (with offset or 'Z'), or None if invalid"""
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (AttributeError, ValueError):
+        return None
+
+
+class EncounterIndex:
+    """A patient's encounters sorted by period start, for nearest-date lookup
+    
+    Built in the same pass over the bundle that finds the Patient resource;
+    lookups are a binary search over the start timestamps.
+    """
+    
+    def __init__(self):
+        self._entries = []
+        self._starts = None
+    
+    def add(self, resource: Dict):
+        start = parse_fhir_datetime(resource.get('period', {}).get('start'))
+        if start is not None:
+            self._entries.append((start.timestamp(), start, f"Encounter/{resource['id']}"))
+            self._starts = None
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    def nearest(self, when: datetime) -> Optional[Tuple[str, datetime]]:
+        """Reference and start date of the encounter closest to when"""
+        if not self._entries:
+            return None
+        if self._starts is None:
+            self._entries.sort(key=lambda e: e[0])
+            self._starts = [e[0] for e in self._entries]
+        target = when.timestamp()
+        i = bisect.bisect_left(self._starts, target)
+        if i == len(self._starts) or (i > 0 and target - self._starts[i - 1] <= self._starts[i] - target):
+            i -= 1
+        _, start, ref = self._entries[i]
+        return ref, start
+
+
+class EncounterTargets:
+    """Nearest encounter to each of a patient's target dates, fed one encounter at a time
+    
+    Used for bulk NDJSON input, where a patient's encounters are spread over
+    Encounter.ndjson: only the best candidate per target is kept.
+    """
+    
+    __slots__ = ('patient', 'dates', 'best')
+    
+    def __init__(self, patient: Dict, dates: Tuple[datetime, ...]):
+        self.patient = patient
+        self.dates = dates
+        self.best = [None] * len(dates)  # (distance, start timestamp, start, reference)
+    
+    def add(self, resource: Dict):
+        start = parse_fhir_datetime(resource.get('period', {}).get('start'))
+        if start is None:
+            return
+        timestamp = start.timestamp()
+        for i, target in enumerate(self.dates):
+            candidate = (abs(timestamp - target.timestamp()), timestamp, start, f"Encounter/{resource['id']}")
+            # Ties go to the earlier encounter, as in EncounterIndex.nearest
+            if self.best[i] is None or candidate[:2] < self.best[i][:2]:
+                self.best[i] = candidate
+    
+    def nearest(self, i: int) -> Tuple[Optional[str], datetime]:
+        """(encounter reference or None, snapped date) for target i"""
+        if self.best[i] is None:
+            return None, self.dates[i]
+        return self.best[i][3], self.best[i][2]
+
+
+class Transformed(NamedTuple):
+    """Output of the transform stage for one input bundle"""
+    output_file: Optional[Path]  # None when nothing is written
+    data: bytes
+    new_entries: List[Dict]
+    index_records: Optional[List] = None  # (Type/id, hash) per resource, for content_index
+    spans: Optional[List] = None  # (resource, byte offset, byte length) per entry, for sqlite_index
+
+
+SKIPPED = Transformed(None, b'', [])
+
+
+def dump_bundle(bundle: Dict) -> Tuple[bytes, List[Tuple[int, int]]]:
+    """json.dumps(bundle, indent=2), plus the byte range of every entry
+    
+    Entries are serialized one at a time and re-indented to their nesting
+    depth, which yields exactly the same bytes as dumping the whole bundle.
+    """
+    chunks = ['{']
+    position = 1
+    spans = []
+    for i, (key, value) in enumerate(bundle.items()):
+        prefix = ('\n  ' if i == 0 else ',\n  ') + json.dumps(key) + ': '
+        if key == 'entry' and isinstance(value, list) and value:
+            chunks.append(prefix + '[\n    ')
+            position += len(chunks[-1])
+            for j, entry in enumerate(value):
+                if j:
+                    chunks.append(',\n    ')
+                    position += 6
+                text = json.dumps(entry, indent=2).replace('\n', '\n    ')
+                spans.append((position, len(text)))
+                chunks.append(text)
+                position += len(text)
+            chunks.append('\n  ]')
+            position += 4
+        else:
+            chunks.append(prefix + json.dumps(value, indent=2).replace('\n', '\n  '))
+            position += len(chunks[-1])
+    chunks.append('\n}' if len(chunks) > 1 else '}')
+    # ensure_ascii output: character offsets are byte offsets
+    return ''.join(chunks).encode('ascii'), spans
+
+
+def sidecar_name(bundle_name: str) -> str:
+    """Sidecar file name for a patient bundle (Given_Family_<uuid>.patch.json)"""
+    return bundle_name[:-len('.json')] + '.patch.json' if bundle_name.endswith('.json') else bundle_name + '.patch.json'
+
+
 class FHIRPostProcessor:
     """Add comprehensive HIV-related medications and lab results to FHIR bundles"""
     
-    def __init__(self, input_dir: str, output_dir: str = None, adap_percentage: float = 0.5):
+    def __init__(self,
+                 input_dir: str,
+                 output_dir: str = None,
+                 adap_percentage: float = 0.5,
+                 output_layout: str = 'flat',
+                 output_mode: str = 'bundle',
+                 correlated_labs: bool = True,
+                 seed: int = None,
+                 content_index: bool = False,
+                 sqlite_index: bool = False,
+                 reader_threads: int = 4,
+                 writer_threads: int = 4,
+                 read_ahead: int = 64,
+                 write_behind: int = 64,
+                 write_buffer_size: int = 1 << 20,
+                 workers: int = 0,
+                 memory_budget_bytes: int = None,
+                 resource_filter: ResourceFilter = None,
+                 input_format: str = 'bundle',
+                 parsed_cache: bool = False,
+                 output_archive: str = None,
+                 archive_shard_bytes: int = 1 << 30):
         self.input_dir = Path(input_dir)
         if output_dir is None:
             output_dir = os.getenv('PROCESSED_FHIR_DIR', './processed_fhir')
         self.output_dir = Path(output_dir)
         self.adap_percentage = adap_percentage
+        self.output_layout = output_layout  # 'flat' or 'sharded' (two-level hashed fan-out)
+        if output_mode not in OUTPUT_MODES:
+            raise ValueError(f"Unknown output mode: {output_mode}")
+        self.output_mode = output_mode
+        # Drops resource types / narratives before enrichment; only bundle mode rewrites Synthea's files
+        if resource_filter is not None and output_mode != 'bundle':
+            raise ValueError("A resource filter needs output mode 'bundle'")
+        self.resource_filter = resource_filter
+        if input_format not in INPUT_FORMATS:
+            raise ValueError(f"Unknown input format: {input_format}")
+        if input_format == 'ndjson' and (output_mode == 'sidecar' or resource_filter or content_index or sqlite_index):
+            raise ValueError("NDJSON input supports output modes 'bundle' and 'ndjson' without filter or indexes")
+        self.input_format = input_format
+        # Synthea output packed into tar/zip archives is streamed member by member
+        self.input_archives = find_archives(self.input_dir) if input_format == 'bundle' else []
+        if self.input_archives and parsed_cache:
+            raise ValueError("The parsed cache needs bundle files, not archives")
+        # Patient outputs go into rolling archive shards instead of one file each;
+        # indexes point into the shards, so they need uncompressed tar
+        if output_archive is not None:
+            if output_archive not in ARCHIVE_FORMATS:
+                raise ValueError(f"Unknown archive format: {output_archive}")
+            if output_mode == 'ndjson' or input_format == 'ndjson':
+                raise ValueError("Archive output needs bundle input and output mode 'bundle' or 'sidecar'")
+            if (content_index or sqlite_index) and output_archive != 'tar':
+                raise ValueError("Indexes into archive output need archive format 'tar'")
+        self.output_archive = output_archive
+        self.archive_shard_bytes = archive_shard_bytes
+        # Binary copies of parsed input bundles, so repeat runs skip JSON parsing
+        self.parsed_cache = ParsedBundleCache(self.input_dir) if parsed_cache else None
+        # With a seed, every patient's draws come from their own stream, so a
+        # re-run reproduces each patient regardless of processing order
+        self.seed = seed
+        # Write content_index.bin (per-resource hashes) for corpus_diff.py
+        self.content_index = content_index
+        # Populate resource_index.sqlite (file, byte range, code, value per resource)
+        self.sqlite_index = sqlite_index
+        
+        # Gaussian-copula lab model; None keeps independent per-test draws
+        self.lab_model = CorrelatedLabModel(COMPLETE_HIV_LABS, seed=seed) if correlated_labs else None
+        # ART regimens are chosen from the valid ones given the patient's labs
+        self.regimen_sampler = RegimenSampler(seed=seed)
+        
+        # I/O pipeline: thread counts and bounded queue depths (in bundles)
+        self.reader_threads = reader_threads
+        self.writer_threads = writer_threads
+        self.read_ahead = read_ahead
+        self.write_behind = write_behind
+        self.write_buffer_size = write_buffer_size
+        # Transform stage in up to this many processes (0 keeps it in this
+        # thread), as many at a time as fit in memory_budget_bytes of RSS
+        self.workers = workers
+        self.memory_budget_bytes = memory_budget_bytes
         self.output_dir.mkdir(exist_ok=True, parents=True)
+        self._created_dirs = {self.output_dir}
+    
+    def patient_rng(self, key: str):
+        """Random stream for one patient (the shared module stream when unseeded)"""
+        if self.seed is None:
+            return random
+        return random.Random(f"{self.seed}:{key}")
         
     def generate_medication_statement(self, 
                                      patient_ref: str,
                                      rx_code: str,
                                      medication_name: str,
-                                     start_date: str) -> Dict:
+                                     start_date: str,
+                                     encounter_ref: str = None) -> Dict:
         """Create FHIR MedicationStatement resource"""
-        return {
+        statement = {
             "resourceType": "MedicationStatement",
             "id": str(uuid.uuid4()),
+            "meta": {"tag": [GENERATED_TAG]},
             "status": "active",
             "medicationCodeableConcept": {
                 "coding": [{
@@ -251,6 +568,9 @@ class FHIRPostProcessor:
             "effectivePeriod": {"start": start_date},
             "dateAsserted": start_date
         }
+        if encounter_ref:
+            statement["context"] = {"reference": encounter_ref}
+        return statement
     
     def generate_observation_quantitative(self,
                                          patient_ref: str,
@@ -258,11 +578,13 @@ class FHIRPostProcessor:
                                          display: str,
                                          value: float,
                                          unit: str,
-                                         date: str) -> Dict:
+                                         date: str,
+                                         encounter_ref: str = None) -> Dict:
         """Create quantitative FHIR Observation resource"""
-        return {
+        observation = {
             "resourceType": "Observation",
             "id": str(uuid.uuid4()),
+            "meta": {"tag": [GENERATED_TAG]},
             "status": "final",
             "category": [{
                 "coding": [{
@@ -288,17 +610,22 @@ class FHIRPostProcessor:
                 "code": unit
             }
         }
+        if encounter_ref:
+            observation["encounter"] = {"reference": encounter_ref}
+        return observation
     
     def generate_observation_qualitative(self,
                                         patient_ref: str,
                                         loinc_code: str,
                                         display: str,
                                         value: str,
-                                        date: str) -> Dict:
+                                        date: str,
+                                        encounter_ref: str = None) -> Dict:
         """Create qualitative FHIR Observation resource"""
-        return {
+        observation = {
             "resourceType": "Observation",
             "id": str(uuid.uuid4()),
+            "meta": {"tag": [GENERATED_TAG]},
             "status": "final",
             "category": [{
                 "coding": [{
@@ -319,22 +646,37 @@ class FHIRPostProcessor:
             "issued": date,
             "valueString": value
         }
+        if encounter_ref:
+            observation["encounter"] = {"reference": encounter_ref}
+        return observation
     
-    def generate_complete_lab_panel(self, patient_ref: str, base_date: datetime) -> List[Dict]:
+    def generate_complete_lab_panel(self,
+                                    patient_ref: str,
+                                    base_date: datetime,
+                                    age: float = DEFAULT_AGE,
+                                    female: bool = False,
+                                    encounter_ref: str = None,
+                                    rng=random) -> List[Dict]:
         """Generate complete lab panel per DHHS guidelines"""
         observations = []
         
         # Determine viral suppression status (85% undetectable per ADAP outcomes)
-        vl_status = random.choices(
+        vl_status = rng.choices(
             ['undetectable', 'suppressed', 'detectable'],
             weights=[0.85, 0.10, 0.05]
         )[0]
         
+        # Jointly sampled quantitative values (None = independent draws below)
+        correlated = None
+        if self.lab_model is not None:
+            seed = rng.getrandbits(64) if self.seed is not None else None
+            correlated = self.lab_model.draw(vl_status == 'undetectable', age, female, seed=seed)
+        
         # HIV Core Monitoring Labs
         for test_name, test_info in COMPLETE_HIV_LABS.items():
             if test_info.get('result_type') == 'qualitative':
                 # Qualitative test
-                value = random.choices(
+                value = rng.choices(
                     test_info['values'],
                     weights=test_info.get('distribution', [1.0/len(test_info['values'])] * len(test_info['values']))
                 )[0]
@@ -344,21 +686,23 @@ class FHIRPostProcessor:
                     test_info['loinc'],
                     test_info['display'],
                     value,
-                    base_date.isoformat()
+                    base_date.isoformat(),
+                    encounter_ref
                 )
                 observations.append(obs)
                 
                 # If HCV positive, add HCV RNA
                 if test_name == 'hep_c_antibody' and value == 'positive':
                     hcv_rna = COMPLETE_HIV_LABS['hep_c_rna']
-                    hcv_value = random.uniform(*hcv_rna['ranges']['detectable'])
+                    hcv_value = rng.uniform(*hcv_rna['ranges']['detectable'])
                     obs_rna = self.generate_observation_quantitative(
                         patient_ref,
                         hcv_rna['loinc'],
                         hcv_rna['display'],
                         hcv_value,
                         hcv_rna['unit'],
-                        base_date.isoformat()
+                        base_date.isoformat(),
+                        encounter_ref
                     )
                     observations.append(obs_rna)
                     
@@ -367,15 +711,17 @@ class FHIRPostProcessor:
                 # Special handling for HIV VL and CD4 correlation
                 if test_name == 'hiv_viral_load':
                     vl_range = test_info['ranges'][vl_status]
-                    value = random.uniform(*vl_range)
+                    value = rng.uniform(*vl_range)
+                elif correlated is not None and test_name in correlated:
+                    value = correlated[test_name]
                 elif test_name in ['cd4_count', 'cd4_percent']:
                     # Correlate with VL status
-                    cd4_status = 'normal' if vl_status == 'undetectable' else random.choice(['low', 'normal'])
-                    value = random.uniform(*test_info['ranges'][cd4_status])
+                    cd4_status = 'normal' if vl_status == 'undetectable' else rng.choice(['low', 'normal'])
+                    value = rng.uniform(*test_info['ranges'][cd4_status])
                 else:
                     # Random normal or abnormal
-                    range_choice = random.choice(list(test_info['ranges'].keys()))
-                    value = random.uniform(*test_info['ranges'][range_choice])
+                    range_choice = rng.choice(list(test_info['ranges'].keys()))
+                    value = rng.uniform(*test_info['ranges'][range_choice])
                 
                 obs = self.generate_observation_quantitative(
                     patient_ref,
@@ -383,13 +729,14 @@ class FHIRPostProcessor:
                     test_info['display'],
                     round(value, 2),
                     test_info['unit'],
-                    base_date.isoformat()
+                    base_date.isoformat(),
+                    encounter_ref
                 )
                 observations.append(obs)
         
         # Add baseline-only tests
         for test_name, test_info in BASELINE_ONLY_TESTS.items():
-            value = random.choices(
+            value = rng.choices(
                 test_info['values'],
                 weights=test_info.get('distribution', [1.0/len(test_info['values'])] * len(test_info['values']))
             )[0]
@@ -399,115 +746,657 @@ class FHIRPostProcessor:
                 test_info['loinc'],
                 test_info['display'],
                 value,
-                base_date.isoformat()
+                base_date.isoformat(),
+                encounter_ref
             )
             observations.append(obs)
         
         return observations
     
-    def process_patient_bundle(self, bundle_path: Path) -> Dict:
-        """Process a patient bundle and add HIV-related data"""
-        with open(bundle_path, 'r') as f:
-            bundle = json.load(f)
-        
+    def add_hiv_resources(self, bundle: Dict, is_adap: Optional[bool] = None, rng=None) -> List[Dict]:
+        """Add HIV medications and labs to a bundle in place, returning the new entries"""
+        rng = rng or random
         # Determine if this patient is in ADAP
-        is_adap = random.random() < self.adap_percentage
+        if is_adap is None:
+            is_adap = rng.random() < self.adap_percentage
         
         if not is_adap:
-            return bundle
+            return []
         
-        # Find patient resource
+        # Find patient resource and index encounters in the same pass
         patient_resource = None
-        patient_ref = None
+        encounters = EncounterIndex()
         for entry in bundle.get('entry', []):
-            if entry['resource']['resourceType'] == 'Patient':
-                patient_resource = entry['resource']
-                patient_ref = f"Patient/{patient_resource['id']}"
-                break
+            resource = entry['resource']
+            if resource['resourceType'] == 'Patient' and patient_resource is None:
+                patient_resource = resource
+            elif resource['resourceType'] == 'Encounter':
+                encounters.add(resource)
         
         if not patient_resource:
-            return bundle
+            return []
+        
+        # Target dates, snapped to the nearest real encounter when there is one
+        base_date, med_start_date = self.draw_target_dates(rng)
+        lab_encounter = med_encounter = None
+        if encounters:
+            lab_encounter, base_date = encounters.nearest(base_date)
+            med_encounter, med_start_date = encounters.nearest(med_start_date)
+        
+        new_entries = self.generate_hiv_entries(patient_resource, base_date, med_start_date,
+                                                lab_encounter, med_encounter, rng)
+        bundle.setdefault('entry', []).extend(new_entries)
+        return new_entries
+    
+    @staticmethod
+    def draw_target_dates(rng) -> Tuple[datetime, datetime]:
+        """(lab date, ART start date) to anchor a patient's generated resources near"""
+        base_date = datetime.now() - timedelta(days=rng.randint(0, 180))  # Recent labs
+        med_start_date = datetime.now() - timedelta(days=rng.randint(365, 1825))  # 1-5 years on ART
+        return base_date.astimezone(), med_start_date.astimezone()
+    
+    def generate_hiv_entries(self,
+                             patient_resource: Dict,
+                             base_date: datetime,
+                             med_start_date: datetime,
+                             lab_encounter: Optional[str],
+                             med_encounter: Optional[str],
+                             rng) -> List[Dict]:
+        """Regimen and lab panel entries for one ADAP patient
+        
+        Only the Patient's id, gender and birthDate are read.
+        """
+        patient_ref = f"Patient/{patient_resource['id']}"
+        age = patient_age(patient_resource, base_date)
+        female = patient_resource.get('gender') == 'female'
         
-        # Generate dates
-        base_date = datetime.now() - timedelta(days=random.randint(0, 180))  # Recent labs
-        med_start_date = datetime.now() - timedelta(days=random.randint(365, 1825))  # 1-5 years on ART
+        new_entries = []
+        occurrences = {}
         
-        # Add HIV medications (1-2 per patient)
-        num_meds = random.choice([1, 2])
-        selected_meds = random.sample(list(HIV_MEDICATIONS.items()), num_meds)
+        # Labs first: the regimen depends on HLA-B*57:01, HBsAg, eGFR and viral load
+        lab_observations = self.generate_complete_lab_panel(patient_ref, base_date, age, female,
+                                                            lab_encounter, rng)
+        regimen = self.regimen_sampler.draw(conditions_from_observations(lab_observations),
+                                            u=rng.random() if self.seed is not None else None)
         
-        for med_name, rx_code in selected_meds:
+        # Add HIV medications (one complete regimen: a single tablet or backbone + anchor)
+        for med_name, rx_code in zip(regimen.medications, regimen.rxnorm):
             med_statement = self.generate_medication_statement(
                 patient_ref,
                 rx_code,
                 med_name,
-                med_start_date.isoformat()
+                med_start_date.isoformat(),
+                med_encounter
             )
-            bundle['entry'].append({
+            med_statement['id'] = self._generated_id(patient_resource['id'], med_statement, occurrences)
+            new_entries.append({
                 'fullUrl': f"urn:uuid:{med_statement['id']}",
                 'resource': med_statement
             })
         
         # Add complete lab panel
-        lab_observations = self.generate_complete_lab_panel(patient_ref, base_date)
         for obs in lab_observations:
-            bundle['entry'].append({
+            obs['id'] = self._generated_id(patient_resource['id'], obs, occurrences)
+            new_entries.append({
                 'fullUrl': f"urn:uuid:{obs['id']}",
                 'resource': obs
             })
         
+        return new_entries
+    
+    @staticmethod
+    def _generated_id(patient_id: str, resource: Dict, occurrences: Dict) -> str:
+        """Stable id for the next generated resource, counting repeated codes"""
+        base = generated_resource_id(patient_id, resource)
+        occurrence = occurrences.get(base, 0)
+        occurrences[base] = occurrence + 1
+        return generated_resource_id(patient_id, resource, occurrence) if occurrence else base
+    
+    def process_patient_bundle(self, bundle_path: Path) -> Dict:
+        """Process a patient bundle and add HIV-related data"""
+        with open(bundle_path, 'r') as f:
+            bundle = json.load(f)
+        
+        if self.resource_filter is not None:
+            self.resource_filter.apply(bundle)
+        self.add_hiv_resources(bundle, rng=self.patient_rng(Path(bundle_path).name))
         return bundle
     
+    def output_path(self, name: str, kind: str = PATIENT) -> Path:
+        """Output path for a bundle, creating its shard directory if needed
+        
+        With archive output a patient's path only names its archive member.
+        """
+        output_file = output_path_for(self.output_dir, name, self.output_layout, kind)
+        if self.output_archive is not None and kind == PATIENT:
+            return output_file
+        parent = output_file.parent
+        if parent not in self._created_dirs:
+            parent.mkdir(parents=True, exist_ok=True)
+            self._created_dirs.add(parent)
+        return output_file
+    
+    def serialize_patch(self, new_entries: List[Dict]) -> Tuple[bytes, List[Tuple[int, int]]]:
+        """Serialize added entries as a compact transaction Bundle (sidecar mode)
+        
+        Returns the bytes and the byte range of every entry in them.
+        """
+        prefix = b'{"resourceType":"Bundle","type":"transaction","entry":['
+        chunks = [prefix]
+        position = len(prefix)
+        spans = []
+        for i, entry in enumerate(new_entries):
+            if i:
+                chunks.append(b',')
+                position += 1
+            data = json.dumps(
+                dict(entry, request={"method": "POST", "url": entry['resource']['resourceType']}),
+                separators=(',', ':')
+            ).encode('utf-8')
+            spans.append((position, len(data)))
+            chunks.append(data)
+            position += len(data)
+        chunks.append(b']}')
+        return b''.join(chunks), spans
+    
+    def _index_data(self, resources: List[Dict], spans: List[Tuple[int, int]]) -> Tuple[Optional[List], Optional[List]]:
+        """Content-index records and SQLite spans for the resources being written"""
+        records = index_records(resources) if self.content_index else None
+        spans = [(resource, offset, length) for resource, (offset, length) in zip(resources, spans)] \
+            if self.sqlite_index else None
+        return records, spans
+    
+    def _parse(self, bundle_file: BundleFile, data, summary: bool = False) -> Dict:
+        """Parsed patient bundle from its bytes or its parsed-cache record
+        
+        summary=True allows the cache's Patient/Encounter skeleton instead.
+        """
+        if isinstance(data, CachedBundle):
+            return decode_summary(data) if summary else decode_bundle(data)
+        bundle = json.loads(data)
+        if self.parsed_cache is not None:
+            self.parsed_cache.write(bundle_file, data, bundle)
+        return bundle
+    
+    def transform_bundle(self, bundle_file: BundleFile, data) -> Transformed:
+        """Transform stage: enrich one bundle read by the reader stage"""
+        indexing = self.content_index or self.sqlite_index
+        
+        # Hospital and practitioner bundles carry no patient; pass them through as-is
+        if bundle_file.kind != PATIENT:
+            if self.output_mode != 'bundle':
+                return SKIPPED
+            output_file = self.output_path(bundle_file.name, bundle_file.kind)
+            if not indexing and self.resource_filter is None:
+                return Transformed(output_file, data, [])
+            bundle = json.loads(data)
+            if self.resource_filter is not None:
+                self.resource_filter.apply(bundle)
+                if not indexing:
+                    return Transformed(output_file, json.dumps(bundle, indent=2).encode('utf-8'), [])
+            if self.sqlite_index:
+                data, spans = dump_bundle(bundle)  # re-serialized to know entry offsets
+            else:
+                spans = []
+            return Transformed(output_file, data, [],
+                               *self._index_data([e['resource'] for e in bundle.get('entry', [])], spans))
+        
+        rng = self.patient_rng(bundle_file.name)
+        if self.output_mode == 'bundle':
+            bundle = self._parse(bundle_file, data)
+            if self.resource_filter is not None:
+                self.resource_filter.apply(bundle)
+            new_entries = self.add_hiv_resources(bundle, rng=rng)
+            output_file = self.output_path(bundle_file.name)
+            if not indexing:
+                return Transformed(output_file, json.dumps(bundle, indent=2).encode('utf-8'), new_entries)
+            if self.sqlite_index:
+                data, spans = dump_bundle(bundle)
+            else:
+                data, spans = json.dumps(bundle, indent=2).encode('utf-8'), []
+            return Transformed(output_file, data, new_entries,
+                               *self._index_data([e['resource'] for e in bundle.get('entry', [])], spans))
+        
+        # Patch modes leave Synthea's file untouched, so non-ADAP patients are
+        # decided before paying for the JSON parse
+        if rng.random() >= self.adap_percentage:
+            return SKIPPED
+        new_entries = self.add_hiv_resources(self._parse(bundle_file, data, summary=True), is_adap=True, rng=rng)
+        if not new_entries:
+            return SKIPPED
+        resources = [entry['resource'] for entry in new_entries]
+        
+        if self.output_mode == 'sidecar':
+            data, spans = self.serialize_patch(new_entries)
+            return Transformed(self.output_path(sidecar_name(bundle_file.name)), data, new_entries,
+                               *self._index_data(resources, spans))
+        
+        lines = [json.dumps(resource, separators=(',', ':')).encode('utf-8') + b'\n' for resource in resources]
+        spans = []
+        position = 0
+        for line in lines:
+            spans.append((position, len(line) - 1))
+            position += len(line)
+        return Transformed(self.output_dir / NDJSON_PATCH_FILE, b''.join(lines), new_entries,
+                           *self._index_data(resources, spans))
+    
+    def _run_stage(self, worker: Callable, errors: List[BaseException], stop: threading.Event):
+        """Run a pipeline thread body, recording failures and stopping the pipeline"""
+        try:
+            worker()
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+    
+    @staticmethod
+    def _put(q: queue.Queue, item, stop: threading.Event):
+        """Blocking put that gives up once the pipeline is stopping"""
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+    
+    @staticmethod
+    def _get(q: queue.Queue, stop: threading.Event):
+        """Blocking get that returns the sentinel once the pipeline is stopping"""
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _SENTINEL
+    
+    def process_ndjson_input(self):
+        """Process Synthea bulk-data NDJSON (one <ResourceType>.ndjson per type)
+        
+        Patient.ndjson is streamed once to pick the ADAP patients and draw
+        their target dates, then Encounter.ndjson once, keeping only the
+        encounter nearest each target. No per-patient document is built.
+        In 'bundle' output mode Synthea's files are copied and the generated
+        resources appended to the per-type files; in 'ndjson' mode only the
+        generated resources are written, to hiv_resources.ndjson.
+        """
+        print(f"Processing bulk NDJSON from {self.input_dir}...")
+        
+        patient_count = 0
+        targets: Dict[str, EncounterTargets] = {}
+        with open(self.input_dir / 'Patient.ndjson', 'rb') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                patient = json.loads(line)
+                patient_count += 1
+                # Draws after the encounter pass come from the patient's second stream
+                rng = self.patient_rng(patient['id'])
+                if rng.random() < self.adap_percentage:
+                    minimal = {key: patient[key] for key in ('id', 'gender', 'birthDate') if key in patient}
+                    targets[patient['id']] = EncounterTargets(minimal, self.draw_target_dates(rng))
+        
+        encounter_path = self.input_dir / 'Encounter.ndjson'
+        if encounter_path.exists():
+            with open(encounter_path, 'rb') as f:
+                for line in f:
+                    match = _BULK_SUBJECT.search(line)
+                    if match is not None and match.group(1).decode('utf-8') not in targets:
+                        continue  # not an ADAP patient: skip without parsing
+                    if not line.strip():
+                        continue
+                    encounter = json.loads(line)
+                    subject = encounter.get('subject', {}).get('reference', '')
+                    tracked = targets.get(subject.rsplit('/', 1)[-1].rsplit(':', 1)[-1])
+                    if tracked is not None:
+                        tracked.add(encounter)
+        
+        copied = set()
+        if self.output_mode == 'bundle':
+            for ndjson_file in scan_bundle_files(self.input_dir, suffix='.ndjson'):
+                shutil.copyfile(ndjson_file.path, self.output_dir / ndjson_file.name)
+                copied.add(ndjson_file.name)
+        
+        streams = {}
+        total_meds = 0
+        total_labs = 0
+        try:
+            for patient_id, tracked in targets.items():
+                rng = self.patient_rng(f"{patient_id}:resources") if self.seed is not None else random
+                lab_encounter, base_date = tracked.nearest(0)
+                med_encounter, med_start_date = tracked.nearest(1)
+                new_entries = self.generate_hiv_entries(tracked.patient, base_date, med_start_date,
+                                                        lab_encounter, med_encounter, rng)
+                for entry in new_entries:
+                    resource = entry['resource']
+                    name = NDJSON_PATCH_FILE if self.output_mode == 'ndjson' else f"{resource['resourceType']}.ndjson"
+                    if name not in streams:
+                        mode = 'ab' if name in copied else 'wb'
+                        streams[name] = open(self.output_dir / name, mode, buffering=self.write_buffer_size)
+                    streams[name].write(json.dumps(resource, separators=(',', ':')).encode('utf-8') + b'\n')
+                    if resource['resourceType'] == 'MedicationStatement':
+                        total_meds += 1
+                    else:
+                        total_labs += 1
+        finally:
+            for stream in streams.values():
+                stream.close()
+        
+        adap_count = len(targets)
+        print(f"\n✅ Processed {patient_count} patients")
+        print(f"   ADAP patients: {adap_count} ({adap_count/max(patient_count, 1)*100:.1f}%)")
+        print(f"   Total medications added: {total_meds}")
+        print(f"   Total lab observations added: {total_labs}")
+        print(f"   Average labs per ADAP patient: {total_labs/max(adap_count, 1):.0f}")
+        print(f"\n📁 Output saved to: {self.output_dir}")
+    
     def process_all_bundles(self):
-        """Process all FHIR bundles in input directory"""
-        bundle_files = list(self.input_dir.glob("*.json"))
-        print(f"Processing {len(bundle_files)} patient bundles...")
+        """Process all FHIR bundles in input directory
+        
+        Runs as a staged pipeline over bounded queues: reader threads prefetch
+        upcoming bundles, this thread enriches them, and writer threads flush
+        finished outputs, so disk and CPU stay busy together while memory is
+        bounded by the queue depths.
+        
+        Work moves through the pipeline as tasks (lists of bundles). In process
+        mode the tasks come from schedule_bundles: largest bundles first, small
+        ones batched, so no worker is left with a huge bundle at the end. The
+        read-ahead queues count the bundles in their tasks, so the depths
+        stay in bundles whatever the batching.
+        """
+        if self.input_format == 'ndjson':
+            return self.process_ndjson_input()
+        
+        print(f"Processing patient bundles from {self.input_dir}...")
+        
+        pending = BundleQueue(maxsize=self.read_ahead)
+        loaded = BundleQueue(maxsize=self.read_ahead)
+        completed = queue.Queue(maxsize=self.write_behind)
+        stop = threading.Event()
+        errors = []
+        
+        def feed():
+            if self.workers:
+                # Scheduling needs the whole work list and its sizes up front
+                bundle_files = scan_bundle_files(self.input_dir, recursive=True, with_size=True)
+                for task in schedule_bundles(bundle_files, self.workers):
+                    self._put(pending, task, stop)
+            else:
+                for bundle_file in scan_bundle_files(self.input_dir, recursive=True):
+                    self._put(pending, [bundle_file], stop)
+            for _ in range(self.reader_threads):
+                self._put(pending, _SENTINEL, stop)
+        
+        # Archives are streamed in archive order by a single reader, with no extraction
+        def read_archives():
+            try:
+                for item in iter_archives(self.input_archives):
+                    self._put(loaded, [item], stop)
+            finally:
+                self._put(loaded, _SENTINEL, stop)
+        
+        def load(bundle_file: BundleFile):
+            if self.parsed_cache is not None and bundle_file.kind == PATIENT:
+                cached = self.parsed_cache.read(bundle_file)
+                if cached is not None:
+                    return bundle_file, cached
+            with open(bundle_file.path, 'rb') as f:
+                return bundle_file, f.read()
+        
+        def read():
+            try:
+                while True:
+                    task = self._get(pending, stop)
+                    if task is _SENTINEL:
+                        break
+                    self._put(loaded, [load(bundle_file) for bundle_file in task], stop)
+            finally:
+                self._put(loaded, _SENTINEL, stop)
+        
+        # NDJSON patch mode appends every patient to one shared stream
+        ndjson_stream = None
+        ndjson_lock = threading.Lock()
+        if self.output_mode == 'ndjson':
+            ndjson_stream = open(self.output_dir / NDJSON_PATCH_FILE, 'wb', buffering=self.write_buffer_size)
+        
+        # Rolling archive shards take the patient outputs, one member each
+        archive_writer = None
+        if self.output_archive is not None:
+            archive_writer = ArchiveShardWriter(self.output_dir, 'bundles', self.output_archive, self.archive_shard_bytes)
+        
+        # Content index blocks are appended by whichever writer flushed the bundle
+        index_stream = None
+        index_lock = threading.Lock()
+        if self.content_index:
+            index_stream = open_index(self.output_dir / CONTENT_INDEX_FILE)
+        
+        # SQLite rows are inserted by a single indexer thread fed by the writers
+        indexed = queue.Queue(maxsize=self.write_behind)
+        
+        def write():
+            while True:
+                item = self._get(completed, stop)
+                if item is _SENTINEL:
+                    break
+                bundle_file, result = item
+                offset = 0
+                path = result.output_file.relative_to(self.output_dir).as_posix()
+                if ndjson_stream is not None:
+                    with ndjson_lock:
+                        offset = ndjson_stream.tell()
+                        ndjson_stream.write(result.data)
+                elif archive_writer is not None and bundle_file.kind == PATIENT:
+                    path, offset = archive_writer.write(path, result.data)
+                else:
+                    with open(result.output_file, 'wb', buffering=self.write_buffer_size) as f:
+                        f.write(result.data)
+                if index_stream is not None and result.index_records is not None:
+                    block = encode_block(bundle_file.name, path, offset, len(result.data), result.index_records)
+                    with index_lock:
+                        index_stream.write(block)
+                if result.spans is not None:
+                    spans = [(resource, offset + start, length) for resource, start, length in result.spans]
+                    self._put(indexed, (bundle_file.name, path, bundle_file.kind, spans), stop)
         
+        def index():
+            writer = SQLiteIndexWriter(self.output_dir / SQLITE_INDEX_FILE, GENERATED_TAG['system'])
+            try:
+                while True:
+                    item = self._get(indexed, stop)
+                    if item is _SENTINEL:
+                        break
+                    writer.add_bundle(*item)
+            finally:
+                writer.close()
+        
+        if self.input_archives:
+            reader_count = 1
+            threads = [threading.Thread(target=self._run_stage, args=(read_archives, errors, stop), daemon=True)]
+        else:
+            reader_count = self.reader_threads
+            threads = [threading.Thread(target=self._run_stage, args=(feed, errors, stop), daemon=True)]
+            threads += [threading.Thread(target=self._run_stage, args=(read, errors, stop), daemon=True)
+                        for _ in range(self.reader_threads)]
+        writers = [threading.Thread(target=self._run_stage, args=(write, errors, stop), daemon=True)
+                   for _ in range(self.writer_threads)]
+        indexers = []
+        if self.sqlite_index:
+            indexers.append(threading.Thread(target=self._run_stage, args=(index, errors, stop), daemon=True))
+        for thread in threads + writers + indexers:
+            thread.start()
+        
+        bundle_count = 0
         adap_count = 0
         total_meds = 0
         total_labs = 0
         
-        for bundle_file in bundle_files:
-            processed_bundle = self.process_patient_bundle(bundle_file)
+        def finish(bundle_file: BundleFile, result: Transformed):
+            nonlocal bundle_count, adap_count, total_meds, total_labs
+            new_entries = result.new_entries
+            if result.output_file is not None:
+                self._put(completed, (bundle_file, result), stop)
+            bundle_count += 1
             
             # Count resources added
-            has_meds = any(
-                entry['resource'].get('resourceType') == 'MedicationStatement'
-                for entry in processed_bundle.get('entry', [])
-            )
-            if has_meds:
+            if new_entries:
                 adap_count += 1
-            
-            med_count = sum(
-                1 for entry in processed_bundle.get('entry', [])
-                if entry['resource'].get('resourceType') == 'MedicationStatement'
+            total_meds += sum(
+                1 for entry in new_entries
+                if entry['resource']['resourceType'] == 'MedicationStatement'
             )
-            lab_count = sum(
-                1 for entry in processed_bundle.get('entry', [])
-                if entry['resource'].get('resourceType') == 'Observation'
+            total_labs += sum(
+                1 for entry in new_entries
+                if entry['resource']['resourceType'] == 'Observation'
             )
+        
+        # Process mode: tasks run in worker processes, admitted by a memory
+        # budget on the estimated cost of each task and the workers' RSS
+        pool = None
+        budget = None
+        if self.workers:
+            budget = MemoryBudget(self.memory_budget_bytes, self.workers)
+            cost_model = CostModel(BUNDLE_COST_PER_BYTE, min_units=1 << 20)
+            # Spawned, not forked: the pipeline threads are already running
+            pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                       initializer=_init_transform_worker, initargs=(self,))
+            finished = queue.Queue()
+            outstanding = 0
             
-            total_meds += med_count
-            total_labs += lab_count
+            def done(size, cost, future):
+                budget.release(cost)
+                if future.exception() is None:
+                    _, pid, rss, growth = future.result()
+                    budget.report(pid, rss)
+                    cost_model.observe(size, growth)
+                finished.put(future)
             
-            output_file = self.output_dir / bundle_file.name
-            with open(output_file, 'w') as f:
-                json.dump(processed_bundle, f, indent=2)
+            def collect(block: bool):
+                nonlocal outstanding
+                while outstanding:
+                    try:
+                        future = finished.get(timeout=0.1) if block else finished.get_nowait()
+                    except queue.Empty:
+                        if block and not stop.is_set():
+                            continue
+                        return
+                    outstanding -= 1
+                    for bundle_file, result in future.result()[0]:
+                        finish(bundle_file, result)
+        
+        try:
+            readers_done = 0
+            while readers_done < reader_count and not stop.is_set():
+                item = self._get(loaded, stop)
+                if item is _SENTINEL:
+                    readers_done += 1
+                    continue
+                
+                if pool is None:
+                    for bundle_file, data in item:
+                        finish(bundle_file, self.transform_bundle(bundle_file, data))
+                    continue
+                
+                size = sum(len(data.record) if isinstance(data, CachedBundle) else len(data) for _, data in item)
+                cost = cost_model.estimate(size)
+                budget.report(os.getpid(), process_rss())
+                if not budget.acquire(cost, stop):
+                    break
+                outstanding += 1
+                future = pool.submit(_transform_in_worker, item)
+                future.add_done_callback(partial(done, size, cost))
+                collect(block=False)
+            if pool is not None:
+                collect(block=True)
+        except BaseException:
+            stop.set()
+            raise
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+            for _ in writers:
+                self._put(completed, _SENTINEL, stop)
+            for thread in threads + writers:
+                thread.join()
+            for _ in indexers:
+                self._put(indexed, _SENTINEL, stop)
+            for thread in indexers:
+                thread.join()
+            if ndjson_stream is not None:
+                ndjson_stream.close()
+            if index_stream is not None:
+                index_stream.close()
+            if archive_writer is not None:
+                archive_writer.close()
+        
+        if errors:
+            raise errors[0]
         
-        print(f"\n✅ Processed {len(bundle_files)} bundles")
-        print(f"   ADAP patients: {adap_count} ({adap_count/len(bundle_files)*100:.1f}%)")
+        print(f"\n✅ Processed {bundle_count} bundles")
+        print(f"   ADAP patients: {adap_count} ({adap_count/max(bundle_count, 1)*100:.1f}%)")
         print(f"   Total medications added: {total_meds}")
         print(f"   Total lab observations added: {total_labs}")
-        print(f"   Average labs per ADAP patient: {total_labs/adap_count:.0f}")
+        print(f"   Average labs per ADAP patient: {total_labs/max(adap_count, 1):.0f}")
+        if budget is not None:
+            print(f"   Transform workers: {budget.summary()}")
+        if archive_writer is not None:
+            print(f"   Archive shards: {len(archive_writer.shards)} ({self.output_archive})")
         print(f"\n📁 Output saved to: {self.output_dir}")
 
 
+# Post-processor copy used by each transform worker process
+_worker_processor = None
+
+
+def _init_transform_worker(processor: FHIRPostProcessor):
+    global _worker_processor
+    if processor.seed is None:
+        # Forked workers inherit the parent's random state; give each its own
+        random.seed()
+        if processor.lab_model is not None:
+            processor.lab_model = CorrelatedLabModel(COMPLETE_HIV_LABS)
+        processor.regimen_sampler = RegimenSampler()
+    _worker_processor = processor
+
+
+def _transform_in_worker(task: List[Tuple[BundleFile, bytes]]) -> Tuple[List[Tuple[BundleFile, Transformed]], int, int, int]:
+    """(results, worker pid, worker RSS after, RSS growth during the task)"""
+    before = process_rss()
+    results = [(bundle_file, _worker_processor.transform_bundle(bundle_file, data)) for bundle_file, data in task]
+    after = process_rss()
+    return results, os.getpid(), after, after - before
+
+
 def main():
     """Main execution"""
     output_path = os.getenv('PROCESSED_FHIR_DIR', './processed_fhir')
+    input_dir = os.path.join(output_path, 'fhir')
+    # Synthea's bulk-data export (SYNTHEA_BULK_DATA=true) is detected by its Patient.ndjson
+    input_format = os.getenv('INPUT_FORMAT') or (
+        'ndjson' if os.path.exists(os.path.join(input_dir, 'Patient.ndjson')) else 'bundle')
+    
+    # Optional shrinking pass, e.g. FILTER_DENY_TYPES=Claim,ExplanationOfBenefit STRIP_NARRATIVE=true
+    resource_filter = None
+    if any(os.getenv(name) for name in ('FILTER_ALLOW_TYPES', 'FILTER_DENY_TYPES', 'STRIP_NARRATIVE', 'STRIP_ELEMENTS')):
+        resource_filter = ResourceFilter(
+            allow=parse_types(os.getenv('FILTER_ALLOW_TYPES')),
+            deny=parse_types(os.getenv('FILTER_DENY_TYPES')),
+            strip_narrative=os.getenv('STRIP_NARRATIVE', 'false').lower() == 'true',
+            strip_elements=parse_elements(os.getenv('STRIP_ELEMENTS', '').split(',') if os.getenv('STRIP_ELEMENTS') else [])
+        )
+    
     processor = FHIRPostProcessor(
-        input_dir=os.path.join(output_path, 'fhir'),
-        adap_percentage=0.5  # 50% of patients in ADAP program
+        input_dir=input_dir,
+        adap_percentage=0.5,  # 50% of patients in ADAP program
+        output_layout=os.getenv('OUTPUT_LAYOUT', 'flat'),  # 'sharded' for very large populations
+        output_mode=os.getenv('OUTPUT_MODE', 'bundle'),  # 'sidecar' or 'ndjson' to write only added resources
+        seed=int(os.getenv('POST_PROCESSOR_SEED')) if os.getenv('POST_PROCESSOR_SEED') else None,
+        content_index=os.getenv('CONTENT_INDEX', 'false').lower() == 'true',  # for corpus_diff.py
+        sqlite_index=os.getenv('SQLITE_INDEX', 'false').lower() == 'true',  # for sqlite_index.py queries
+        workers=int(os.getenv('POST_PROCESSOR_WORKERS', '0')),  # transform processes (0: in-process)
+        memory_budget_bytes=int(float(os.getenv('MEMORY_BUDGET_GB')) * 1024**3) if os.getenv('MEMORY_BUDGET_GB') else None,
+        resource_filter=resource_filter,
+        input_format=input_format,
+        parsed_cache=os.getenv('PARSED_CACHE', 'false').lower() == 'true',  # skip JSON parsing on repeat runs
+        output_archive=os.getenv('OUTPUT_ARCHIVE') or None,  # 'tar', 'tar.gz' or 'zip' shards instead of files
+        archive_shard_bytes=int(float(os.getenv('ARCHIVE_SHARD_MB', '1024')) * 1024**2)
     )
 
     processor.process_all_bundles()
@@ -0,0 +1,163 @@
+"""
+Date Re-Baselining
+Moves a cached population forward in time instead of regenerating it.
+Synthea dates are relative to its run date and the post-processor's dates to
+the processing date, so a corpus goes stale; this shifts every FHIR date,
+dateTime and instant (and so every Period) by a whole number of days, either
+a fixed delta or whatever moves the corpus's latest date to a new reference
+date.
+
+Files are rewritten as raw bytes: a single regex pass over each file
+replaces JSON string values of the form YYYY-MM-DD[Thh:mm:ss[.fff][zone]],
+keeping the time of day, precision and zone offset. A shifted value has the
+same length as the original, so byte offsets recorded in
+resource_index.sqlite stay valid. Partial dates (YYYY, YYYY-MM) are left
+alone; Synthea and the post-processor do not write them and they cannot be
+told apart from codes. Files are processed in parallel worker processes.
+"""
+
+import argparse
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, timedelta
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+from dotenv import load_dotenv
+
+from content_index import CONTENT_INDEX_FILE
+from fhir_archive import reject_archives
+from fhir_files import scan_bundle_files
+from sqlite_index import SQLITE_INDEX_FILE
+
+load_dotenv()
+
+# A whole JSON string value holding a full date, optionally with a time part
+_DATE_VALUE = re.compile(rb'"(\d{4}-\d{2}-\d{2})(T\d{2}:\d{2}:\d{2}(?:\.\d+)?(?:Z|[+-]\d{2}:\d{2})?)?"')
+
+
+@lru_cache(maxsize=65536)
+def shift_day(day: bytes, days: int) -> bytes:
+    """b'YYYY-MM-DD' moved by a number of days"""
+    return (date.fromisoformat(day.decode('ascii')) + timedelta(days=days)).isoformat().encode('ascii')
+
+
+def shift_dates(data: bytes, days: int) -> Tuple[bytes, int]:
+    """(shifted data, number of values shifted)"""
+    def replace(match):
+        return b'"' + shift_day(match.group(1), days) + (match.group(2) or b'') + b'"'
+    return _DATE_VALUE.subn(replace, data)
+
+
+def latest_date(path: str) -> Optional[str]:
+    """Latest full date (YYYY-MM-DD) in a file, or None"""
+    with open(path, 'rb') as f:
+        days = [match.group(1) for match in _DATE_VALUE.finditer(f.read())]
+    return max(days).decode('ascii') if days else None
+
+
+def rebaseline_file(task: Tuple[str, str, int]) -> int:
+    """Shift one file into target (which may be the source itself)"""
+    source, target, days = task
+    with open(source, 'rb') as f:
+        data, count = shift_dates(f.read(), days)
+    target = Path(target)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = target.with_name(f".{target.name}.tmp")
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, target)
+    return count
+
+
+class DateRebaseliner:
+    """Shift all dates in a corpus by a whole number of days"""
+
+    def __init__(self, corpus_dir: str, output_dir: str = None, workers: int = None):
+        self.corpus_dir = Path(corpus_dir)
+        # No output_dir rewrites the corpus in place
+        self.output_dir = Path(output_dir) if output_dir else self.corpus_dir
+        self.workers = workers or os.cpu_count() or 1
+        # Shifting keeps byte offsets only for files rewritten in place
+        reject_archives(self.corpus_dir, 'rebaselining')
+
+    def iter_files(self) -> Iterator[str]:
+        """Bundles (flat or sharded) and NDJSON streams of the corpus"""
+        for bundle_file in scan_bundle_files(self.corpus_dir, recursive=True):
+            yield bundle_file.path
+        for ndjson_file in scan_bundle_files(self.corpus_dir, suffix='.ndjson'):
+            yield ndjson_file.path
+
+    def _map(self, fn, items) -> Iterator:
+        if self.workers <= 1:
+            yield from map(fn, items)
+            return
+        pool = ProcessPoolExecutor(max_workers=self.workers)
+        try:
+            yield from pool.map(fn, items, chunksize=32)
+        finally:
+            pool.shutdown()
+
+    def latest_date(self) -> Optional[date]:
+        """Latest date in the corpus (roughly when it was generated)"""
+        found = [day for day in self._map(latest_date, self.iter_files()) if day]
+        return date.fromisoformat(max(found)) if found else None
+
+    def days_to(self, reference: date, current: date = None, keep_weekday: bool = False) -> int:
+        """Shift that moves current (default: the corpus's latest date) to reference"""
+        current = current or self.latest_date()
+        if current is None:
+            raise ValueError(f"No dates found in {self.corpus_dir}")
+        days = (reference - current).days
+        # Whole weeks keep every encounter on the same day of the week
+        return 7 * round(days / 7) if keep_weekday else days
+
+    def rebaseline(self, days: int) -> Tuple[int, int]:
+        """Shift every file; returns (files, values shifted)"""
+        tasks = (
+            (path, str(self.output_dir / os.path.relpath(path, self.corpus_dir)), days)
+            for path in self.iter_files()
+        )
+        files = 0
+        values = 0
+        for count in self._map(rebaseline_file, tasks):
+            files += 1
+            values += count
+        return files, values
+
+    def stale_indexes(self) -> List[str]:
+        """Index files of the corpus that no longer match the shifted output"""
+        return [name for name in (CONTENT_INDEX_FILE, SQLITE_INDEX_FILE) if (self.corpus_dir / name).exists()]
+
+
+def main():
+    """Main execution"""
+    parser = argparse.ArgumentParser(description="Shift every date in a FHIR corpus by a whole number of days")
+    parser.add_argument('corpus_dir', nargs='?', default=os.getenv('PROCESSED_FHIR_DIR', './processed_fhir'))
+    shift = parser.add_mutually_exclusive_group(required=True)
+    shift.add_argument('--days', type=int, help="Fixed shift in days (negative moves dates back)")
+    shift.add_argument('--to-date', type=date.fromisoformat,
+                       help="Move the corpus so that --from-date lands on this date (YYYY-MM-DD)")
+    parser.add_argument('--from-date', type=date.fromisoformat, default=None,
+                        help="Current reference date for --to-date (default: the latest date in the corpus)")
+    parser.add_argument('--keep-weekday', action='store_true', help="Round --to-date shifts to whole weeks")
+    parser.add_argument('--output-dir', default=None, help="Write here instead of rewriting the corpus in place")
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    rebaseliner = DateRebaseliner(args.corpus_dir, args.output_dir, args.workers)
+    days = args.days
+    if days is None:
+        days = rebaseliner.days_to(args.to_date, args.from_date, args.keep_weekday)
+
+    print(f"📅 Shifting dates in {args.corpus_dir} by {days:+d} days")
+    files, values = rebaseliner.rebaseline(days)
+    print(f"✅ {values} dates in {files} files")
+    for name in rebaseliner.stale_indexes():
+        print(f"⚠️  {name} was not shifted; regenerate it with the post-processor if needed")
+    print(f"\n📁 Output saved to: {rebaseliner.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""
+Constraint-Aware ART Regimen Sampler
+Builds every complete regimen the medication catalog allows (single-tablet
+regimens, and an NRTI backbone plus an integrase inhibitor) and tags each
+with a contraindication bitset:
+
+    HLA-B*57:01 positive   -> no abacavir
+    HBsAg positive         -> needs tenofovir + emtricitabine/lamivudine
+    eGFR < 60              -> no tenofovir disoproxil (TDF)
+    eGFR < 30              -> no tenofovir alafenamide (TAF) or cobicistat
+    viral load detectable  -> no long-acting injectable (switch-only)
+
+Patient conditions form a small bitmask, so the valid regimens and their
+cumulative weights are tabulated once per possible mask. Sampling is then a
+table row lookup plus a binary search over uniforms drawn in batches.
+"""
+
+import re
+from typing import Dict, List, NamedTuple, Tuple
+import numpy as np
+
+from medications_and_labs import HIV_MEDICATIONS as HIV_MEDICATION_REFERENCE
+
+
+# Patient condition bits
+HLA_B5701_POSITIVE = 1
+HBV_POSITIVE = 2
+EGFR_BELOW_60 = 4
+EGFR_BELOW_30 = 8
+VIREMIC = 16
+CONDITION_BITS = 5
+
+# Bits dropped, in order, when no regimen satisfies every condition
+# (renal limits become dose adjustments; HLA-B*57:01 is never relaxed)
+RELAXATION_ORDER = [EGFR_BELOW_30, EGFR_BELOW_60, VIREMIC]
+
+# LOINC codes the conditions are read from
+HLA_B5701_LOINC = '13303-3'
+HBSAG_LOINC = '5196-1'
+EGFR_LOINC = '48643-1'
+VIRAL_LOAD_LOINC = '20447-9'
+UNDETECTABLE_VIRAL_LOAD = 20
+
+# Catalog classes that combine into a regimen rather than forming one
+BACKBONE_CLASSES = {'NRTI backbone'}
+ANCHOR_CLASSES = {'Integrase Inhibitor'}
+PARTIAL_CLASSES = BACKBONE_CLASSES | ANCHOR_CLASSES | {'NRTI'}
+
+# A strength such as '50mg', '200 mg/ml' or '1.5 mg / 1 mL'
+_STRENGTH = re.compile(r'\d+(?:\.\d+)?\s*(?:mcg|mg|g|ml)(?:\s*/\s*(?:\d+(?:\.\d+)?\s*)?(?:ml|l))?\b', re.IGNORECASE)
+
+# DHHS recommended initial regimens are prescribed more often than alternatives
+RECOMMENDED_INITIAL = {'biktarvy', 'triumeq', 'dovato', 'descovy+tivicay', 'truvada+tivicay'}
+RECOMMENDED_WEIGHT = 3.0
+
+
+class Regimen(NamedTuple):
+    name: str
+    medications: Tuple[str, ...]
+    rxnorm: Tuple[str, ...]
+    contraindications: int
+    weight: float
+
+
+def ingredients(components: str) -> List[str]:
+    """Ingredient names of a catalog 'components' string (doses stripped)
+
+    Strengths are removed before splitting on the ingredient separator, so a
+    per-volume unit ('200mg/ml') is not read as an ingredient.
+    """
+    names = []
+    for part in _STRENGTH.sub(' ', components).split('/'):
+        words = part.split()
+        if words:
+            names.append(' '.join(words).lower())
+    return names
+
+
+def contraindication_mask(drugs: List[str]) -> int:
+    """Conditions under which a set of ingredients must not be prescribed"""
+    mask = 0
+    if 'abacavir' in drugs:
+        mask |= HLA_B5701_POSITIVE
+    has_tenofovir = any(d.startswith('tenofovir') for d in drugs)
+    if not (has_tenofovir and ('emtricitabine' in drugs or 'lamivudine' in drugs)):
+        mask |= HBV_POSITIVE
+    if 'tenofovir disoproxil fumarate' in drugs:
+        mask |= EGFR_BELOW_60 | EGFR_BELOW_30
+    if 'tenofovir alafenamide' in drugs or 'cobicistat' in drugs:
+        mask |= EGFR_BELOW_30
+    if 'cabotegravir' in drugs:
+        mask |= VIREMIC
+    return mask
+
+
+def build_regimens(catalog: Dict = HIV_MEDICATION_REFERENCE) -> List[Regimen]:
+    """Enumerate complete regimens from the catalog with their contraindications"""
+    drugs = {name: ingredients(info['components']) for name, info in catalog.items()}
+    combinations = [(name,) for name, info in catalog.items() if info['class'] not in PARTIAL_CLASSES]
+    combinations += [
+        (backbone, anchor)
+        for backbone, info in catalog.items() if info['class'] in BACKBONE_CLASSES
+        for anchor, anchor_info in catalog.items() if anchor_info['class'] in ANCHOR_CLASSES
+        if not set(drugs[backbone]) & set(drugs[anchor])  # no duplicated ingredient
+    ]
+    regimens = []
+    for medications in combinations:
+        name = '+'.join(medications)
+        combined = [d for med in medications for d in drugs[med]]
+        weight = RECOMMENDED_WEIGHT if name in RECOMMENDED_INITIAL else 1.0
+        rxnorm = tuple(catalog[med]['rxnorm'] for med in medications)
+        regimens.append(Regimen(name, medications, rxnorm, contraindication_mask(combined), weight))
+    return regimens
+
+
+def patient_conditions(hla_positive: np.ndarray,
+                       hbv_positive: np.ndarray,
+                       egfr: np.ndarray,
+                       viral_load: np.ndarray) -> np.ndarray:
+    """Vectorized condition bitmasks from lab results (NaN eGFR/VL = unknown, not flagged)"""
+    egfr = np.asarray(egfr, dtype=float)
+    viral_load = np.asarray(viral_load, dtype=float)
+    mask = np.where(hla_positive, HLA_B5701_POSITIVE, 0)
+    mask |= np.where(hbv_positive, HBV_POSITIVE, 0)
+    mask |= np.where(egfr < 60, EGFR_BELOW_60, 0)
+    mask |= np.where(egfr < 30, EGFR_BELOW_30, 0)
+    mask |= np.where(viral_load >= UNDETECTABLE_VIRAL_LOAD, VIREMIC, 0)
+    return mask.astype(np.int64)
+
+
+def conditions_from_observations(observations: List[Dict]) -> int:
+    """Condition bitmask of one patient's generated Observations"""
+    hla = hbv = False
+    egfr = viral_load = np.nan
+    for obs in observations:
+        code = obs['code']['coding'][0]['code']
+        if code == HLA_B5701_LOINC:
+            hla = obs.get('valueString') == 'positive'
+        elif code == HBSAG_LOINC:
+            hbv = obs.get('valueString') == 'positive'
+        elif code == EGFR_LOINC:
+            egfr = obs['valueQuantity']['value']
+        elif code == VIRAL_LOAD_LOINC:
+            viral_load = obs['valueQuantity']['value']
+    return int(patient_conditions(hla, hbv, egfr, viral_load))
+
+
+class RegimenSampler:
+    """Samples valid regimens conditioned on patient condition bitmasks"""
+
+    def __init__(self,
+                 regimens: List[Regimen] = None,
+                 batch_size: int = 4096,
+                 seed: int = None):
+        self.regimens = regimens if regimens is not None else build_regimens()
+        self.rng = np.random.default_rng(seed)
+        self.batch_size = batch_size
+
+        contraindications = np.array([r.contraindications for r in self.regimens], dtype=np.int64)
+        weights = np.array([r.weight for r in self.regimens], dtype=float)
+
+        # One row of cumulative weights per possible condition mask
+        self.cumulative = np.zeros((1 << CONDITION_BITS, len(self.regimens)))
+        for state in range(1 << CONDITION_BITS):
+            relaxed = state
+            valid = (contraindications & relaxed) == 0
+            for bit in RELAXATION_ORDER:
+                if valid.any():
+                    break
+                relaxed &= ~bit
+                valid = (contraindications & relaxed) == 0
+            if not valid.any():
+                valid = (contraindications & state & HLA_B5701_POSITIVE) == 0
+            self.cumulative[state] = np.cumsum(np.where(valid, weights, 0.0))
+        self._uniforms = None
+        self._position = 0
+
+    def sample(self, conditions: np.ndarray) -> np.ndarray:
+        """Vectorized regimen indices for an array of condition bitmasks"""
+        rows = self.cumulative[np.asarray(conditions, dtype=np.int64)]
+        u = self.rng.random(len(rows)) * rows[:, -1]
+        return (rows <= u[:, None]).sum(axis=1)
+
+    def draw(self, conditions: int, u: float = None) -> Regimen:
+        """One patient's regimen, using a pre-sampled batch of uniforms (or u)"""
+        if u is None:
+            if self._uniforms is None or self._position >= self.batch_size:
+                self._uniforms = self.rng.random(self.batch_size)
+                self._position = 0
+            u = self._uniforms[self._position]
+            self._position += 1
+        row = self.cumulative[conditions]
+        return self.regimens[int(np.searchsorted(row, u * row[-1], side='right'))]
@@ -0,0 +1,127 @@
+"""
+Resource Filter for Synthea Bundles
+Shrinks bundles before they are enriched and written: drops resource types
+by an allow or deny list, strips text.div narratives and removes chosen
+elements (e.g. 'Claim.item', '*.meta'). Everything downstream (the
+post-processor's serialization, indexes, validation, upload) then handles
+less data.
+
+References stay consistent. A reference to a dropped resource is removed
+from the resource holding it (a list item, or the element itself). If that
+leaves a resource without its subject/patient/target, that resource is
+dropped too, and the check repeats until nothing else refers to a dropped
+resource. The Patient is never dropped.
+"""
+
+from typing import Dict, Iterable, List, Optional, Set
+
+# Top-level reference elements without which a resource is meaningless
+ANCHOR_REFERENCES = ('subject', 'patient', 'target')
+
+
+def parse_types(value: Optional[str]) -> Optional[Set[str]]:
+    """'Claim, ExplanationOfBenefit' -> {'Claim', 'ExplanationOfBenefit'} (None if empty)"""
+    types = {part.strip() for part in (value or '').split(',') if part.strip()}
+    return types or None
+
+
+def parse_elements(paths: Iterable[str]) -> Dict[str, List[str]]:
+    """['Claim.item', '*.meta'] -> {'Claim': ['item'], '*': ['meta']}"""
+    elements: Dict[str, List[str]] = {}
+    for path in paths:
+        resource_type, _, element = path.strip().partition('.')
+        if not element:
+            raise ValueError(f"Element path must be Type.element or *.element: {path!r}")
+        elements.setdefault(resource_type, []).append(element)
+    return elements
+
+
+def _prune(node, dropped: Set[str]) -> bool:
+    """Remove references to dropped resources below node, in place
+
+    Returns True if node should be removed from its parent: it is such a
+    reference, or a list/object that pruning left empty.
+    """
+    if isinstance(node, dict):
+        if node.get('reference') in dropped:
+            return True
+        pruned = False
+        for key in [key for key, value in node.items() if isinstance(value, (dict, list))]:
+            if _prune(node[key], dropped):
+                del node[key]
+                pruned = True
+        return pruned and not node
+    if isinstance(node, list) and node:
+        node[:] = [item for item in node if not _prune(item, dropped)]
+        return not node
+    return False
+
+
+class ResourceFilter:
+    """Drop resource types and strip narratives/elements from a bundle, in place"""
+
+    def __init__(self,
+                 allow: Set[str] = None,
+                 deny: Set[str] = None,
+                 strip_narrative: bool = True,
+                 strip_elements: Dict[str, List[str]] = None):
+        if allow is not None and deny is not None:
+            raise ValueError("Give either allowed or denied resource types, not both")
+        self.allow = set(allow) | {'Patient'} if allow is not None else None
+        self.deny = set(deny or ()) - {'Patient'}
+        self.strip_narrative = strip_narrative
+        self.strip_elements = strip_elements or {}
+
+    def keeps(self, resource_type: str) -> bool:
+        if self.allow is not None:
+            return resource_type in self.allow
+        return resource_type not in self.deny
+
+    def _strip(self, resource: Dict):
+        if self.strip_narrative:
+            resource.pop('text', None)
+            for contained in resource.get('contained', []):
+                contained.pop('text', None)
+        for element in self.strip_elements.get('*', []) + self.strip_elements.get(resource.get('resourceType'), []):
+            resource.pop(element, None)
+
+    def apply(self, bundle: Dict) -> int:
+        """Filter a bundle; returns the number of entries dropped"""
+        entries = bundle.get('entry', [])
+        kept = []
+        dropped: Set[str] = set()
+        for entry in entries:
+            resource = entry.get('resource', {})
+            if self.keeps(resource.get('resourceType')):
+                kept.append(entry)
+            else:
+                dropped.update(self._keys(entry))
+
+        while dropped:
+            orphaned = set()
+            remaining = []
+            for entry in kept:
+                resource = entry['resource']
+                anchored = [key for key in ANCHOR_REFERENCES if key in resource]
+                _prune(resource, dropped)
+                if resource.get('resourceType') != 'Patient' and any(key not in resource for key in anchored):
+                    orphaned.update(self._keys(entry))
+                else:
+                    remaining.append(entry)
+            kept = remaining
+            dropped = orphaned
+
+        for entry in kept:
+            self._strip(entry['resource'])
+        if len(kept) != len(entries):
+            bundle['entry'] = kept
+        return len(entries) - len(kept)
+
+    @staticmethod
+    def _keys(entry: Dict) -> List[str]:
+        """Reference strings that may point at an entry's resource"""
+        resource = entry.get('resource', {})
+        keys = [f"{resource.get('resourceType')}/{resource.get('id')}"]
+        if entry.get('fullUrl'):
+            keys.append(entry['fullUrl'])
+        return keys
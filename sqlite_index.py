@@ -0,0 +1,215 @@
+"""
+SQLite Resource Index
+Optional random-access index over a processed corpus, populated by
+FHIRPostProcessor (sqlite_index=True) as it writes. Each resource row records
+the bundle it lives in, its file path and byte range, its resourceType and id,
+the patient, its LOINC/RxNorm/SNOMED code and its value. Lookups such as
+"which file holds patient X" or "all HCV-positive patients" are then indexed
+queries instead of scans over the JSON.
+
+Rows are bulk-inserted in large transactions with WAL journaling; secondary
+indexes are created once at the end of the load.
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SQLITE_INDEX_FILE = 'resource_index.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bundles (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    patient_id TEXT
+);
+CREATE TABLE IF NOT EXISTS resources (
+    bundle_id INTEGER NOT NULL REFERENCES bundles(id),
+    resource_type TEXT NOT NULL,
+    id TEXT,
+    patient_id TEXT,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    code_system TEXT,
+    code TEXT,
+    value_num REAL,
+    value_str TEXT,
+    effective TEXT,
+    generated INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+INDEXES = """
+CREATE INDEX IF NOT EXISTS bundles_patient ON bundles(patient_id);
+CREATE INDEX IF NOT EXISTS bundles_name ON bundles(name);
+CREATE INDEX IF NOT EXISTS resources_patient ON resources(patient_id);
+CREATE INDEX IF NOT EXISTS resources_key ON resources(resource_type, id);
+CREATE INDEX IF NOT EXISTS resources_code ON resources(code, value_str);
+"""
+
+
+def resource_code(resource: Dict) -> Tuple[Optional[str], Optional[str]]:
+    """(system, code) of the resource's first coding (code or medication)"""
+    concept = resource.get('code') or resource.get('medicationCodeableConcept') or {}
+    codings = concept.get('coding') or [{}]
+    return codings[0].get('system'), codings[0].get('code')
+
+
+def resource_value(resource: Dict) -> Tuple[Optional[float], Optional[str]]:
+    """(numeric, string) value of an Observation-like resource"""
+    if 'valueQuantity' in resource:
+        return resource['valueQuantity'].get('value'), None
+    if 'valueString' in resource:
+        return None, resource['valueString']
+    if 'valueCodeableConcept' in resource:
+        codings = resource['valueCodeableConcept'].get('coding') or [{}]
+        return None, codings[0].get('code') or resource['valueCodeableConcept'].get('text')
+    return None, None
+
+
+def resource_effective(resource: Dict) -> Optional[str]:
+    return (resource.get('effectiveDateTime')
+            or resource.get('effectivePeriod', {}).get('start')
+            or resource.get('period', {}).get('start'))
+
+
+def has_tag(resource: Dict, system: str) -> bool:
+    return any(tag.get('system') == system for tag in resource.get('meta', {}).get('tag', []))
+
+
+def connect(path, create: bool = False) -> sqlite3.Connection:
+    """Open an index database in WAL mode (create=True starts a fresh one)"""
+    path = Path(path)
+    if create:
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.unlink(f"{path}{suffix}")
+            except FileNotFoundError:
+                pass
+    # Autocommit at the driver level; the writer manages its own transactions
+    conn = sqlite3.connect(str(path), isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    if create:
+        conn.executescript(SCHEMA)
+    return conn
+
+
+class SQLiteIndexWriter:
+    """Bulk loader used by the post-processor's index stage (single thread)"""
+
+    def __init__(self, path, generated_system: str, batch_rows: int = 50000):
+        self.conn = connect(path, create=True)
+        self.generated_system = generated_system  # meta.tag system of post-processor resources
+        self.batch_rows = batch_rows
+        self._pending = 0
+        self._next_bundle_id = 1
+        self.conn.execute('BEGIN')
+
+    def add_bundle(self,
+                   name: str,
+                   path: str,
+                   kind: str,
+                   spans: List[Tuple[Dict, int, int]]):
+        """Index one written bundle: spans are (resource, byte offset, byte length)"""
+        patient_id = next(
+            (resource.get('id') for resource, _, _ in spans if resource.get('resourceType') == 'Patient'),
+            None
+        )
+        if patient_id is None:
+            # Patch outputs hold no Patient; take it from the subject reference
+            subject = next((r.get('subject', {}).get('reference') for r, _, _ in spans if 'subject' in r), None)
+            if subject and subject.startswith('Patient/'):
+                patient_id = subject[len('Patient/'):]
+        bundle_id = self._next_bundle_id
+        self._next_bundle_id += 1
+        self.conn.execute('INSERT INTO bundles VALUES (?, ?, ?, ?, ?)', (bundle_id, name, path, kind, patient_id))
+        rows = []
+        for resource, offset, length in spans:
+            system, code = resource_code(resource)
+            value_num, value_str = resource_value(resource)
+            rows.append((
+                bundle_id, resource.get('resourceType'), resource.get('id'), patient_id, offset, length,
+                system, code, value_num, value_str, resource_effective(resource),
+                int(has_tag(resource, self.generated_system))
+            ))
+        self.conn.executemany('INSERT INTO resources VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        self._pending += len(rows) + 1
+        if self._pending >= self.batch_rows:
+            self.conn.execute('COMMIT')
+            self.conn.execute('BEGIN')
+            self._pending = 0
+
+    def close(self):
+        self.conn.execute('COMMIT')
+        self.conn.executescript(INDEXES)
+        self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self.conn.close()
+
+
+def read_resource(corpus_dir, path: str, offset: int, length: int) -> Dict:
+    """Load one indexed resource straight from its byte range"""
+    with open(Path(corpus_dir) / path, 'rb') as f:
+        f.seek(offset)
+        obj = json.loads(f.read(length))
+    # Bundle spans cover the whole entry, NDJSON spans the bare resource
+    return obj if 'resourceType' in obj else obj['resource']
+
+
+def patient_bundles(conn: sqlite3.Connection, patient_id: str) -> List[str]:
+    """Output paths holding a patient's resources"""
+    return [row[0] for row in conn.execute(
+        'SELECT DISTINCT path FROM bundles WHERE patient_id = ?', (patient_id,))]
+
+
+def patients_with_result(conn: sqlite3.Connection, code: str, value: str = None) -> Iterator[str]:
+    """Patients with an Observation of a code (optionally with a given string value)"""
+    sql = "SELECT DISTINCT patient_id FROM resources WHERE resource_type = 'Observation' AND code = ?"
+    params = [code]
+    if value is not None:
+        sql += ' AND value_str = ?'
+        params.append(value)
+    for (patient_id,) in conn.execute(sql, params):
+        yield patient_id
+
+
+def main():
+    """Main execution"""
+    parser = argparse.ArgumentParser(description="Query the SQLite resource index of a processed corpus")
+    parser.add_argument('corpus_dir', nargs='?', default=os.getenv('PROCESSED_FHIR_DIR', './processed_fhir'))
+    parser.add_argument('--patient', help="Print the file(s) and resources of a patient")
+    parser.add_argument('--code', help="Patients with an Observation of this LOINC code")
+    parser.add_argument('--value', help="Restrict --code to this result value (e.g. positive)")
+    parser.add_argument('--sql', help="Run an arbitrary read-only query")
+    args = parser.parse_args()
+
+    conn = connect(Path(args.corpus_dir) / SQLITE_INDEX_FILE)
+    if args.patient:
+        for path in patient_bundles(conn, args.patient):
+            print(f"📁 {path}")
+        for resource_type, count in conn.execute(
+                'SELECT resource_type, COUNT(*) FROM resources WHERE patient_id = ? GROUP BY resource_type',
+                (args.patient,)):
+            print(f"   {resource_type}: {count}")
+    if args.code:
+        count = 0
+        for patient_id in patients_with_result(conn, args.code, args.value):
+            print(patient_id)
+            count += 1
+        print(f"\n✅ {count} patients")
+    if args.sql:
+        for row in conn.execute(args.sql):
+            print('\t'.join('' if v is None else str(v) for v in row))
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+"""
+Stratified Subset Extraction
+Carves a smaller dataset (e.g. 5k dev patients) out of a large processed
+corpus without regenerating it. Patients are stratified by ADAP status,
+sex and viral-load category; one streaming pass keeps a reservoir sample
+per stratum (memory bounded by the subset size, not the corpus), and the
+final per-stratum quotas are proportional to the stratum sizes observed.
+
+Selected bundles are copied byte-for-byte. A post-processor NDJSON patch
+stream (hiv_resources.ndjson), whose lines are written one patient at a
+time, is sampled the same way by contiguous patient line groups and copied
+line-for-line.
+
+Sidecar patches and NDJSON patch lines hold no Patient resource, so their
+sex is read from the Synthea output they apply to (base_dir: the base
+bundles, or Patient.ndjson of a bulk-data export). Without base_dir these
+patients are stratified with sex 'unknown' and a warning is printed.
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+from collections import Counter
+from functools import partial
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+from dotenv import load_dotenv
+
+from fhir_archive import reject_archives
+from fhir_files import OUTPUT_LAYOUTS, PATCH_SUFFIX, PATIENT, base_bundle_path, output_path_for, scan_bundle_files
+from population_generator import apportion
+from post_processor import COMPLETE_HIV_LABS, GENERATED_TAG, NDJSON_PATCH_FILE
+
+load_dotenv()
+
+
+VIRAL_LOAD_LOINC = COMPLETE_HIV_LABS['hiv_viral_load']['loinc']
+UNDETECTABLE_BELOW = COMPLETE_HIV_LABS['hiv_viral_load']['ranges']['undetectable'][1]
+SUPPRESSED_BELOW = COMPLETE_HIV_LABS['hiv_viral_load']['ranges']['suppressed'][1]
+
+# Patient reference of an NDJSON patch line, read without parsing the line
+_SUBJECT = re.compile(rb'"subject":\{"reference":"Patient/([^"]+)"')
+
+
+def viral_load_category(value: Optional[float]) -> str:
+    if value is None:
+        return 'no_vl'
+    if value < UNDETECTABLE_BELOW:
+        return 'undetectable'
+    return 'suppressed' if value < SUPPRESSED_BELOW else 'detectable'
+
+
+def _is_generated(resource: Dict) -> bool:
+    return any(tag.get('system') == GENERATED_TAG['system'] for tag in resource.get('meta', {}).get('tag', []))
+
+
+def patient_sex(patient: Dict) -> str:
+    return {'male': 'M', 'female': 'F'}.get(patient.get('gender'), 'unknown')
+
+
+def classify_resources(resources: Iterator[Dict], sex: str = 'unknown') -> Tuple[str, str, str]:
+    """(ADAP status, sex, viral-load category) of one patient's resources
+
+    sex is used when the resources hold no Patient (sidecar and NDJSON patches).
+    """
+    adap = False
+    latest = (None, None)  # (effective date, value) of the latest viral load
+    for resource in resources:
+        resource_type = resource.get('resourceType')
+        if resource_type == 'Patient':
+            sex = patient_sex(resource)
+        elif resource_type in ('Observation', 'MedicationStatement') and _is_generated(resource):
+            adap = True
+            codings = resource.get('code', {}).get('coding', [])
+            if codings and codings[0].get('code') == VIRAL_LOAD_LOINC:
+                effective = resource.get('effectiveDateTime', '')
+                if latest[0] is None or effective >= latest[0]:
+                    latest = (effective, resource.get('valueQuantity', {}).get('value'))
+    return ('adap' if adap else 'non_adap'), sex, viral_load_category(latest[1])
+
+
+def base_patient_sex(base_dir: Optional[str], patch_name: str) -> str:
+    """Sex of the Patient in a sidecar's base bundle ('unknown' if not found)"""
+    path = base_bundle_path(base_dir, patch_name) if base_dir else None
+    if path is None:
+        return 'unknown'
+    with open(path, 'rb') as f:
+        bundle = json.loads(f.read())
+    patient = next((entry['resource'] for entry in bundle.get('entry', [])
+                    if entry.get('resource', {}).get('resourceType') == 'Patient'), {})
+    return patient_sex(patient)
+
+
+def classify_file(path: str, base_dir: str = None) -> Tuple[str, Tuple[str, str, str]]:
+    with open(path, 'rb') as f:
+        bundle = json.loads(f.read())
+    sex = base_patient_sex(base_dir, Path(path).name) if path.endswith(PATCH_SUFFIX) else 'unknown'
+    return path, classify_resources((entry.get('resource', {}) for entry in bundle.get('entry', [])), sex)
+
+
+def load_patient_sexes(base_dir: Optional[str]) -> Dict[str, str]:
+    """Patient id -> sex from a bulk-data export's Patient.ndjson (empty if absent)"""
+    path = Path(base_dir) / 'Patient.ndjson' if base_dir else None
+    if path is None or not path.exists():
+        return {}
+    sexes = {}
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                patient = json.loads(line)
+                sexes[patient['id']] = patient_sex(patient)
+    return sexes
+
+
+def iter_patient_groups(path: Path) -> Iterator[Tuple[int, int, List[bytes]]]:
+    """(offset, length, lines) of each contiguous run of one patient's NDJSON lines"""
+    with open(path, 'rb') as f:
+        offset = 0
+        group_start = 0
+        group_patient = None
+        lines = []
+        for line in f:
+            match = _SUBJECT.search(line)
+            patient = match.group(1) if match else group_patient
+            if lines and patient != group_patient:
+                yield group_start, offset - group_start, lines
+                group_start = offset
+                lines = []
+            group_patient = patient
+            lines.append(line)
+            offset += len(line)
+        if lines:
+            yield group_start, offset - group_start, lines
+
+
+class StratifiedReservoir:
+    """Per-stratum reservoir samples (Algorithm R) with proportional final quotas"""
+
+    def __init__(self, target: int, rng: random.Random):
+        self.target = target
+        self.rng = rng
+        self.counts = Counter()
+        self.reservoirs: Dict[Tuple, List] = {}
+
+    def add(self, stratum: Tuple, item):
+        self.counts[stratum] += 1
+        reservoir = self.reservoirs.setdefault(stratum, [])
+        if len(reservoir) < self.target:
+            reservoir.append(item)
+        else:
+            j = self.rng.randrange(self.counts[stratum])
+            if j < self.target:
+                reservoir[j] = item
+
+    def quotas(self) -> Dict[Tuple, int]:
+        if not self.counts:
+            return {}
+        total = min(self.target, sum(self.counts.values()))
+        return apportion(total, dict(self.counts))
+
+    def selection(self) -> Dict[Tuple, List]:
+        """Uniform sample of each stratum's quota from its reservoir"""
+        return {
+            stratum: self.rng.sample(self.reservoirs[stratum], quota)
+            for stratum, quota in self.quotas().items()
+        }
+
+
+class SubsetExtractor:
+    """Stratified, byte-for-byte subset of a processed corpus"""
+
+    def __init__(self,
+                 corpus_dir: str,
+                 output_dir: str,
+                 size: int,
+                 seed: int = None,
+                 workers: int = None,
+                 output_layout: str = 'flat',
+                 base_dir: str = None):
+        self.corpus_dir = Path(corpus_dir)
+        self.output_dir = Path(output_dir)
+        self.size = size
+        self.rng = random.Random(seed)
+        self.workers = workers or os.cpu_count() or 1
+        self.output_layout = output_layout
+        # Synthea output that sidecar/NDJSON patches apply to, for the patients' sex
+        self.base_dir = base_dir
+        # Sidecar/NDJSON patients whose sex could not be found
+        self.unknown_sex = 0
+        # Selected bundles are copied file by file
+        reject_archives(self.corpus_dir, 'subset extraction')
+
+    def sample_bundles(self) -> StratifiedReservoir:
+        reservoir = StratifiedReservoir(self.size, self.rng)
+        paths = (bundle_file.path for bundle_file in
+                 scan_bundle_files(self.corpus_dir, recursive=True, kinds={PATIENT}))
+        with Pool(self.workers) as pool:
+            for path, stratum in pool.imap(partial(classify_file, base_dir=self.base_dir), paths, chunksize=64):
+                if stratum[1] == 'unknown' and path.endswith(PATCH_SUFFIX):
+                    self.unknown_sex += 1
+                reservoir.add(stratum, path)
+        return reservoir
+
+    def sample_ndjson(self, path: Path) -> StratifiedReservoir:
+        reservoir = StratifiedReservoir(self.size, self.rng)
+        sexes = load_patient_sexes(self.base_dir)
+        for offset, length, lines in iter_patient_groups(path):
+            match = _SUBJECT.search(lines[0])
+            sex = sexes.get(match.group(1).decode('utf-8'), 'unknown') if match else 'unknown'
+            stratum = classify_resources((json.loads(line) for line in lines), sex)
+            if stratum[1] == 'unknown':
+                self.unknown_sex += 1
+            reservoir.add(stratum, (offset, length))
+        return reservoir
+
+    def extract(self) -> Dict[Tuple, Tuple[int, int]]:
+        """Copy the subset; returns stratum -> (corpus count, selected count)"""
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        summary = Counter()
+        selected_counts = Counter()
+
+        bundles = self.sample_bundles()
+        for stratum, paths in bundles.selection().items():
+            for path in paths:
+                target = output_path_for(self.output_dir, Path(path).name, self.output_layout)
+                target.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copyfile(path, target)
+            selected_counts[stratum] += len(paths)
+        summary.update(bundles.counts)
+
+        # Hospital/practitioner bundles are shared by all patients: keep them all
+        for bundle_file in scan_bundle_files(self.corpus_dir):
+            if bundle_file.kind != PATIENT:
+                shutil.copyfile(bundle_file.path, self.output_dir / bundle_file.name)
+
+        ndjson_path = self.corpus_dir / NDJSON_PATCH_FILE
+        if ndjson_path.exists():
+            groups = self.sample_ndjson(ndjson_path)
+            ranges = []
+            for stratum, items in groups.selection().items():
+                ranges.extend(items)
+                selected_counts[stratum] += len(items)
+            summary.update(groups.counts)
+            # Keep the original line order; each group is copied as raw bytes
+            with open(ndjson_path, 'rb') as src, open(self.output_dir / NDJSON_PATCH_FILE, 'wb') as dst:
+                for offset, length in sorted(ranges):
+                    src.seek(offset)
+                    dst.write(src.read(length))
+
+        if self.unknown_sex:
+            print(f"⚠️  No sex found for {self.unknown_sex} sidecar/NDJSON patients; they are stratified "
+                  f"as 'unknown' (pass --base-dir with the Synthea output the patches apply to)")
+        return {stratum: (summary[stratum], selected_counts[stratum]) for stratum in summary}
+
+    def print_report(self, result: Dict[Tuple, Tuple[int, int]]):
+        corpus_total = sum(count for count, _ in result.values())
+        selected_total = sum(selected for _, selected in result.values())
+        print(f"\n✂️  Subset of {self.corpus_dir}: {selected_total} of {corpus_total} patients")
+        for stratum in sorted(result):
+            count, selected = result[stratum]
+            print(f"   {'/'.join(stratum):<32} {selected:>7} of {count:>8} "
+                  f"({selected/max(selected_total, 1)*100:5.1f}% vs {count/max(corpus_total, 1)*100:5.1f}%)")
+        print(f"\n📁 Output saved to: {self.output_dir}")
+
+
+def main():
+    """Main execution"""
+    parser = argparse.ArgumentParser(description="Extract a stratified patient subset from a processed corpus")
+    parser.add_argument('corpus_dir', nargs='?', default=os.getenv('PROCESSED_FHIR_DIR', './processed_fhir'))
+    parser.add_argument('--output-dir', required=True)
+    parser.add_argument('--size', type=int, required=True, help="Number of patients in the subset")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--output-layout', choices=OUTPUT_LAYOUTS, default='flat')
+    parser.add_argument('--base-dir', default=None,
+                        help="Synthea output that sidecar/NDJSON patches apply to (for the patients' sex)")
+    args = parser.parse_args()
+
+    extractor = SubsetExtractor(args.corpus_dir, args.output_dir, args.size, args.seed,
+                                args.workers, args.output_layout, args.base_dir)
+    extractor.print_report(extractor.extract())
+
+
+if __name__ == "__main__":
+    main()
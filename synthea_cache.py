@@ -0,0 +1,193 @@
+"""
+Content-Addressed Cache of Synthea Outputs
+Regenerating an identical population costs minutes to hours of JVM time, so
+finished Synthea runs are kept in a cache keyed by the SHA-256 of everything
+that determines their output: the Synthea jar, the command line (seed,
+population size, state/city, age/sex filters, exporter flags) and the
+contents of any module or config files passed to it.
+
+A matching run is materialized by reflinking (copy-on-write) or hard-linking
+the cached bundles into the output directory instead of re-running Java.
+Entries are evicted least-recently-used once the cache exceeds its disk
+budget. Linked bundles share storage with the cache, so Synthea output is
+treated as read-only (the post-processor always writes elsewhere).
+"""
+
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, List, Optional
+
+# Linux FICLONE ioctl (reflink on btrfs/XFS)
+FICLONE = 0x40049409
+
+ENTRY_META = 'entry.json'
+LAST_USED = 'last_used'
+
+# Arguments that only say where output goes, not what is generated
+LOCATION_ARG_PREFIXES = ('--exporter.baseDirectory=',)
+
+
+def hash_file(path: Path, h=None) -> str:
+    """SHA-256 of a file, streamed in 1 MiB blocks"""
+    h = h or hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def hash_tree(root: Path) -> str:
+    """SHA-256 over the relative paths and contents of every file under root"""
+    h = hashlib.sha256()
+    for path in sorted(p for p in Path(root).rglob('*') if p.is_file()):
+        h.update(str(path.relative_to(root)).encode('utf-8') + b'\0')
+        hash_file(path, h)
+    return h.hexdigest()
+
+
+def clone_file(src: str, dst: str):
+    """Reflink src to dst if the filesystem supports it, else hard-link, else copy
+
+    The clone is made under a temporary name and renamed over dst: dst may
+    already be a link to the same cached file, and opening it for writing
+    would truncate the cache entry too.
+    """
+    tmp = os.path.join(os.path.dirname(dst), f".{os.path.basename(dst)}.{uuid.uuid4().hex}")
+    try:
+        try:
+            with open(src, 'rb') as fsrc, open(tmp, 'xb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            try:
+                os.unlink(tmp)
+            except FileNotFoundError:
+                pass
+            try:
+                os.link(src, tmp)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                    raise
+                shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+    finally:
+        # Also left behind when dst was already a link to src (rename is then a no-op)
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+
+
+def clone_tree(src_dir: Path, dst_dir: Path) -> int:
+    """Clone every file of a flat directory; returns the number of bytes"""
+    dst_dir.mkdir(parents=True, exist_ok=True)
+    total = 0
+    with os.scandir(src_dir) as entries:
+        for entry in entries:
+            if entry.is_file(follow_symlinks=False):
+                clone_file(entry.path, str(dst_dir / entry.name))
+                total += entry.stat().st_size
+    return total
+
+
+class SyntheaCache:
+    """LRU, content-addressed store of Synthea FHIR output directories"""
+
+    def __init__(self, cache_dir: str, max_bytes: int = 50 * 1024**3):
+        self.cache_dir = Path(cache_dir)
+        self.entries_dir = self.cache_dir / 'entries'
+        self.max_bytes = max_bytes
+        self.entries_dir.mkdir(parents=True, exist_ok=True)
+        self._jar_hashes = {}
+
+    def jar_hash(self, jar_path: Path) -> str:
+        """Hash of the Synthea jar, memoized by path, size and mtime"""
+        stat = os.stat(jar_path)
+        memo_key = (str(jar_path), stat.st_size, stat.st_mtime_ns)
+        if memo_key not in self._jar_hashes:
+            self._jar_hashes[memo_key] = hash_file(jar_path)
+        return self._jar_hashes[memo_key]
+
+    def key(self, jar_path: Path, cmd: List[str], input_paths: List[Path] = ()) -> str:
+        """Cache key for a Synthea command line and the files it reads"""
+        args = [arg for arg in cmd if not arg.startswith(LOCATION_ARG_PREFIXES)]
+        inputs = {}
+        for path in input_paths:
+            path = Path(path)
+            if path.is_dir():
+                inputs[path.name] = hash_tree(path)
+            elif path.is_file():
+                inputs[path.name] = hash_file(path)
+        # The jar path itself is replaced by its content hash
+        args = ['<jar>' if arg == str(jar_path) else arg for arg in args]
+        material = json.dumps({'jar': self.jar_hash(jar_path), 'args': args, 'inputs': inputs},
+                              sort_keys=True)
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def _entry(self, key: str) -> Path:
+        return self.entries_dir / key
+
+    def lookup(self, key: str) -> Optional[Path]:
+        """Cached FHIR directory for a key (marking it recently used), or None"""
+        entry = self._entry(key)
+        if not (entry / ENTRY_META).exists():
+            return None
+        (entry / LAST_USED).touch()
+        return entry / 'fhir'
+
+    def materialize(self, key: str, target_dir: Path) -> bool:
+        """Link a cached run's bundles into target_dir; False on a cache miss"""
+        cached = self.lookup(key)
+        if cached is None:
+            return False
+        clone_tree(cached, Path(target_dir))
+        return True
+
+    def store(self, key: str, fhir_dir: Path, meta: Dict = None):
+        """Add a finished run's FHIR directory to the cache, then enforce the budget"""
+        if (self._entry(key) / ENTRY_META).exists():
+            return
+        staging = self.cache_dir / f".staging-{uuid.uuid4().hex}"
+        try:
+            size = clone_tree(Path(fhir_dir), staging / 'fhir')
+            with open(staging / ENTRY_META, 'w') as f:
+                json.dump(dict(meta or {}, key=key, bytes=size, created=time.time()), f, indent=2)
+            (staging / LAST_USED).touch()
+            try:
+                os.rename(staging, self._entry(key))
+            except OSError:
+                pass  # a concurrent run stored the same key first
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+        self.evict()
+
+    def entries(self) -> List[Dict]:
+        """All cache entries with their size and last-used time"""
+        entries = []
+        with os.scandir(self.entries_dir) as scanner:
+            for entry in scanner:
+                meta_path = Path(entry.path) / ENTRY_META
+                try:
+                    with open(meta_path) as f:
+                        meta = json.load(f)
+                    last_used = os.stat(Path(entry.path) / LAST_USED).st_mtime
+                except (OSError, ValueError):
+                    continue
+                entries.append({'path': Path(entry.path), 'bytes': meta.get('bytes', 0), 'last_used': last_used})
+        return entries
+
+    def evict(self):
+        """Remove least-recently-used entries until the cache fits its budget"""
+        entries = sorted(self.entries(), key=lambda e: e['last_used'])
+        total = sum(e['bytes'] for e in entries)
+        for entry in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry['path'], ignore_errors=True)
+            total -= entry['bytes']
@@ -0,0 +1,524 @@
+"""
+Synthea Generic Module Builder for HIV Care
+Compiles the ART regimens (regimens.build_regimens), COMPLETE_HIV_LABS,
+BASELINE_ONLY_TESTS and MONITORING_SCHEDULE into a Synthea Generic Module
+Framework (GMF) JSON module, so medications and labs are produced inside the
+Synthea run and the separate post-processing pass can be skipped.
+
+The module is checked offline against GMF_STATE_SCHEMA (state types, required
+fields, transitions and code systems from the GMF documentation) before it is
+handed to Synthea.
+"""
+
+import argparse
+import json
+import os
+import re
+from pathlib import Path
+from typing import Dict, List, Tuple
+from dotenv import load_dotenv
+
+from post_processor import COMPLETE_HIV_LABS, BASELINE_ONLY_TESTS
+from medications_and_labs import HIV_MEDICATIONS as HIV_MEDICATION_REFERENCE, MONITORING_SCHEDULE
+from regimens import (CONDITION_BITS, EGFR_BELOW_60, HBV_POSITIVE, HLA_B5701_POSITIVE, VIREMIC,
+                      RegimenSampler, build_regimens)
+
+load_dotenv()
+
+
+MODULE_NAME = 'HIV Care (Ryan White/ADAP)'
+MODULE_FILE = 'hiv_care.json'
+
+HIV_CONDITION_CODE = {
+    'system': 'SNOMED-CT', 'code': '86406008',
+    'display': 'Human immunodeficiency virus infection (disorder)'
+}
+HIV_ENCOUNTER_CODE = {
+    'system': 'SNOMED-CT', 'code': '185349003',
+    'display': 'Encounter for check up (procedure)'
+}
+
+# SNOMED CT qualifier values for qualitative lab results
+QUALITATIVE_RESULT_CODES = {
+    'negative': ('260385009', 'Negative (qualifier value)'),
+    'positive': ('10828004', 'Positive (qualifier value)'),
+    'nonreactive': ('131194007', 'Non-Reactive (qualifier value)'),
+    'reactive': ('11214006', 'Reactive (qualifier value)'),
+    'indeterminate': ('82334004', 'Indeterminate (qualifier value)')
+}
+
+# MONITORING_SCHEDULE test keys -> COMPLETE_HIV_LABS tests
+MONITORING_TEST_KEYS = {
+    'hiv_viral_load': ['hiv_viral_load'],
+    'cd4_count': ['cd4_count', 'cd4_percent'],
+    'bmp': ['creatinine', 'egfr'],
+    'alt_ast': ['alt', 'ast'],
+    'lipid_panel': ['cholesterol_total', 'hdl', 'ldl', 'triglycerides'],
+    'glucose_fasting': ['glucose_fasting'],
+    'hep_c_antibody': ['hep_c_antibody'],
+    'syphilis_gonorrhea_chlamydia': ['syphilis_rpr']
+}
+
+# Baseline results that constrain the ART regimen, recorded as patient
+# attributes: (test, result label) -> (attribute, regimens.py condition bit).
+# The module's eGFR never falls below 30, so EGFR_BELOW_30 cannot occur.
+REGIMEN_CONDITION_RESULTS = {
+    ('hla_b5701', 'positive'): ('hiv_hla_b5701_positive', HLA_B5701_POSITIVE),
+    ('hep_b_surface_ag', 'positive'): ('hiv_hbv_positive', HBV_POSITIVE),
+    ('egfr', 'reduced'): ('hiv_egfr_below_60', EGFR_BELOW_60),
+    ('hiv_viral_load', 'suppressed'): ('hiv_viremic', VIREMIC),
+    ('hiv_viral_load', 'detectable'): ('hiv_viremic', VIREMIC)
+}
+REGIMEN_CONDITION_ATTRIBUTES = {attribute: bit for attribute, bit in REGIMEN_CONDITION_RESULTS.values()}
+
+# Offline GMF schema: required fields per state type
+GMF_STATE_SCHEMA = {
+    'Initial': {'required': []},
+    'Terminal': {'required': []},
+    'Simple': {'required': []},
+    'Guard': {'required': ['allow']},
+    'Delay': {'one_of': ['exact', 'range']},
+    'SetAttribute': {'required': ['attribute']},
+    'Encounter': {'required': ['encounter_class', 'codes']},
+    'EncounterEnd': {'required': []},
+    'ConditionOnset': {'required': ['codes']},
+    'MedicationOrder': {'required': ['codes']},
+    'Observation': {'required': ['category', 'codes'], 'one_of': ['exact', 'range', 'attribute', 'value_code']},
+}
+GMF_TRANSITIONS = ('direct_transition', 'distributed_transition', 'conditional_transition',
+                   'complex_transition', 'lookup_table_transition')
+GMF_CODE_SYSTEMS = {'SNOMED-CT', 'LOINC', 'RxNorm', 'NUBC', 'DICOM-DCM', 'DICOM-SOP', 'CVX'}
+
+
+class ModuleBuilder:
+    """Incrementally wires GMF states together
+
+    States are appended after the currently "open" states (those still
+    waiting for a transition); forks leave each of their branches open so the
+    following state merges them back together.
+    """
+
+    def __init__(self):
+        self.states = {}
+        self.open = []
+
+    def add(self, name: str, state: Dict, after: List[str] = None) -> str:
+        """Append a state after all open states (or only those in `after`)"""
+        sources = self.open if after is None else [s for s in self.open if s in after]
+        for source in sources:
+            self.states[source]['direct_transition'] = name
+        self.states[name] = state
+        self.open = [s for s in self.open if s not in sources] + [name]
+        return name
+
+    def fork(self,
+             name: str,
+             options: List[Tuple[float, str, Dict]],
+             after: List[str] = None) -> List[str]:
+        """Branch into (weight, state name, state) options by distribution"""
+        transition = {'distributed_transition': [
+            {'distribution': weight, 'transition': target} for weight, target, _ in options
+        ]}
+        return self.branch(name, transition, {target: state for _, target, state in options}, after=after)
+
+    def branch(self,
+               name: str,
+               transition: Dict,
+               targets: Dict[str, Dict],
+               after: List[str] = None) -> List[str]:
+        """Branch into the target states by any GMF transition (e.g. complex_transition)"""
+        self.add(name, {'type': 'Simple'}, after=after)
+        self.open.remove(name)
+        self.states[name].update(transition)
+        branches = []
+        for target, state in targets.items():
+            self.states[target] = state
+            if state['type'] != 'Terminal':
+                branches.append(target)
+        self.open += branches
+        return branches
+
+    def close(self, target: str):
+        """Send every open state to an existing state (e.g. to form a loop)"""
+        for source in self.open:
+            self.states[source]['direct_transition'] = target
+        self.open = []
+
+
+def _observation(test: Dict, **value) -> Dict:
+    state = {
+        'type': 'Observation',
+        'category': 'laboratory',
+        'codes': [{'system': 'LOINC', 'code': test['loinc'], 'display': test['display']}]
+    }
+    if 'unit' in test:
+        state['unit'] = test['unit']
+    state.update(value)
+    return state
+
+
+def _state_name(*parts: str) -> str:
+    return '_'.join(re.sub(r'\W+', '_', p).strip('_').title() for p in parts)
+
+
+def _record_conditions(builder: ModuleBuilder,
+                       prefix: str,
+                       test_name: str,
+                       branches: List[str],
+                       stem: str = None) -> List[str]:
+    """At baseline, set the regimen condition attribute after each flagged result
+    
+    Branches are named <prefix>_<stem>_<result label> (stem defaults to test_name).
+    """
+    if prefix != 'Baseline':
+        return branches
+    recorded = []
+    for branch in branches:
+        label = next((label for (test, label) in REGIMEN_CONDITION_RESULTS
+                      if test == test_name and branch == _state_name(prefix, stem or test_name, label)), None)
+        if label is None:
+            recorded.append(branch)
+            continue
+        attribute, _ = REGIMEN_CONDITION_RESULTS[(test_name, label)]
+        recorded.append(builder.add(_state_name('Set', test_name, label),
+                                    {'type': 'SetAttribute', 'attribute': attribute, 'value': True},
+                                    after=[branch]))
+    return recorded
+
+
+def _add_lab(builder: ModuleBuilder, prefix: str, test_name: str, test: Dict, after: List[str] = None):
+    """Add one lab test: a fork over its qualitative values or quantitative ranges"""
+    if test.get('result_type') == 'qualitative':
+        values = test['values']
+        weights = test.get('distribution', [1.0 / len(values)] * len(values))
+        options = []
+        for value, weight in zip(values, weights):
+            code, display = QUALITATIVE_RESULT_CODES[value]
+            options.append((weight, _state_name(prefix, test_name, value), _observation(
+                test, value_code={'system': 'SNOMED-CT', 'code': code, 'display': display})))
+        return _record_conditions(builder, prefix, test_name,
+                                  builder.fork(_state_name(prefix, test_name), options, after=after))
+
+    ranges = test['ranges']
+    if len(ranges) == 1:
+        (low, high), = ranges.values()
+        return [builder.add(_state_name(prefix, test_name),
+                            _observation(test, range={'low': low, 'high': high}), after=after)]
+    options = [
+        (1.0 / len(ranges), _state_name(prefix, test_name, label), _observation(test, range={'low': low, 'high': high}))
+        for label, (low, high) in ranges.items()
+    ]
+    return _record_conditions(builder, prefix, test_name,
+                              builder.fork(_state_name(prefix, test_name), options, after=after))
+
+
+def _add_viral_load_and_cd4(builder: ModuleBuilder, prefix: str):
+    """Viral load split 85/10/5; CD4 is normal when VL is undetectable"""
+    vl = COMPLETE_HIV_LABS['hiv_viral_load']
+    vl_weights = {'undetectable': 0.85, 'suppressed': 0.10, 'detectable': 0.05}
+    _record_conditions(builder, prefix, 'hiv_viral_load', builder.fork(_state_name(prefix, 'viral_load'), [
+        (vl_weights[status], _state_name(prefix, 'viral_load', status),
+         _observation(vl, range={'low': low, 'high': high}))
+        for status, (low, high) in vl['ranges'].items()
+    ]), stem='viral_load')
+    undetectable = _state_name(prefix, 'viral_load', 'undetectable')
+    detectable = [s for s in builder.open if s != undetectable]
+
+    normal_path = [undetectable]
+    for test_name in ('cd4_count', 'cd4_percent'):
+        test = COMPLETE_HIV_LABS[test_name]
+        low, high = test['ranges']['normal']
+        normal_path = [builder.add(_state_name(prefix, test_name, 'suppressed'),
+                                   _observation(test, range={'low': low, 'high': high}), after=normal_path)]
+        detectable = _add_lab(builder, prefix, test_name, test, after=detectable)
+
+
+def _add_labs(builder: ModuleBuilder, prefix: str, test_names: List[str]):
+    for test_name in test_names:
+        if test_name == 'hiv_viral_load':
+            _add_viral_load_and_cd4(builder, prefix)
+        elif test_name in ('cd4_count', 'cd4_percent', 'hep_c_rna'):
+            continue  # sampled with viral load / HCV antibody
+        elif test_name == 'hep_c_antibody':
+            _add_lab(builder, prefix, test_name, COMPLETE_HIV_LABS[test_name])
+            # HCV RNA only follows a positive antibody
+            builder.add(_state_name(prefix, 'hep_c_rna'),
+                        _observation(COMPLETE_HIV_LABS['hep_c_rna'],
+                                     range=dict(zip(('low', 'high'),
+                                                    COMPLETE_HIV_LABS['hep_c_rna']['ranges']['detectable']))),
+                        after=[_state_name(prefix, 'hep_c_antibody', 'positive')])
+        elif test_name in COMPLETE_HIV_LABS:
+            _add_lab(builder, prefix, test_name, COMPLETE_HIV_LABS[test_name])
+        elif test_name in BASELINE_ONLY_TESTS:
+            _add_lab(builder, prefix, test_name, BASELINE_ONLY_TESTS[test_name])
+
+
+def _attribute_condition(mask: int) -> Dict:
+    """GMF condition matching patients whose regimen condition attributes equal mask"""
+    return {'condition_type': 'And', 'conditions': [
+        {'condition_type': 'Attribute', 'attribute': attribute,
+         'operator': 'is not nil' if mask & bit else 'is nil'}
+        for attribute, bit in REGIMEN_CONDITION_ATTRIBUTES.items()
+    ]}
+
+
+def _add_art_regimen(builder: ModuleBuilder):
+    """Prescribe one complete regimen (regimens.build_regimens) valid for the baseline results
+    
+    Each combination of the recorded condition attributes gets the
+    RegimenSampler's weights for that condition mask (contraindicated
+    regimens weigh zero); each branch orders every medication of its regimen.
+    """
+    sampler = RegimenSampler(build_regimens())
+    checked = 0
+    for bit in REGIMEN_CONDITION_ATTRIBUTES.values():
+        checked |= bit
+    # Condition masks with the same valid weights share one option
+    groups: Dict[Tuple[float, ...], List[int]] = {}
+    for mask in range(1 << CONDITION_BITS):
+        if mask & ~checked:
+            continue
+        row = sampler.cumulative[mask]
+        weights = tuple(float(high - low) for low, high in zip([0.0, *row[:-1]], row))
+        groups.setdefault(weights, []).append(mask)
+
+    options = []
+    for weights, masks in groups.items():
+        total = sum(weights)
+        options.append({
+            'condition': {'condition_type': 'Or', 'conditions': [_attribute_condition(m) for m in masks]},
+            'distributions': [
+                {'distribution': weight / total, 'transition': _state_name('Prescribe', regimen.name)}
+                for regimen, weight in zip(sampler.regimens, weights) if weight > 0
+            ]
+        })
+    del options[-1]['condition']  # the last option is the fallback
+
+    targets = {}
+    for regimen in sampler.regimens:
+        first = regimen.medications[0]
+        targets[_state_name('Prescribe', regimen.name)] = _medication_order(first)
+    branches = builder.branch('ART_Regimen', {'complex_transition': options}, targets)
+    for regimen, branch in zip(sampler.regimens, branches):
+        previous = branch
+        for i, medication in enumerate(regimen.medications[1:], start=2):
+            previous = builder.add(_state_name('Prescribe', regimen.name, str(i)),
+                                   _medication_order(medication), after=[previous])
+
+
+def _medication_order(medication: str) -> Dict:
+    info = HIV_MEDICATION_REFERENCE[medication]
+    return {
+        'type': 'MedicationOrder',
+        'codes': [{'system': 'RxNorm', 'code': info['rxnorm'], 'display': info['name']}],
+        'reason': 'HIV_Diagnosis',
+        'chronic': True
+    }
+
+
+def _monitoring_interval(schedule: Dict) -> Dict:
+    """Parse a MONITORING_SCHEDULE timing ('Every 3-6 months', 'Annually') into a Delay"""
+    timing = schedule.get('timing', '')
+    match = re.search(r'(\d+)\s*-\s*(\d+)\s*(week|month)', timing)
+    if match:
+        return {'range': {'low': int(match.group(1)), 'high': int(match.group(2)), 'unit': match.group(3) + 's'}}
+    return {'exact': {'quantity': 1, 'unit': 'years'}}
+
+
+def _monitoring_window(schedule: Dict) -> Dict:
+    """A MONITORING_SCHEDULE timing as a GMF duration (the upper end of a range)"""
+    interval = _monitoring_interval(schedule)
+    if 'exact' in interval:
+        return dict(interval['exact'])
+    return {'quantity': interval['range']['high'], 'unit': interval['range']['unit']}
+
+
+def _monitoring_tests(schedule: Dict) -> List[str]:
+    tests = []
+    for key in schedule.get('tests', {}):
+        for test_name in MONITORING_TEST_KEYS.get(key, []):
+            if test_name not in tests:
+                tests.append(test_name)
+    return tests
+
+
+def _encounter(reason: str) -> Dict:
+    return {
+        'type': 'Encounter',
+        'encounter_class': 'ambulatory',
+        'reason': reason,
+        'telemedicine_possibility': 'none',
+        'codes': [HIV_ENCOUNTER_CODE]
+    }
+
+
+def build_hiv_module(adap_percentage: float = 0.5, min_age: int = 13) -> Dict:
+    """Compile the HIV medication/lab catalogs into a GMF module"""
+    builder = ModuleBuilder()
+    builder.add('Initial', {'type': 'Initial'})
+    builder.add('Age_Guard', {
+        'type': 'Guard',
+        'allow': {'condition_type': 'Age', 'operator': '>=', 'quantity': min_age, 'unit': 'years'}
+    })
+    builder.fork('ADAP_Enrollment', [
+        (adap_percentage, 'HIV_Diagnosis', {
+            'type': 'ConditionOnset',
+            'target_encounter': 'HIV_Baseline_Encounter',
+            'codes': [HIV_CONDITION_CODE]
+        }),
+        (1 - adap_percentage, 'Terminal', {'type': 'Terminal'})
+    ])
+
+    # Baseline visit: full DHHS panel, baseline-only tests and ART start
+    builder.add('HIV_Baseline_Encounter', _encounter('HIV_Diagnosis'))
+    _add_labs(builder, 'Baseline', list(COMPLETE_HIV_LABS) + list(BASELINE_ONLY_TESTS))
+    _add_art_regimen(builder)
+    builder.add('HIV_Baseline_Encounter_End', {'type': 'EncounterEnd'})
+
+    # Monitoring loop: a visit at the routine cadence; it adds the annual labs
+    # once the annual interval has passed since the last annual (or baseline) visit
+    routine = MONITORING_SCHEDULE['routine_monitoring']
+    annual = MONITORING_SCHEDULE['annual_monitoring']
+    routine_tests = _monitoring_tests(routine)
+    annual_tests = routine_tests + [t for t in _monitoring_tests(annual) if t not in routine_tests]
+
+    builder.add('Routine_Delay', dict({'type': 'Delay'}, **_monitoring_interval(routine)))
+    annual_window = _monitoring_window(annual)
+    builder.branch('Monitoring_Visit', {'conditional_transition': [
+        {'condition': {'condition_type': 'Or', 'conditions': [
+            {'condition_type': 'PriorState', 'name': 'Annual_Encounter', 'within': annual_window},
+            {'condition_type': 'PriorState', 'name': 'HIV_Baseline_Encounter', 'within': annual_window}
+        ]}, 'transition': 'Routine_Encounter'},
+        {'transition': 'Annual_Encounter'}
+    ]}, {
+        'Routine_Encounter': _encounter('HIV_Diagnosis'),
+        'Annual_Encounter': _encounter('HIV_Diagnosis')
+    })
+    for prefix, tests in (('Routine', routine_tests), ('Annual', annual_tests)):
+        builder.open.remove(f'{prefix}_Encounter')
+        others = builder.open
+        builder.open = [f'{prefix}_Encounter']
+        _add_labs(builder, prefix, tests)
+        builder.add(f'{prefix}_Encounter_End', {'type': 'EncounterEnd'})
+        builder.open = others + builder.open
+    builder.close('Routine_Delay')
+
+    return {
+        'name': MODULE_NAME,
+        'remarks': [
+            'Generated by synthea_module.py from the HIV medication and lab catalogs.',
+            'DHHS baseline panel at diagnosis, then monitoring per MONITORING_SCHEDULE.'
+        ],
+        'gmf_version': 2,
+        'states': builder.states
+    }
+
+
+def validate_module(module: Dict) -> List[str]:
+    """Offline check of a module against GMF_STATE_SCHEMA; returns error messages"""
+    errors = []
+    for key in ('name', 'states'):
+        if key not in module:
+            errors.append(f"module missing '{key}'")
+    states = module.get('states', {})
+    if 'Initial' not in states:
+        errors.append("module has no Initial state")
+
+    for name, state in states.items():
+        state_type = state.get('type')
+        schema = GMF_STATE_SCHEMA.get(state_type)
+        if schema is None:
+            errors.append(f"{name}: unknown state type {state_type!r}")
+            continue
+        for field in schema.get('required', []):
+            if field not in state:
+                errors.append(f"{name}: {state_type} missing '{field}'")
+        one_of = schema.get('one_of')
+        if one_of and sum(field in state for field in one_of) != 1:
+            errors.append(f"{name}: {state_type} needs exactly one of {one_of}")
+
+        for code in state.get('codes', []):
+            if code.get('system') not in GMF_CODE_SYSTEMS or not code.get('code') or not code.get('display'):
+                errors.append(f"{name}: invalid code {code}")
+
+        transitions = [t for t in GMF_TRANSITIONS if t in state]
+        if state_type == 'Terminal':
+            if transitions:
+                errors.append(f"{name}: Terminal state has a transition")
+            continue
+        if len(transitions) != 1:
+            errors.append(f"{name}: expected exactly one transition, found {transitions}")
+            continue
+
+        targets = []
+        if 'direct_transition' in state:
+            targets = [state['direct_transition']]
+        elif 'distributed_transition' in state:
+            options = state['distributed_transition']
+            targets = [o['transition'] for o in options]
+            total = sum(o['distribution'] for o in options)
+            if abs(total - 1.0) > 1e-6:
+                errors.append(f"{name}: distributions sum to {total}")
+        elif 'conditional_transition' in state:
+            targets = [o['transition'] for o in state['conditional_transition']]
+        elif 'complex_transition' in state:
+            for option in state['complex_transition']:
+                targets += [d['transition'] for d in option['distributions']]
+                total = sum(d['distribution'] for d in option['distributions'])
+                if abs(total - 1.0) > 1e-6:
+                    errors.append(f"{name}: distributions sum to {total}")
+        for target in targets:
+            if target not in states:
+                errors.append(f"{name}: transition to unknown state {target!r}")
+
+    # Every state must be reachable from Initial
+    reachable, stack = set(), ['Initial'] if 'Initial' in states else []
+    while stack:
+        name = stack.pop()
+        if name in reachable or name not in states:
+            continue
+        reachable.add(name)
+        state = states[name]
+        if 'direct_transition' in state:
+            stack.append(state['direct_transition'])
+        for key in ('distributed_transition', 'conditional_transition'):
+            stack.extend(o['transition'] for o in state.get(key, []))
+        for option in state.get('complex_transition', []):
+            stack.extend(d['transition'] for d in option['distributions'])
+    for name in states:
+        if name not in reachable:
+            errors.append(f"{name}: unreachable from Initial")
+    return errors
+
+
+def write_hiv_module(module_dir: Path, adap_percentage: float = 0.5) -> Path:
+    """Build, validate and write the HIV care module; returns its path"""
+    module = build_hiv_module(adap_percentage=adap_percentage)
+    errors = validate_module(module)
+    if errors:
+        raise ValueError("Invalid HIV care module:\n" + "\n".join(errors))
+
+    module_dir = Path(module_dir)
+    module_dir.mkdir(parents=True, exist_ok=True)
+    module_path = module_dir / MODULE_FILE
+    with open(module_path, 'w') as f:
+        json.dump(module, f, indent=2)
+    return module_path
+
+
+def main():
+    """Main execution"""
+    parser = argparse.ArgumentParser(description="Write the HIV care Synthea module")
+    parser.add_argument('module_dir', nargs='?',
+                        default=os.path.join(os.getenv('PROCESSED_FHIR_DIR', './output_fhir'), 'modules'))
+    parser.add_argument('--adap-percentage', type=float, default=0.5)
+    args = parser.parse_args()
+
+    module_path = write_hiv_module(Path(args.module_dir), adap_percentage=args.adap_percentage)
+    with open(module_path) as f:
+        state_count = len(json.load(f)['states'])
+    print(f"✅ Wrote {module_path} ({state_count} states, GMF schema check passed)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from bundle_schedule import imap_bounded, iter_batches, schedule_bundles
+from fhir_files import PATIENT, BundleFile
+
+
+def test_schedule_covers_every_bundle_largest_first():
+    bundles = [BundleFile(f"/c/{i}.json", f"{i}.json", PATIENT, size) for i, size in enumerate([5, 900, 20, 300, 1])]
+    tasks = schedule_bundles(bundles, workers=2, min_chunk_bytes=0)
+    flat = [bundle for task in tasks for bundle in task]
+    assert sorted(b.name for b in flat) == sorted(b.name for b in bundles)
+    assert flat[0].size == 900
+
+
+def test_iter_batches():
+    assert list(iter_batches(range(5), 2)) == [[0, 1], [2, 3], [4]]
+
+
+def test_imap_bounded_submits_at_most_window():
+    pulled = []
+
+    def calls():
+        for i in range(20):
+            pulled.append(i)
+            yield (lambda x: x * x), i
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        results = imap_bounded(pool, calls(), window=4)
+        first = next(results)
+        assert len(pulled) <= 4
+        assert sorted([first, *results]) == sorted(i * i for i in range(20))
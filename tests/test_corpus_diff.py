@@ -0,0 +1,47 @@
+import json
+
+from content_index import CONTENT_INDEX_FILE, encode_block, index_records, load_blocks, open_index, read_records
+from corpus_diff import CorpusDiff
+
+
+def write_corpus(corpus_dir, bundles):
+    """Write bundles and their content index, as the post-processor does"""
+    corpus_dir.mkdir(parents=True, exist_ok=True)
+    with open_index(corpus_dir / CONTENT_INDEX_FILE) as index:
+        for name, resources in bundles.items():
+            data = json.dumps({'resourceType': 'Bundle', 'entry': [{'resource': r} for r in resources]}).encode()
+            (corpus_dir / name).write_bytes(data)
+            index.write(encode_block(name, name, 0, len(data), index_records(resources)))
+
+
+def observation(obs_id, value):
+    return {'resourceType': 'Observation', 'id': obs_id, 'valueQuantity': {'value': value}}
+
+
+def test_index_round_trip_with_long_keys(tmp_path):
+    resources = [observation('x' * 300, 1), observation('short', 2)]
+    write_corpus(tmp_path, {'a.json': resources})
+    block = load_blocks(tmp_path / CONTENT_INDEX_FILE)['a.json']
+    with open(tmp_path / CONTENT_INDEX_FILE, 'rb') as f:
+        assert read_records(f, block) == dict(index_records(resources))
+
+
+def test_diff_reports_added_changed_and_deleted(tmp_path):
+    patient = {'resourceType': 'Patient', 'id': 'p'}
+    write_corpus(tmp_path / 'previous', {
+        'a.json': [patient, observation('o1', 1), observation('o2', 2)],
+        'b.json': [{'resourceType': 'Patient', 'id': 'q'}],
+        'gone.json': [observation('o9', 9)],
+    })
+    write_corpus(tmp_path / 'current', {
+        'a.json': [patient, observation('o1', 10), observation('o3', 3)],
+        'b.json': [{'resourceType': 'Patient', 'id': 'q'}],
+    })
+    diff = CorpusDiff(str(tmp_path / 'previous'), str(tmp_path / 'current'))
+    changes = list(diff.iter_changes())
+
+    upserts = {f"{r['resourceType']}/{r['id']}": r for kind, r in changes if kind == 'upsert'}
+    assert set(upserts) == {'Observation/o1', 'Observation/o3'}
+    assert upserts['Observation/o1']['valueQuantity']['value'] == 10
+    assert [key for kind, key in changes if kind == 'delete'] == ['Observation/o2', 'Observation/o9']
+    assert diff.counts == {'added': 1, 'changed': 1, 'deleted': 2, 'unchanged_bundles': 1, 'changed_bundles': 1}
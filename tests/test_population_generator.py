@@ -0,0 +1,34 @@
+import json
+
+from population_generator import SyntheaPopulationGenerator
+
+
+def write_ndjson(path, resources):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(''.join(json.dumps(resource) + '\n' for resource in resources))
+
+
+def read_ids(path):
+    return [json.loads(line)['id'] for line in path.read_text().splitlines()]
+
+
+def test_merge_keeps_one_copy_of_shared_providers(tmp_path):
+    generator = SyntheaPopulationGenerator('synthea.jar', str(tmp_path / 'out'), bulk_data=True)
+    for job, patient in (('a', 'p1'), ('b', 'p2')):
+        fhir_dir = tmp_path / job / 'fhir'
+        write_ndjson(fhir_dir / 'Patient.ndjson', [{'resourceType': 'Patient', 'id': patient}])
+        write_ndjson(fhir_dir / 'Organization.ndjson', [{'resourceType': 'Organization', 'id': 'shared'},
+                                                        {'resourceType': 'Organization', 'id': f"org-{job}"}])
+        generator.merge_job_output(job, tmp_path / job)
+
+    fhir_dir = tmp_path / 'out' / 'fhir'
+    assert read_ids(fhir_dir / 'Patient.ndjson') == ['p1', 'p2']
+    assert read_ids(fhir_dir / 'Organization.ndjson') == ['shared', 'org-a', 'org-b']
+
+
+def test_bundle_runs_leave_ndjson_files_alone(tmp_path):
+    generator = SyntheaPopulationGenerator('synthea.jar', str(tmp_path / 'out'))
+    kept = tmp_path / 'out' / 'fhir' / 'notes.ndjson'
+    write_ndjson(kept, [{'id': 'x'}])
+    generator.run_synthea_jobs([])
+    assert kept.exists()
@@ -0,0 +1,31 @@
+import json
+from datetime import date
+
+from rebaseline import DateRebaseliner, shift_dates
+
+
+def test_shift_keeps_time_zone_and_length():
+    data = b'{"start": "2020-02-28T23:15:00.123-05:00", "birthDate": "1990-12-31", "code": "2020"}'
+    shifted, count = shift_dates(data, 2)
+    assert count == 2
+    assert len(shifted) == len(data)
+    assert json.loads(shifted) == {'start': '2020-03-01T23:15:00.123-05:00', 'birthDate': '1991-01-02',
+                                   'code': '2020'}
+
+
+def test_rebaseline_corpus_to_reference_date(tmp_path):
+    corpus = tmp_path / 'corpus'
+    (corpus / 'ab').mkdir(parents=True)
+    (corpus / 'ab' / 'P_1.json').write_text(json.dumps({'a': '2023-01-01', 'b': '2023-06-30T10:00:00Z'}))
+    (corpus / 'hiv_resources.ndjson').write_text('{"effectiveDateTime": "2023-03-01"}\n')
+
+    rebaseliner = DateRebaseliner(str(corpus), str(tmp_path / 'out'), workers=1)
+    assert rebaseliner.latest_date() == date(2023, 6, 30)
+    days = rebaseliner.days_to(date(2024, 6, 30))
+    assert days == 366
+    assert rebaseliner.days_to(date(2024, 6, 30), keep_weekday=True) % 7 == 0
+
+    assert rebaseliner.rebaseline(days) == (2, 3)
+    shifted = json.loads((tmp_path / 'out' / 'ab' / 'P_1.json').read_text())
+    assert shifted == {'a': '2024-01-02', 'b': '2024-06-30T10:00:00Z'}
+    assert (tmp_path / 'out' / 'hiv_resources.ndjson').read_text() == '{"effectiveDateTime": "2024-03-01"}\n'
@@ -0,0 +1,37 @@
+import numpy as np
+
+from medications_and_labs import HIV_MEDICATIONS
+from regimens import (CONDITION_BITS, HBV_POSITIVE, HLA_B5701_POSITIVE, RegimenSampler, build_regimens,
+                      ingredients)
+
+
+def test_ingredients_ignore_strengths_and_units():
+    assert ingredients('cabotegravir 200mg/ml / rilpivirine 300mg/ml') == ['cabotegravir', 'rilpivirine']
+    assert ingredients('emtricitabine 200mg / tenofovir disoproxil fumarate 300mg') == \
+        ['emtricitabine', 'tenofovir disoproxil fumarate']
+
+
+def test_catalog_ingredients_are_drug_names():
+    for info in HIV_MEDICATIONS.values():
+        for name in ingredients(info['components']):
+            assert not any(ch.isdigit() for ch in name)
+            assert name not in ('mg', 'ml', 'mcg')
+
+
+def test_combined_regimens_repeat_no_ingredient():
+    for regimen in build_regimens():
+        drugs = [d for med in regimen.medications for d in ingredients(HIV_MEDICATIONS[med]['components'])]
+        assert len(drugs) == len(set(drugs)), regimen.name
+
+
+def test_sampled_regimens_respect_contraindications():
+    sampler = RegimenSampler(seed=0)
+    masks = np.repeat(np.arange(1 << CONDITION_BITS), 200)
+    for mask, index in zip(masks, sampler.sample(masks)):
+        regimen = sampler.regimens[index]
+        drugs = {d for med in regimen.medications for d in ingredients(HIV_MEDICATIONS[med]['components'])}
+        if mask & HLA_B5701_POSITIVE:
+            assert 'abacavir' not in drugs
+        if mask & HBV_POSITIVE:
+            assert any(d.startswith('tenofovir') for d in drugs)
+            assert drugs & {'emtricitabine', 'lamivudine'}
@@ -0,0 +1,75 @@
+import json
+
+from post_processor import GENERATED_TAG, NDJSON_PATCH_FILE
+from subset import SubsetExtractor
+
+VIRAL_LOAD = {'coding': [{'system': 'http://loinc.org', 'code': '20447-9'}]}
+
+
+def patient(patient_id, gender):
+    return {'resourceType': 'Patient', 'id': patient_id, 'gender': gender}
+
+
+def viral_load(patient_id, value):
+    return {
+        'resourceType': 'Observation', 'id': f"vl-{patient_id}", 'meta': {'tag': [GENERATED_TAG]},
+        'code': VIRAL_LOAD, 'subject': {'reference': f"Patient/{patient_id}"},
+        'effectiveDateTime': '2024-01-01', 'valueQuantity': {'value': value}
+    }
+
+
+def write_bundle(path, resources):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps({'resourceType': 'Bundle', 'entry': [{'resource': r} for r in resources]}))
+
+
+def population():
+    """30 non-ADAP women and 10 undetectable ADAP men"""
+    people = [(f"f{i}", 'female', None) for i in range(30)]
+    return people + [(f"m{i}", 'male', 5) for i in range(10)]
+
+
+def test_bundle_subset_keeps_stratum_proportions(tmp_path):
+    for patient_id, gender, value in population():
+        resources = [patient(patient_id, gender)] + ([viral_load(patient_id, value)] if value is not None else [])
+        write_bundle(tmp_path / 'corpus' / f"P_{patient_id}.json", resources)
+    write_bundle(tmp_path / 'corpus' / 'hospitalInformation1.json', [])
+
+    result = SubsetExtractor(str(tmp_path / 'corpus'), str(tmp_path / 'out'), 8, seed=1, workers=1).extract()
+
+    assert result == {('non_adap', 'F', 'no_vl'): (30, 6), ('adap', 'M', 'undetectable'): (10, 2)}
+    copied = sorted(path.name for path in (tmp_path / 'out').iterdir())
+    assert len(copied) == 9 and 'hospitalInformation1.json' in copied
+
+
+def test_sidecar_sex_comes_from_base_bundles(tmp_path):
+    for patient_id, gender, value in population():
+        write_bundle(tmp_path / 'base' / f"P_{patient_id}.json", [patient(patient_id, gender)])
+        if value is not None:
+            write_bundle(tmp_path / 'corpus' / f"P_{patient_id}.patch.json", [viral_load(patient_id, value)])
+
+    with_base = SubsetExtractor(str(tmp_path / 'corpus'), str(tmp_path / 'out1'), 5, seed=1, workers=1,
+                                base_dir=str(tmp_path / 'base'))
+    assert with_base.extract() == {('adap', 'M', 'undetectable'): (10, 5)}
+
+    without_base = SubsetExtractor(str(tmp_path / 'corpus'), str(tmp_path / 'out2'), 5, seed=1, workers=1)
+    assert without_base.extract() == {('adap', 'unknown', 'undetectable'): (10, 5)}
+    assert without_base.unknown_sex == 10
+
+
+def test_ndjson_sex_comes_from_patient_ndjson(tmp_path):
+    (tmp_path / 'base').mkdir()
+    (tmp_path / 'corpus').mkdir()
+    people = [(f"f{i}", 'female', 300) for i in range(6)] + [(f"m{i}", 'male', 5) for i in range(2)]
+    with open(tmp_path / 'base' / 'Patient.ndjson', 'w') as f:
+        for patient_id, gender, _ in people:
+            f.write(json.dumps(patient(patient_id, gender)) + '\n')
+    with open(tmp_path / 'corpus' / NDJSON_PATCH_FILE, 'w') as f:
+        for patient_id, _, value in people:
+            f.write(json.dumps(viral_load(patient_id, value), separators=(',', ':')) + '\n')
+
+    extractor = SubsetExtractor(str(tmp_path / 'corpus'), str(tmp_path / 'out'), 4, seed=1, workers=1,
+                                base_dir=str(tmp_path / 'base'))
+    assert extractor.extract() == {('adap', 'F', 'detectable'): (6, 3), ('adap', 'M', 'undetectable'): (2, 1)}
+    assert extractor.unknown_sex == 0
+    assert len((tmp_path / 'out' / NDJSON_PATCH_FILE).read_text().splitlines()) == 4
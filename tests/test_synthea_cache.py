@@ -0,0 +1,95 @@
+import os
+
+from synthea_cache import SyntheaCache, clone_file, clone_tree
+
+
+def write_run(fhir_dir, bundles):
+    fhir_dir.mkdir(parents=True, exist_ok=True)
+    for name, data in bundles.items():
+        (fhir_dir / name).write_text(data)
+
+
+def read_dir(fhir_dir):
+    return {path.name: path.read_text() for path in fhir_dir.iterdir() if path.is_file()}
+
+
+def test_clone_file_over_link_to_itself_keeps_content(tmp_path):
+    src = tmp_path / 'src.json'
+    src.write_text('{"resourceType": "Bundle"}')
+    dst = tmp_path / 'dst.json'
+    os.link(src, dst)
+    clone_file(str(src), str(dst))
+    assert src.read_text() == dst.read_text() == '{"resourceType": "Bundle"}'
+    assert sorted(os.listdir(tmp_path)) == ['dst.json', 'src.json']
+
+
+def test_materialize_into_same_output_keeps_cache_entry(tmp_path):
+    bundles = {'a.json': '{"id": "a"}', 'hospitalInformation1.json': '{"id": "h"}'}
+    run_dir = tmp_path / 'run' / 'fhir'
+    write_run(run_dir, bundles)
+    cache = SyntheaCache(tmp_path / 'cache')
+    cache.store('k', run_dir)
+    out = tmp_path / 'out' / 'fhir'
+    clone_tree(run_dir, out)
+    assert cache.materialize('k', out)
+    assert cache.materialize('k', out)
+    assert read_dir(out) == bundles
+    assert read_dir(cache.lookup('k')) == bundles
+
+
+def test_store_copies_only_the_given_directory(tmp_path):
+    run_dir = tmp_path / 'run' / 'fhir'
+    write_run(run_dir, {'a.json': '{"id": "a"}'})
+    cache = SyntheaCache(tmp_path / 'cache')
+    cache.store('k', run_dir)
+    write_run(run_dir, {'stale.json': '{}'})
+    cache.store('k', run_dir)  # an existing entry is never rewritten
+    out = tmp_path / 'out'
+    assert cache.materialize('k', out)
+    assert read_dir(out) == {'a.json': '{"id": "a"}'}
+
+
+def test_miss_and_eviction(tmp_path):
+    run_dir = tmp_path / 'run'
+    write_run(run_dir, {'a.json': 'x' * 100})
+    cache = SyntheaCache(tmp_path / 'cache', max_bytes=150)
+    assert not cache.materialize('missing', tmp_path / 'out')
+    cache.store('k1', run_dir)
+    os.utime(cache.entries_dir / 'k1' / 'last_used', (0, 0))
+    cache.store('k2', run_dir)
+    assert cache.lookup('k1') is None
+    assert cache.lookup('k2') is not None
+
+
+FAKE_JAVA = '''#!/bin/sh
+for arg in "$@"; do
+    case "$arg" in --exporter.baseDirectory=*) base="${arg#*=}";; esac
+done
+mkdir -p "$base/fhir"
+echo '{"resourceType": "Bundle", "entry": []}' > "$base/fhir/Name_Fam_1.json"
+'''
+
+
+def test_execute_caches_only_its_own_run(tmp_path, monkeypatch):
+    from population_generator import SyntheaPopulationGenerator
+
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    (bin_dir / 'java').write_text(FAKE_JAVA)
+    (bin_dir / 'java').chmod(0o755)
+    monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    jar = tmp_path / 'synthea.jar'
+    jar.write_bytes(b'jar')
+
+    output_dir = tmp_path / 'output'
+    write_run(output_dir / 'fhir', {'stale.json': '{}'})
+    generator = SyntheaPopulationGenerator(str(jar), str(output_dir), population_size=1,
+                                           cache_dir=str(tmp_path / 'cache'))
+    cmd = generator.synthea_command(1, output_dir, 'Massachusetts', 'Boston')
+    generator._execute('synthea', cmd, output_dir / 'fhir')
+    generator._execute('synthea', cmd, output_dir / 'fhir')  # cache hit into the same directory
+
+    key = generator.cache.key(jar, cmd)
+    assert set(read_dir(generator.cache.lookup(key))) == {'Name_Fam_1.json'}
+    assert read_dir(output_dir / 'fhir')['Name_Fam_1.json'].startswith('{"resourceType"')
+    assert not any(path.name.startswith('.synthea-') for path in output_dir.iterdir())
@@ -0,0 +1,109 @@
+import json
+import os
+import threading
+
+from work_queue import CLAIMS, DONE, WorkQueue
+
+
+def make_queue(queue_dir, worker_id, lease_seconds=60):
+    queue = WorkQueue(str(queue_dir), lease_seconds=lease_seconds)
+    queue.worker_id = worker_id
+    queue.add_task({'id': 't', 'kind': 'generate'})
+    return queue
+
+
+def expire(queue, task_id='t'):
+    os.utime(queue._path(CLAIMS, task_id), (0, 0))
+
+
+def claim(queue, task_id='t'):
+    return queue._path(CLAIMS, task_id).read_text()
+
+
+def test_claim_is_exclusive(tmp_path):
+    a, b = make_queue(tmp_path, 'A'), make_queue(tmp_path, 'B')
+    assert a.claim_next()['id'] == 't'
+    assert b.claim_next() is None
+    assert a.owns('t') and not b.owns('t')
+
+
+def test_released_task_can_be_claimed_again(tmp_path):
+    a, b = make_queue(tmp_path, 'A'), make_queue(tmp_path, 'B')
+    a.claim_next()
+    a.release('t')
+    assert a.status()['generate']['running'] == 0
+    assert b.claim_next()['id'] == 't'
+    assert b.owns('t') and not a.owns('t')
+
+
+def test_expired_lease_is_taken_over(tmp_path):
+    a, b = make_queue(tmp_path, 'A'), make_queue(tmp_path, 'B')
+    a.claim_next()
+    expire(a)
+    assert b.claim_next()['id'] == 't'
+    assert not a.owns('t')
+    a.complete('t')
+    assert not a._path(DONE, 't').exists()
+    b.complete('t')
+    assert b._path(DONE, 't').exists()
+
+
+def test_live_lease_is_not_taken_over(tmp_path):
+    a, b = make_queue(tmp_path, 'A', lease_seconds=60), make_queue(tmp_path, 'B')
+    a.claim_next()
+    before = claim(a)
+    assert b.claim_next() is None
+    assert claim(a) == before
+
+
+def test_restarted_worker_with_same_id_does_not_own_old_claim(tmp_path):
+    a = make_queue(tmp_path, 'A')
+    a.claim_next()
+    restarted = make_queue(tmp_path, 'A')
+    assert not restarted.owns('t')
+    restarted.release('t')
+    assert a.owns('t')
+
+
+def test_claim_being_replaced_is_left_alone(tmp_path):
+    a, c, d = make_queue(tmp_path, 'A'), make_queue(tmp_path, 'C'), make_queue(tmp_path, 'D')
+    a.claim_next()
+    expire(a)
+    token = json.loads(claim(a))['token']
+    # C holds the lock for A's token while it verifies and replaces the claim
+    lock = a._path(CLAIMS, 't').with_name(f".t.{token}.lock")
+    lock.write_text('{"worker": "C"}')
+    before = claim(a)
+    assert d.claim_next() is None
+    assert claim(a) == before
+    lock.unlink()
+    assert c.claim_next()['id'] == 't'
+
+
+def test_concurrent_takeover_has_one_winner(tmp_path):
+    make_queue(tmp_path, 'A').claim_next()
+    expire(make_queue(tmp_path, 'A'))
+    queues = [make_queue(tmp_path, f"W{i}") for i in range(8)]
+    start = threading.Barrier(len(queues))
+    won = []
+
+    def take(queue):
+        start.wait()
+        if queue.claim_next() is not None:
+            won.append(queue.worker_id)
+
+    threads = [threading.Thread(target=take, args=(queue,)) for queue in queues]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(won) == 1
+    assert [queue.worker_id for queue in queues if queue.owns('t')] == won
+
+
+def test_task_completed_by_previous_holder_is_not_run_again(tmp_path):
+    a, b = make_queue(tmp_path, 'A'), make_queue(tmp_path, 'B')
+    a.claim_next()
+    a.complete('t')
+    assert b.claim_next() is None
+    assert a.status()['generate'] == {'done': 1, 'running': 0, 'failed': 0, 'pending': 0}
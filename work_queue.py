@@ -0,0 +1,439 @@
+"""
+Multi-Node Shard Work Queue
+Splits a large build into shards and lets any number of workers, on any
+number of machines sharing a filesystem, generate and post-process them
+without an external broker.
+
+The queue is a directory:
+    tasks/<id>.json     task specs, written once by `init`
+    claims/<id>.json    the worker holding a task (its lease), or a released claim
+    done/<id>.json      completion records
+    failed/<id>.json    failed attempts per task
+
+A worker claims a task by hard-linking a fully written claim file into
+claims/ (atomic, and fails if the task is already claimed, also over NFS).
+Every claim carries a random lease token. It renews its lease by touching
+the claim while it works. A claim whose mtime is older than the lease has
+been left by a crashed node and may be taken over. Once created, a claim
+file is only ever replaced, never removed, and only by the worker that won
+the lock for the token it replaces (claims/.<id>.<token>.lock, again
+created by an exclusive link). The winner re-reads the claim under the
+lock and replaces it only if it still holds that token and may still be
+taken, so a claim is never moved unverified and there is no moment without
+one. Releasing a task replaces the claim with a released record the same
+way. A worker owns a task only while the claim holds the token it got when
+claiming, so a takeover is detected even by a restarted worker with the
+same id. Post-processing shard k waits until generating shard k is done.
+
+Process tasks write into a staging directory of their own and then move
+their bundles into the shared output, renaming each shard's hospital and
+practitioner bundles so they do not overwrite each other.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional
+from dotenv import load_dotenv
+
+from fhir_files import PATIENT, output_path_for, scan_bundle_files
+from population_generator import SyntheaPopulationGenerator
+from post_processor import FHIRPostProcessor
+
+load_dotenv()
+
+
+TASK_KINDS = ('generate', 'process')
+
+TASKS = 'tasks'
+CLAIMS = 'claims'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def write_atomic(path: Path, record: Dict):
+    """Write a JSON record to a temporary file and rename it into place"""
+    tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}")
+    with open(tmp, 'w') as f:
+        json.dump(record, f, indent=2)
+    os.replace(tmp, path)
+
+
+def read_record(path: Path) -> Optional[Dict]:
+    """JSON record at path, or None if it does not exist (or is being replaced)"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def shard_id(kind: str, index: int) -> str:
+    return f"{kind}-{index:06d}"
+
+
+class WorkQueue:
+    """File-based task queue with atomic claims and renewable leases"""
+
+    def __init__(self, queue_dir: str, lease_seconds: float = 600, max_attempts: int = 3):
+        self.queue_dir = Path(queue_dir)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+        # Task id -> lease token of this worker's claims
+        self.leases: Dict[str, str] = {}
+        for name in (TASKS, CLAIMS, DONE, FAILED):
+            (self.queue_dir / name).mkdir(parents=True, exist_ok=True)
+
+    def _path(self, area: str, task_id: str) -> Path:
+        return self.queue_dir / area / f"{task_id}.json"
+
+    def add_task(self, task: Dict):
+        """Register a task spec (idempotent: existing specs are left alone)"""
+        path = self._path(TASKS, task['id'])
+        if not path.exists():
+            write_atomic(path, task)
+
+    def iter_tasks(self) -> Iterator[Dict]:
+        """All task specs, in id order"""
+        for path in sorted((self.queue_dir / TASKS).glob('*.json')):
+            task = read_record(path)
+            if task is not None:
+                yield task
+
+    def is_done(self, task_id: str) -> bool:
+        return self._path(DONE, task_id).exists()
+
+    def attempts(self, task_id: str) -> int:
+        record = read_record(self._path(FAILED, task_id))
+        return len(record['attempts']) if record else 0
+
+    def failed_out(self, task: Dict) -> bool:
+        """True once a task, or a task it waits on, has used up its attempts"""
+        return any(self.attempts(task_id) >= self.max_attempts
+                   for task_id in [task['id']] + task.get('after', []))
+
+    def _lease_expired(self, claim_path: Path) -> bool:
+        try:
+            return time.time() - os.stat(claim_path).st_mtime > self.lease_seconds
+        except FileNotFoundError:
+            return False
+
+    def _link_record(self, path: Path, record: Dict) -> bool:
+        """Create path holding record by an exclusive hard link; False if it exists"""
+        tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}")
+        with open(tmp, 'w') as f:
+            json.dump(record, f)
+        try:
+            os.link(tmp, path)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.unlink(tmp)
+
+    def _replace_claim(self, task_id: str, token: str, record: Dict, may_replace: Callable[[Dict], bool]) -> bool:
+        """Replace the claim holding token by record, if may_replace still holds under its lock"""
+        claim_path = self._path(CLAIMS, task_id)
+        lock = claim_path.with_name(f".{task_id}.{token}.lock")
+        if not self._link_record(lock, {'worker': self.worker_id}):
+            # Another worker is replacing this claim; a lock older than the
+            # lease was left by a node that crashed while holding it
+            if self._lease_expired(lock):
+                try:
+                    os.unlink(lock)
+                except FileNotFoundError:
+                    pass
+            return False
+        try:
+            claim = read_record(claim_path)
+            if claim is None or claim.get('token') != token or not may_replace(claim):
+                return False
+            write_atomic(claim_path, record)
+            return True
+        finally:
+            os.unlink(lock)
+
+    def _try_claim(self, task_id: str) -> Optional[str]:
+        """Lease token of a new claim on the task, or None if it is held"""
+        claim_path = self._path(CLAIMS, task_id)
+        token = uuid.uuid4().hex
+        record = {'worker': self.worker_id, 'claimed': time.time(), 'token': token}
+        if self._link_record(claim_path, record):
+            return token
+        claim = read_record(claim_path)
+        if claim is None:
+            return None
+        if not claim.get('released') and not self._lease_expired(claim_path):
+            return None
+        # Released, or an expired lease from a crashed node
+        if not self._replace_claim(task_id, claim.get('token'), record,
+                                   lambda current: current.get('released') or self._lease_expired(claim_path)):
+            return None
+        if not claim.get('released'):
+            print(f"♻️  Reclaimed expired lease on {task_id}")
+        return token
+
+    def owns(self, task_id: str) -> bool:
+        """True while the task's claim holds the token this worker claimed it with"""
+        token = self.leases.get(task_id)
+        claim = read_record(self._path(CLAIMS, task_id))
+        return token is not None and claim is not None and claim.get('token') == token \
+            and not claim.get('released')
+
+    def renew(self, task_id: str):
+        """Extend this worker's lease on a task"""
+        if self.owns(task_id):
+            os.utime(self._path(CLAIMS, task_id))
+
+    def claim_next(self, kinds=TASK_KINDS) -> Optional[Dict]:
+        """Claim the first runnable task, or None if nothing is available now"""
+        for task in self.iter_tasks():
+            if task['kind'] not in kinds or self.is_done(task['id']):
+                continue
+            if self.failed_out(task):
+                continue
+            if not all(self.is_done(dep) for dep in task.get('after', [])):
+                continue
+            token = self._try_claim(task['id'])
+            if token is None:
+                continue
+            self.leases[task['id']] = token
+            if self.is_done(task['id']):
+                # Completed by the previous holder after we listed it
+                self.release(task['id'])
+                continue
+            return task
+        return None
+
+    def complete(self, task_id: str, result: Dict = None):
+        """Record completion and release the claim"""
+        if not self.owns(task_id):
+            print(f"⚠️  Lease on {task_id} was taken over; not recording completion")
+            return
+        write_atomic(self._path(DONE, task_id), {
+            'worker': self.worker_id,
+            'finished': time.time(),
+            **(result or {})
+        })
+        self.release(task_id)
+
+    def fail(self, task_id: str, error: str):
+        """Record a failed attempt and release the claim so the task can be retried"""
+        path = self._path(FAILED, task_id)
+        record = read_record(path) or {'attempts': []}
+        record['attempts'].append({'worker': self.worker_id, 'time': time.time(), 'error': error})
+        write_atomic(path, record)
+        self.release(task_id)
+
+    def release(self, task_id: str):
+        token = self.leases.pop(task_id, None)
+        if token is not None:
+            released = {'worker': self.worker_id, 'released': time.time(), 'token': uuid.uuid4().hex}
+            self._replace_claim(task_id, token, released, lambda current: not current.get('released'))
+
+    def status(self) -> Dict[str, Dict[str, int]]:
+        """Per-kind counts of done, running, failed-out and pending tasks"""
+        counts = {}
+        for task in self.iter_tasks():
+            kind_counts = counts.setdefault(task['kind'], {'done': 0, 'running': 0, 'failed': 0, 'pending': 0})
+            if self.is_done(task['id']):
+                kind_counts['done'] += 1
+            elif not (read_record(self._path(CLAIMS, task['id'])) or {'released': True}).get('released'):
+                kind_counts['running'] += 1
+            elif self.failed_out(task):
+                kind_counts['failed'] += 1
+            else:
+                kind_counts['pending'] += 1
+        return counts
+
+
+def plan_build(queue: WorkQueue,
+               build_dir: str,
+               population_size: int,
+               shard_size: int = 10000,
+               seed: int = 0,
+               state: str = "Massachusetts",
+               city: str = "Boston",
+               synthea_jar_path: str = "./synthea-with-dependencies.jar",
+               adap_percentage: float = 0.5,
+               output_layout: str = 'sharded',
+               cache_dir: str = None) -> int:
+    """Split a build into generate/process task pairs, one per shard"""
+    build_dir = Path(build_dir).resolve()
+    shard_count = (population_size + shard_size - 1) // shard_size
+    for index in range(shard_count):
+        size = min(shard_size, population_size - index * shard_size)
+        shard_dir = build_dir / "synthea" / f"shard-{index:06d}"
+        queue.add_task({
+            'id': shard_id('generate', index),
+            'kind': 'generate',
+            'synthea_jar_path': str(Path(synthea_jar_path).resolve()),
+            'output_dir': str(shard_dir),
+            'population_size': size,
+            'seed': seed + index,  # distinct seeds, or every shard generates the same patients
+            'state': state,
+            'city': city,
+            'cache_dir': cache_dir
+        })
+        queue.add_task({
+            'id': shard_id('process', index),
+            'kind': 'process',
+            'after': [shard_id('generate', index)],
+            'input_dir': str(shard_dir / "fhir"),
+            'output_dir': str(build_dir / "processed"),
+            'adap_percentage': adap_percentage,
+            'output_layout': output_layout,
+            'seed': seed + index
+        })
+    return shard_count
+
+
+def merge_task_output(task_id: str, staging_dir: Path, output_dir: Path, output_layout: str) -> int:
+    """Move a process task's bundles into the shared output; returns the number moved"""
+    moved = 0
+    for bundle_file in scan_bundle_files(staging_dir, recursive=True):
+        if bundle_file.kind == PATIENT:
+            target = output_path_for(output_dir, bundle_file.name, output_layout)
+        else:
+            # Every shard has its own hospital/practitioner bundles
+            target = output_dir / f"{bundle_file.name[:-len('.json')]}_{task_id}.json"
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(bundle_file.path, target)
+        moved += 1
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    return moved
+
+
+def run_task(task: Dict) -> Dict:
+    """Execute one task; re-running a task overwrites its previous partial output"""
+    if task['kind'] == 'generate':
+        # A crashed attempt may have left a partial fhir/ directory behind
+        shutil.rmtree(Path(task['output_dir']) / "fhir", ignore_errors=True)
+        generator = SyntheaPopulationGenerator(
+            synthea_jar_path=task['synthea_jar_path'],
+            output_dir=task['output_dir'],
+            population_size=task['population_size'],
+            seed=task['seed'],
+            cache_dir=task.get('cache_dir')
+        )
+        generator.run_synthea(task['state'], task['city'])
+        return {'patients': sum(1 for _ in generator.iter_generated_patients())}
+
+    output_dir = Path(task['output_dir'])
+    staging_dir = output_dir.parent / "staging" / task['id']
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    processor = FHIRPostProcessor(
+        input_dir=task['input_dir'],
+        output_dir=str(staging_dir),
+        adap_percentage=task['adap_percentage'],
+        output_layout=task['output_layout'],
+        seed=task['seed']
+    )
+    processor.process_all_bundles()
+    return {'bundles': merge_task_output(task['id'], staging_dir, output_dir, task['output_layout'])}
+
+
+class Worker:
+    """Claims and runs tasks until the queue is drained"""
+
+    def __init__(self, queue: WorkQueue, kinds: List[str] = TASK_KINDS, poll_seconds: float = 10):
+        self.queue = queue
+        self.kinds = kinds
+        self.poll_seconds = poll_seconds
+
+    def _heartbeat(self, task_id: str, stop: threading.Event):
+        while not stop.wait(self.queue.lease_seconds / 3):
+            self.queue.renew(task_id)
+
+    def run_one(self, task: Dict):
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(task['id'], stop), daemon=True)
+        heartbeat.start()
+        started = time.time()
+        print(f"▶️  {self.queue.worker_id} running {task['id']}")
+        try:
+            result = run_task(task)
+        except Exception as e:
+            print(f"❌ {task['id']} failed: {e}")
+            self.queue.fail(task['id'], str(e))
+            return
+        finally:
+            stop.set()
+            heartbeat.join()
+        self.queue.complete(task['id'], dict(result, seconds=round(time.time() - started, 1)))
+        print(f"✅ {task['id']} done in {time.time() - started:.0f}s")
+
+    def run(self) -> int:
+        """Process tasks until none are left; returns the number this worker ran"""
+        completed = 0
+        while True:
+            task = self.queue.claim_next(self.kinds)
+            if task is not None:
+                self.run_one(task)
+                completed += 1
+                continue
+            counts = self.queue.status()
+            remaining = sum(
+                c['pending'] + c['running'] for kind, c in counts.items() if kind in self.kinds
+            )
+            if remaining == 0:
+                return completed
+            # Remaining tasks are claimed elsewhere or wait on a dependency
+            time.sleep(self.poll_seconds)
+
+
+def main():
+    """Main execution"""
+    parser = argparse.ArgumentParser(description="Shared-directory work queue for sharded builds")
+    parser.add_argument('--queue-dir', default=os.getenv('WORK_QUEUE_DIR', './work_queue'))
+    parser.add_argument('--lease-seconds', type=float, default=600)
+    parser.add_argument('--max-attempts', type=int, default=3)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    init = commands.add_parser('init', help="Plan generate/process tasks for a build")
+    init.add_argument('--build-dir', default=os.getenv('PROCESSED_FHIR_DIR', './processed_fhir'))
+    init.add_argument('--population', type=int, required=True)
+    init.add_argument('--shard-size', type=int, default=10000)
+    init.add_argument('--seed', type=int, default=0)
+    init.add_argument('--state', default="Massachusetts")
+    init.add_argument('--city', default="Boston")
+    init.add_argument('--synthea-jar', default="./synthea-with-dependencies.jar")
+    init.add_argument('--adap-percentage', type=float, default=0.5)
+    init.add_argument('--output-layout', default='sharded')
+    init.add_argument('--cache-dir', default=os.getenv('SYNTHEA_CACHE_DIR'))
+
+    worker = commands.add_parser('worker', help="Claim and run tasks until the queue is drained")
+    worker.add_argument('--kinds', default=','.join(TASK_KINDS),
+                        help="Comma-separated task kinds to run (generate, process)")
+    worker.add_argument('--poll-seconds', type=float, default=10)
+
+    commands.add_parser('status', help="Show task counts")
+    args = parser.parse_args()
+
+    queue = WorkQueue(args.queue_dir, lease_seconds=args.lease_seconds, max_attempts=args.max_attempts)
+
+    if args.command == 'init':
+        shard_count = plan_build(
+            queue, args.build_dir, args.population, args.shard_size, args.seed,
+            args.state, args.city, args.synthea_jar, args.adap_percentage,
+            args.output_layout, args.cache_dir
+        )
+        print(f"📋 Planned {shard_count} shards ({2 * shard_count} tasks) in {queue.queue_dir}")
+    elif args.command == 'worker':
+        kinds = [kind.strip() for kind in args.kinds.split(',') if kind.strip()]
+        completed = Worker(queue, kinds, args.poll_seconds).run()
+        print(f"\n✅ Worker {queue.worker_id} finished {completed} tasks")
+
+    for kind, counts in queue.status().items():
+        print(f"   {kind:<10} " + "  ".join(f"{state}: {n}" for state, n in counts.items()))
+
+
+if __name__ == "__main__":
+    main()